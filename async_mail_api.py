@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Asynchronous Microsoft Mail Client
+asyncio counterpart of mail_api.EmailClient for fetching many folders or
+mailboxes concurrently from one process
+
+Requires the optional aiohttp dependency:
+    pip install outlook-mail-automation[async]
+"""
+
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+
+import aiohttp
+
+import mail_api
+from mail_api import build_email_message, build_message_query, get_timeout, load_config
+from instrumentation import Instrumentation, get_instrumentation
+from proxy_resolver import ProxyResolver
+from throttling import RateLimiter, RetryMetrics, RetryPolicy, THROTTLE_STATUSES
+from token_store import AccountToken, TokenStore, open_token_store
+
+logger = logging.getLogger(__name__)
+
+
+def _request_size(kwargs: Dict) -> int:
+    """Approximate request body size from aiohttp request arguments"""
+    if kwargs.get('json') is not None:
+        return len(json.dumps(kwargs['json']))
+    data = kwargs.get('data')
+    return len(data) if isinstance(data, (bytes, str)) else 0
+
+
+def create_connector(config) -> aiohttp.TCPConnector:
+    """Create an aiohttp connection pool from the [http] section of config.txt
+
+    pool_connections * pool_maxsize bounds the total number of open
+    connections and pool_maxsize bounds connections per host, mirroring
+    mail_api.create_session.
+    """
+    pool_connections = config.getint('http', 'pool_connections', fallback=10)
+    pool_maxsize = config.getint('http', 'pool_maxsize', fallback=10)
+    keep_alive = config.getboolean('http', 'keep_alive', fallback=True)
+    return aiohttp.TCPConnector(
+        limit=pool_connections * pool_maxsize,
+        limit_per_host=pool_maxsize,
+        force_close=not keep_alive
+    )
+
+
+class AsyncEmailClient:
+    """Asynchronous email client returning the same data as EmailClient
+
+    Use as an async context manager so the connection pool is closed:
+
+        async with AsyncEmailClient() as client:
+            inbox, junk = await asyncio.gather(
+                client.get_messages(top=5), client.get_junk_messages(top=5))
+    """
+
+    def __init__(self, session: aiohttp.ClientSession = None, proxy_resolver: ProxyResolver = None,
+                 max_concurrency: int = None, account: str = 'default', token_store: TokenStore = None,
+                 retry_policy: RetryPolicy = None, rate_limiter: RateLimiter = None,
+                 retry_metrics: RetryMetrics = None, instrumentation: Instrumentation = None):
+        """Create asynchronous email client
+
+        Args:
+            session: Optional aiohttp session to share between clients,
+                defaults to a new pooled session configured from config.txt
+            proxy_resolver: Optional proxy resolver to share between clients,
+                defaults to one configured from the [proxy] section of config.txt
+            max_concurrency: Maximum number of in-flight requests of this client,
+                defaults to [http] max_concurrency or 50
+            account: Account this client acts as
+            token_store: Optional token store, defaults to the one selected by
+                the [token_store] section of config.txt
+            retry_policy: Optional retry policy, defaults to the [retry] section of config.txt
+            rate_limiter: Optional per-mailbox rate limiter to share between clients,
+                defaults to one configured from the [retry] section of config.txt
+            retry_metrics: Optional counters to share between clients
+            instrumentation: Optional metrics collector, defaults to the process-wide one
+        """
+        config = load_config()
+        self.config = config
+        self._session = session
+        self._owns_session = session is None
+        self.proxy_resolver = proxy_resolver if proxy_resolver is not None else ProxyResolver.from_config(config)
+        if max_concurrency is None:
+            max_concurrency = config.getint('http', 'max_concurrency', fallback=50)
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy.from_config(config)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter.from_config(config)
+        self.instrumentation = instrumentation if instrumentation is not None else get_instrumentation(config)
+        self.retry_metrics = retry_metrics if retry_metrics is not None else RetryMetrics()
+        if self.retry_metrics.parent is None and self.retry_metrics is not self.instrumentation.retry_metrics:
+            self.retry_metrics.parent = self.instrumentation.retry_metrics
+        self._refresh_lock = None
+        self.account = account
+        self._owns_token_store = token_store is None
+        self.token_store = token_store if token_store is not None else open_token_store(config)
+        token = self.token_store.load(account) or AccountToken(account, '')
+        self.refresh_token = token.refresh_token
+        self.access_token = token.access_token
+        self.expires_at = token.expires_at
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Pooled aiohttp session, created on first use inside the running event loop"""
+        if self._session is None:
+            connect_timeout, read_timeout = get_timeout(self.config)
+            self._session = aiohttp.ClientSession(
+                connector=create_connector(self.config),
+                timeout=aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout)
+            )
+        return self._session
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        """Concurrency limit, created on first use inside the running event loop"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @property
+    def refresh_lock(self) -> asyncio.Lock:
+        """Lock shared by concurrent token refreshes, created on first use inside the running event loop"""
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        return self._refresh_lock
+
+    async def close(self) -> None:
+        """Close the HTTP session if it is owned by this client"""
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._owns_token_store:
+            self.token_store.close()
+
+    async def _request(self, method: str, url: str, rate_limited: bool = True,
+                       **kwargs) -> aiohttp.ClientResponse:
+        """Send an HTTP request and read its body, bounded by the client's concurrency limit
+
+        Retries throttled and transient failures like EmailClient._request.
+        """
+        kwargs.setdefault('proxy', self.proxy_resolver.resolve().get('https'))
+
+        attempt = 0
+        while True:
+            if rate_limited:
+                wait = self.rate_limiter.reserve(self.account)
+                if wait > 0:
+                    self.retry_metrics.increment('rate_limited')
+                    await asyncio.sleep(wait)
+            self.retry_metrics.increment('requests')
+            start = time.perf_counter()
+            try:
+                async with self.semaphore:
+                    response = await self.session.request(method, url, **kwargs)
+                    body = await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.instrumentation.record_request(method, url, None, time.perf_counter() - start,
+                                                    attempt=attempt, account=self.account)
+                if not self.retry_policy.should_retry_error(method, attempt):
+                    raise
+                delay = self.retry_policy.delay(attempt)
+                self.retry_metrics.increment('retries')
+                logger.warning(f"{method} {url} failed ({e!r}), retrying in {delay:.1f}s")
+            else:
+                self.instrumentation.record_request(method, url, response.status, time.perf_counter() - start,
+                                                    _request_size(kwargs), len(body), attempt, self.account)
+                retry_after = response.headers.get('Retry-After')
+                if not self.retry_policy.should_retry_status(method, response.status, attempt, retry_after):
+                    return response
+                if response.status in THROTTLE_STATUSES:
+                    self.retry_metrics.increment('throttled')
+                delay = self.retry_policy.delay(attempt, retry_after)
+                self.retry_metrics.increment('retries')
+                logger.warning(f"{method} {url} returned {response.status}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def is_token_expired(self) -> bool:
+        """Check if access token is expired or about to expire"""
+        buffer_time = 300
+        return datetime.now().timestamp() + buffer_time >= self.expires_at
+
+    async def refresh_access_token(self) -> None:
+        """Refresh access token"""
+        with self.instrumentation.time_token_refresh(self.account):
+            await self._refresh_now()
+
+    async def _refresh_now(self) -> None:
+        refresh_params = {
+            'client_id': mail_api.settings.client_id,
+            'refresh_token': self.refresh_token,
+            'grant_type': 'refresh_token',
+        }
+
+        try:
+            response = await self._request('POST', mail_api.TOKEN_URL, rate_limited=False, data=refresh_params)
+            response.raise_for_status()
+            tokens = await response.json()
+
+            self.access_token = tokens['access_token']
+            self.expires_at = time.time() + tokens['expires_in']
+            if 'refresh_token' in tokens:
+                self.refresh_token = tokens['refresh_token']
+            self.token_store.save(AccountToken(self.account, self.refresh_token, self.access_token, self.expires_at))
+        except aiohttp.ClientError as e:
+            logger.error(f"Failed to refresh access token: {e}")
+            raise
+
+    async def ensure_token_valid(self):
+        """Ensure token is valid, sharing one refresh between concurrent callers"""
+        if self.access_token and not self.is_token_expired():
+            return
+        async with self.refresh_lock:
+            if not self.access_token or self.is_token_expired():
+                await self.refresh_access_token()
+
+    async def get_messages(self, folder_id: str = 'inbox', top: int = 10, select: Optional[List[str]] = None,
+                           body: str = 'text', filter: Optional[str] = None, search: Optional[str] = None,
+                           orderby: Optional[str] = 'receivedDateTime DESC') -> List[Dict]:
+        """Get messages from specified folder
+
+        Args:
+            folder_id: Folder ID, defaults to 'inbox'
+            top: Number of messages to retrieve
+            select: Message fields to return, defaults to subject, receivedDateTime and from
+            body: Body to include: 'none', 'preview' (bodyPreview), 'text' or 'html'
+            filter: Optional OData $filter expression
+            search: Optional $search query, results then come in relevance order
+            orderby: $orderby expression, None for server order
+        """
+        page_size = min(top, mail_api.MAX_PAGE_SIZE)
+        messages = self.iter_messages(folder_id, page_size=page_size, limit=top, select=select, body=body,
+                                      filter=filter, search=search, orderby=orderby)
+        return [message async for message in messages]
+
+    async def iter_messages(self, folder_id: str = 'inbox', page_size: int = 50, limit: Optional[int] = None,
+                            select: Optional[List[str]] = None, body: str = 'text', filter: Optional[str] = None,
+                            search: Optional[str] = None,
+                            orderby: Optional[str] = 'receivedDateTime DESC') -> AsyncIterator[Dict]:
+        """Iterate over messages in specified folder, newest first, following @odata.nextLink
+
+        Projection and filtering arguments are the same as for get_messages.
+
+        Args:
+            folder_id: Folder ID, defaults to 'inbox'
+            page_size: Number of messages requested per page, at most 1000
+            limit: Maximum number of messages to yield, defaults to all
+        """
+        if limit is not None and limit <= 0:
+            return
+
+        url = f'{mail_api.GRAPH_API_ENDPOINT}/me/mailFolders/{folder_id}/messages'
+        query_params, prefer = build_message_query(select, body, filter, search, orderby)
+        query_params['$top'] = min(page_size, mail_api.MAX_PAGE_SIZE)
+
+        count = 0
+        while url:
+            page = await self._get_page(url, query_params, prefer=prefer)
+            for message in page.get('value', []):
+                yield message
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            url = page.get('@odata.nextLink')
+            query_params = None
+
+    async def get_message(self, message_id: str, select: Optional[List[str]] = None, body: str = 'text') -> Dict:
+        """Get a single message, e.g. to load the body of a message listed with body='none'"""
+        query_params, prefer = build_message_query(select, body, orderby=None)
+        return await self._get_page(f'{mail_api.GRAPH_API_ENDPOINT}/me/messages/{message_id}',
+                                    query_params, prefer=prefer)
+
+    async def _get_page(self, url: str, query_params: Optional[Dict] = None, retry_auth: bool = True,
+                        prefer: Optional[str] = None) -> Dict:
+        """Get one page of a Graph collection, or a single resource"""
+        await self.ensure_token_valid()
+
+        headers = {
+            'Authorization': f'Bearer {self.access_token}',
+            'Accept': 'application/json'
+        }
+        if prefer:
+            headers['Prefer'] = prefer
+
+        try:
+            response = await self._request('GET', url, headers=headers, params=query_params)
+            if response.status == 401 and retry_auth:
+                await self.refresh_access_token()
+                return await self._get_page(url, query_params, retry_auth=False, prefer=prefer)
+            response.raise_for_status()
+            return await response.json()
+        except aiohttp.ClientError as e:
+            logger.error(f"Failed to get messages: {e}")
+            raise
+
+    async def get_junk_messages(self, top: int = 10) -> List[Dict]:
+        """Get messages from junk email folder"""
+        return await self.get_messages(folder_id='junkemail', top=top)
+
+    async def get_folders_messages(self, folder_ids: List[str], top: int = 10) -> Dict[str, List[Dict]]:
+        """Get messages from many folders concurrently
+
+        Returns:
+            Dict mapping each folder ID to its messages
+        """
+        results = await asyncio.gather(*(self.get_messages(folder_id, top) for folder_id in folder_ids))
+        return dict(zip(folder_ids, results))
+
+    async def send_email(self, to_recipients: List[str], subject: str, content: str,
+                         is_html: bool = False, retry_auth: bool = True) -> bool:
+        """Send email
+
+        Args:
+            to_recipients: List of recipient email addresses
+            subject: Email subject
+            content: Email content
+            is_html: Whether content is HTML format, defaults to False
+
+        Returns:
+            bool: Whether sending was successful
+        """
+        await self.ensure_token_valid()
+
+        headers = {
+            'Authorization': f'Bearer {self.access_token}',
+            'Content-Type': 'application/json'
+        }
+
+        email_msg = build_email_message(to_recipients, subject, content, is_html)
+
+        try:
+            response = await self._request(
+                'POST',
+                f'{mail_api.GRAPH_API_ENDPOINT}/me/sendMail',
+                headers=headers,
+                json=email_msg
+            )
+            if response.status == 401 and retry_auth:
+                await self.refresh_access_token()
+                return await self.send_email(to_recipients, subject, content, is_html, retry_auth=False)
+            response.raise_for_status()
+            logger.info(f"Email successfully sent to {', '.join(to_recipients)}")
+            return True
+        except aiohttp.ClientError as e:
+            logger.error(f"Failed to send email: {e}")
+            raise
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Attachments
+Builds inline file attachments and uploads large files through Graph upload
+sessions in resumable chunks, so file size does not affect memory use
+"""
+
+import base64
+import logging
+import mimetypes
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from settings import lazy_import
+
+requests = lazy_import('requests')
+
+logger = logging.getLogger(__name__)
+
+# Graph rejects request bodies over about 4 MB; larger files need an upload session
+LARGE_ATTACHMENT_SIZE = 3 * 1024 * 1024
+# Upload chunks must be a multiple of 320 KiB
+UPLOAD_CHUNK_SIZE = 10 * 320 * 1024
+DOWNLOAD_CHUNK_SIZE = 65536
+# Listing fields; contentBytes is left out so listings stay small
+ATTACHMENT_SELECT = ('id', 'name', 'contentType', 'size', 'isInline')
+
+
+def guess_content_type(path: str) -> str:
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def file_attachment(path: str, name: Optional[str] = None, content_type: Optional[str] = None) -> Dict:
+    """Build an inline fileAttachment resource; only meant for files up to LARGE_ATTACHMENT_SIZE"""
+    with open(path, 'rb') as f:
+        content = base64.b64encode(f.read()).decode('ascii')
+    return {
+        '@odata.type': '#microsoft.graph.fileAttachment',
+        'name': name or os.path.basename(path),
+        'contentType': content_type or guess_content_type(path),
+        'contentBytes': content
+    }
+
+
+def split_attachments(paths: List[str]) -> Tuple[List[str], List[str]]:
+    """Split files into those sent inline with the message and those added separately
+
+    Returns:
+        Tuple of (inline paths, separate paths). Files over LARGE_ATTACHMENT_SIZE
+        are always separate; small files are too when together they would
+        not fit in one request.
+    """
+    small = [path for path in paths if os.path.getsize(path) <= LARGE_ATTACHMENT_SIZE]
+    large = [path for path in paths if os.path.getsize(path) > LARGE_ATTACHMENT_SIZE]
+    # base64 grows content by a third
+    if sum(os.path.getsize(path) for path in small) * 4 // 3 > LARGE_ATTACHMENT_SIZE:
+        return [], list(paths)
+    return small, large
+
+
+def parse_next_offset(ranges: Optional[List[str]], size: int) -> int:
+    """Get the first missing byte from an upload session's nextExpectedRanges"""
+    if not ranges:
+        return size
+    return int(ranges[0].split('-')[0])
+
+
+class UploadSession:
+    """Resumable upload of one file to a Graph upload session
+
+    The upload URL is pre-authenticated, so chunks are sent without the
+    access token. A failed chunk is followed by a status query and the
+    upload continues from the first byte the server is missing; a session
+    saved by `upload_url` can also be resumed later by another client.
+
+    Args:
+        client: mail_api.EmailClient whose session, proxies and retry policy are used
+        upload_url: uploadUrl returned by createUploadSession
+        path: File to upload
+        chunk_size: Bytes per PUT, a multiple of 320 KiB
+    """
+
+    def __init__(self, client, upload_url: str, path: str, chunk_size: int = UPLOAD_CHUNK_SIZE):
+        if chunk_size % (320 * 1024):
+            raise ValueError('chunk_size must be a multiple of 320 KiB')
+        self.client = client
+        self.upload_url = upload_url
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.chunk_size = chunk_size
+        self.offset = 0
+
+    def status(self) -> int:
+        """Ask the server how much it has received and move `offset` there"""
+        response = self.client._request('GET', self.upload_url)
+        response.raise_for_status()
+        self.offset = parse_next_offset(response.json().get('nextExpectedRanges'), self.size)
+        return self.offset
+
+    def upload(self) -> None:
+        """Upload the remaining chunks, reading one chunk of the file at a time"""
+        policy = self.client.retry_policy
+        attempt = 0
+        with open(self.path, 'rb') as f:
+            while self.offset < self.size:
+                f.seek(self.offset)
+                chunk = f.read(self.chunk_size)
+                end = self.offset + len(chunk) - 1
+                headers = {
+                    'Content-Type': 'application/octet-stream',
+                    'Content-Range': f'bytes {self.offset}-{end}/{self.size}'
+                }
+                try:
+                    response = self.client._request('PUT', self.upload_url, headers=headers, data=chunk)
+                    response.raise_for_status()
+                except requests.RequestException as e:
+                    if attempt >= policy.max_retries:
+                        logger.error(f"Upload of {self.path} failed at byte {self.offset}: {e}")
+                        raise
+                    delay = policy.delay(attempt)
+                    logger.warning(f"Upload chunk at byte {self.offset} failed ({e}), resuming in {delay:.1f}s")
+                    time.sleep(delay)
+                    attempt += 1
+                    self.status()
+                    continue
+                attempt = 0
+                if response.status_code == 201 or not response.content:
+                    self.offset = end + 1
+                else:
+                    self.offset = parse_next_offset(response.json().get('nextExpectedRanges'), self.size)
+        logger.info(f"Uploaded {self.path} ({self.size} bytes)")
+
+    def resume(self) -> None:
+        """Continue an interrupted upload from where the server stopped receiving"""
+        self.status()
+        self.upload()
+
+    def cancel(self) -> None:
+        """Delete the upload session"""
+        self.client._request('DELETE', self.upload_url).raise_for_status()
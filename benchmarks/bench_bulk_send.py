@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Bulk send load test
+Queues messages for several accounts in an outbox and drains it with
+BulkSender against the local stub sendMail endpoint
+
+Run from the repository root:
+    python benchmarks/bench_bulk_send.py --messages 5000 --accounts 4 --workers 16
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_session import CONFIG_TEMPLATE
+from stub_graph import StubGraphServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=5000, help='Messages to send')
+    parser.add_argument('--accounts', type=int, default=4, help='Sending accounts')
+    parser.add_argument('--workers', type=int, default=16, help='Worker threads')
+    parser.add_argument('--per-account', type=int, default=4, help='Concurrent sends per account')
+    parser.add_argument('--throttle', type=int, default=20, help='Number of 429 responses to inject')
+    args = parser.parse_args()
+
+    with StubGraphServer() as server, tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        accounts = [f'account{i}' for i in range(args.accounts)]
+        with open('config.txt', 'w', encoding='utf-8') as f:
+            f.write(CONFIG_TEMPLATE)
+            f.write(f'\n[http]\npool_maxsize = {args.workers}\n')
+            for account in accounts:
+                f.write(f'\n[tokens:{account}]\nrefresh_token = benchmark\naccess_token = benchmark\n'
+                        f'expires_at = 2999-01-01 00:00:00\n')
+
+        import mail_api
+        from bulk_send import BulkSender, Outbox
+        mail_api.GRAPH_API_ENDPOINT = server.graph_endpoint
+        mail_api.TOKEN_URL = server.token_url
+
+        with Outbox(os.path.join(workdir, 'outbox.db')) as outbox:
+            start = time.perf_counter()
+            outbox.enqueue_many(
+                {'to_recipients': [f'user{i}@example.com'], 'subject': f'Bulk {i}',
+                 'content': 'Hello from the bulk sender.', 'account': accounts[i % len(accounts)],
+                 'key': f'bulk-{i}'}
+                for i in range(args.messages)
+            )
+            enqueue_time = time.perf_counter() - start
+
+            server.server.fail_next.extend([(429, 0)] * args.throttle)
+            with BulkSender(outbox, workers=args.workers, per_account=args.per_account,
+                            on_progress=lambda progress: None) as sender:
+                for client in (sender.client(account) for account in accounts):
+                    client.retry_policy.backoff_base = 0.01
+                summary = sender.run()
+                retries = sender.retry_metrics.snapshot().get('retries', 0)
+
+    print(f"enqueued:       {args.messages} in {enqueue_time:.2f}s")
+    print(f"sent:           {summary['sent']}")
+    print(f"failed:         {summary['failed'] + summary['unknown']}")
+    print(f"request retries:{retries:6d}")
+    print(f"elapsed:        {summary['elapsed']:.2f}s")
+    print(f"throughput:     {summary['per_minute']:.0f} messages/min")
+    print(f"sendMail calls: {server.request_counts['me/sendMail']}")
+
+
+if __name__ == '__main__':
+    main()
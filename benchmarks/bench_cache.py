@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Content cache benchmark
+Times get_message without a cache, on a cold cache, revalidating with
+If-None-Match and hitting by changeKey, using the local stub Graph server
+
+Run from the repository root:
+    python benchmarks/bench_cache.py --messages 200 --body-size 100000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_graph import StubGraphServer
+from bench_session import CONFIG_TEMPLATE
+
+
+def fetch_all(client, count: int, with_change_key: bool) -> float:
+    start = time.perf_counter()
+    for index in range(count):
+        change_key = f'ck-{index}' if with_change_key else None
+        client.get_message(f'msg-{index}', change_key=change_key)
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=200, help='Messages fetched per run')
+    parser.add_argument('--body-size', type=int, default=100000, help='Characters per message body')
+    args = parser.parse_args()
+
+    with StubGraphServer(message_count=args.messages, body_size=args.body_size) as server, \
+            tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        with open('config.txt', 'w', encoding='utf-8') as f:
+            f.write(CONFIG_TEMPLATE)
+
+        import mail_api
+        from content_cache import ContentCache
+        mail_api.GRAPH_API_ENDPOINT = server.graph_endpoint
+        mail_api.TOKEN_URL = server.token_url
+
+        with mail_api.EmailClient() as client:
+            uncached = fetch_all(client, args.messages, False)
+        with ContentCache(os.path.join(workdir, 'cache')) as cache, mail_api.EmailClient(cache=cache) as client:
+            cold = fetch_all(client, args.messages, False)
+            revalidated = fetch_all(client, args.messages, False)
+            hit = fetch_all(client, args.messages, True)
+            cached_bytes = cache.total_bytes
+
+    print(f"no cache:                {uncached:10.1f} msg/s")
+    print(f"cold cache:              {cold:10.1f} msg/s")
+    print(f"revalidated (304):       {revalidated:10.1f} msg/s")
+    print(f"changeKey hit:           {hit:10.1f} msg/s")
+    print(f"cache size:              {cached_bytes / 1024 / 1024:10.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Import time benchmark
+Times `import mail_api` in fresh interpreters started in an empty directory
+and fails if it is over budget or has side effects
+
+Importing must not open files in the working directory (config.txt is read
+by the first client), configure logging, or load requests and the other
+heavy modules listed in HEAVY_MODULES.
+
+Run from the repository root:
+    python benchmarks/bench_import.py --runs 20 --budget-ms 30
+"""
+
+import argparse
+import compileall
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must stay unloaded (or lazy) after the import
+HEAVY_MODULES = ('requests', 'urllib3', 'ssl', 'http.server', 'winreg', 'aiohttp')
+
+CHILD = r'''
+import json, logging, os, sys, time
+cwd = os.getcwd()
+opened = []
+
+def audit(event, args):
+    if event == 'open' and isinstance(args[0], str) and os.path.abspath(args[0]).startswith(cwd):
+        opened.append(args[0])
+
+sys.addaudithook(audit)
+start = time.perf_counter()
+import mail_api
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    'ms': elapsed * 1000,
+    'opened': opened,
+    'log_handlers': len(logging.getLogger().handlers),
+    'loaded': [name for name in HEAVY_MODULES
+               if name in sys.modules and type(sys.modules[name]).__name__ != '_LazyModule'],
+}))
+'''
+
+
+def measure(workdir: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    code = f'HEAVY_MODULES = {HEAVY_MODULES!r}\n{CHILD}'
+    result = subprocess.run([sys.executable, '-c', code], cwd=workdir, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        error = result.stderr.decode('utf-8', 'replace').strip().splitlines()
+        return {'error': error[-1] if error else f'exit status {result.returncode}'}
+    return json.loads(result.stdout.decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=20, help='Fresh interpreters to time')
+    parser.add_argument('--budget-ms', type=float, default=30.0, help='Largest acceptable median import time')
+    args = parser.parse_args()
+
+    # Time imports from cached bytecode, as installed packages would be
+    compileall.compile_dir(REPO_DIR, maxlevels=0, quiet=1)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = [measure(workdir) for _ in range(args.runs)]
+
+    failed = [result['error'] for result in results if 'error' in result]
+    if failed:
+        print(f"FAIL: import raised {failed[0]}")
+        sys.exit(1)
+
+    times = sorted(result['ms'] for result in results)
+    median = statistics.median(times)
+    problems = set()
+    for result in results:
+        problems.update(f'opened {path}' for path in result['opened'])
+        problems.update(f'loaded {name}' for name in result['loaded'])
+        if result['log_handlers']:
+            problems.add('configured root logging handlers')
+    if median > args.budget_ms:
+        problems.add(f'median {median:.1f} ms is over the {args.budget_ms:.1f} ms budget')
+
+    print(f"runs:    {args.runs}")
+    print(f"median:  {median:.2f} ms")
+    print(f"min/max: {times[0]:.2f} / {times[-1]:.2f} ms")
+    for problem in sorted(problems):
+        print(f"FAIL: {problem}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Message memory benchmark
+Compares memory held by a 50k-message listing kept as raw Graph dicts
+(json.loads of the response) with the same listing kept as Message objects
+built by the streaming parser
+
+Run from the repository root:
+    python benchmarks/bench_memory.py --messages 50000
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mail_message import JsonPageStream, Message
+from stub_graph import make_message
+
+CHUNK_SIZE = 65536
+
+
+def build_fixture(count: int, body_size: int) -> bytes:
+    """Serialize a Graph page holding `count` messages"""
+    page = {
+        '@odata.context': 'https://graph.microsoft.com/v1.0/$metadata#users/messages',
+        'value': [make_message(i, body_size) for i in range(count)]
+    }
+    return json.dumps(page).encode('utf-8')
+
+
+def chunks(data: bytes):
+    for start in range(0, len(data), CHUNK_SIZE):
+        yield data[start:start + CHUNK_SIZE]
+
+
+def measure(load) -> tuple:
+    """Run `load` and return (items, retained bytes, peak bytes)"""
+    gc.collect()
+    tracemalloc.start()
+    result = load()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(result), retained, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=50000, help='Messages in the fixture')
+    parser.add_argument('--body-size', type=int, default=512, help='Characters per message body')
+    args = parser.parse_args()
+
+    data = build_fixture(args.messages, args.body_size)
+    scenarios = [
+        ('raw dict list', lambda: json.loads(data)['value']),
+        ('streamed Message list', lambda: [Message.from_graph(item) for item in JsonPageStream(chunks(data)).items()]),
+    ]
+
+    print(f"fixture: {args.messages} messages, {len(data) / 1024 / 1024:.1f} MiB of JSON")
+    results = []
+    for name, load in scenarios:
+        count, retained, peak = measure(load)
+        results.append(retained)
+        print(f"{name:24} retained {retained / 1024 / 1024:8.1f} MiB   peak {peak / 1024 / 1024:8.1f} MiB")
+    print(f"reduction: {1 - results[1] / results[0]:.0%} less retained memory")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Pagination memory benchmark
+Walks a large stub folder with EmailClient.iter_messages and reports peak
+Python heap usage, which should stay flat regardless of folder size
+
+Run from the repository root:
+    python benchmarks/bench_pagination.py --messages 100000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mail_api
+from bench_session import CONFIG_TEMPLATE
+from stub_graph import StubGraphServer
+
+
+def walk(client: mail_api.EmailClient, page_size: int) -> tuple:
+    """Iterate the whole inbox, returning (message count, peak bytes, seconds)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = sum(1 for _ in client.iter_messages(page_size=page_size))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count, peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=100000, help='Messages in the stub folder')
+    parser.add_argument('--page-size', type=int, default=1000, help='Messages per page')
+    args = parser.parse_args()
+
+    with StubGraphServer(message_count=args.messages) as server, tempfile.TemporaryDirectory() as workdir:
+        mail_api.GRAPH_API_ENDPOINT = server.graph_endpoint
+        mail_api.TOKEN_URL = server.token_url
+        os.chdir(workdir)
+        with open('config.txt', 'w', encoding='utf-8') as f:
+            f.write(CONFIG_TEMPLATE)
+
+        with mail_api.EmailClient() as client:
+            count, peak, elapsed = walk(client, args.page_size)
+
+    if count != args.messages:
+        sys.exit(f"expected {args.messages} messages, got {count}")
+    print(f"messages:  {count}")
+    print(f"peak heap: {peak / 1024 / 1024:.1f} MiB")
+    print(f"elapsed:   {elapsed:.2f} s ({count / elapsed:.0f} msg/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Payload size benchmark
+Reports response bytes transferred per 1,000 messages listed with each body
+mode, and for a two-phase fetch that lists headers and then loads a few bodies
+
+Run from the repository root:
+    python benchmarks/bench_payload.py --body-size 4096
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_session import CONFIG_TEMPLATE
+from stub_graph import StubGraphServer
+
+MESSAGES = 1000
+
+
+class ByteCounter:
+    """requests response hook summing response body sizes"""
+
+    def __init__(self):
+        self.total = 0
+
+    def __call__(self, response, *args, **kwargs):
+        self.total += len(response.content)
+
+    def take(self) -> int:
+        total, self.total = self.total, 0
+        return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--body-size', type=int, default=4096, help='Characters per message body')
+    parser.add_argument('--bodies', type=int, default=50, help='Bodies loaded in the two-phase fetch')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        with open('config.txt', 'w', encoding='utf-8') as f:
+            f.write(CONFIG_TEMPLATE)
+
+        import mail_api
+        from graph_batch import GraphBatch
+
+        with StubGraphServer(message_count=MESSAGES, body_size=args.body_size) as server:
+            mail_api.GRAPH_API_ENDPOINT = server.graph_endpoint
+            mail_api.TOKEN_URL = server.token_url
+            counter = ByteCounter()
+            with mail_api.EmailClient() as client:
+                client.session.hooks['response'].append(counter)
+
+                results = []
+                for body in mail_api.BODY_MODES:
+                    client.get_messages(top=MESSAGES, body=body)
+                    results.append((f'list, body={body}', counter.take()))
+
+                headers = client.get_messages(top=MESSAGES, body='none')
+                with GraphBatch(client) as batch:
+                    for message in headers[:args.bodies]:
+                        batch.get_message(message['id'], select=[], body='text')
+                results.append((f'two-phase, {args.bodies} bodies', counter.take()))
+
+    baseline = results[2][1]
+    for name, size in results:
+        print(f"{name:28} {size / 1024:10.1f} KiB  {size / baseline:6.1%} of body=text")
+
+
+if __name__ == '__main__':
+    main()
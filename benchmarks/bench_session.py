@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Connection pooling benchmark
+Compares requests/sec of one-off requests.get calls against EmailClient's
+pooled keep-alive session, using the local stub Graph server
+
+Run from the repository root:
+    python benchmarks/bench_session.py --requests 500
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mail_api
+from stub_graph import StubGraphServer
+
+CONFIG_TEMPLATE = """[microsoft]
+client_id = benchmark
+redirect_uri = http://localhost:8000
+
+[tokens]
+refresh_token = benchmark
+access_token = benchmark
+expires_at = 2999-01-01 00:00:00
+
+[retry]
+requests_per_second = 0
+"""
+
+
+def bench_unpooled(url: str, count: int) -> float:
+    """One new connection per call, as EmailClient did before pooling"""
+    start = time.perf_counter()
+    for _ in range(count):
+        response = requests.get(url, params={'$top': 1})
+        response.raise_for_status()
+    return count / (time.perf_counter() - start)
+
+
+def bench_pooled(client: mail_api.EmailClient, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        client.get_messages(top=1)
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=500, help='Requests per run')
+    args = parser.parse_args()
+
+    with StubGraphServer() as server, tempfile.TemporaryDirectory() as workdir:
+        mail_api.GRAPH_API_ENDPOINT = server.graph_endpoint
+        mail_api.TOKEN_URL = server.token_url
+        os.chdir(workdir)
+        with open('config.txt', 'w', encoding='utf-8') as f:
+            f.write(CONFIG_TEMPLATE)
+
+        url = f'{server.graph_endpoint}/me/mailFolders/inbox/messages'
+        before = bench_unpooled(url, args.requests)
+        with mail_api.EmailClient() as client:
+            after = bench_pooled(client, args.requests)
+
+    print(f"unpooled requests.get: {before:8.1f} req/s")
+    print(f"pooled EmailClient:    {after:8.1f} req/s")
+    print(f"speedup:               {after / before:8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite
+Runs EmailClient scenarios against the local stub Graph and token server and
+reports throughput, latency percentiles and peak RSS as JSON
+
+Each scenario runs in a fresh interpreter, so peak RSS belongs to that
+scenario's client alone; the stub server stays in the parent process.
+
+Run from the repository root:
+    python benchmarks/bench_suite.py --output results.json
+    python benchmarks/bench_suite.py --latency-ms 20 --compare results.json
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_session import CONFIG_TEMPLATE
+from stub_graph import StubGraphServer
+
+# Scenario name -> stub server options
+SCENARIOS = {
+    'get_messages': {},
+    'paginate': {'message_count': 1000},
+    'send_email': {},
+    'token_refresh': {},
+    'batch': {},
+    'throttled': {'throttle_every': 5},
+    'large_bodies': {'message_count': 200, 'body_size': 100000},
+}
+DEFAULT_ITERATIONS = {
+    'get_messages': 200, 'paginate': 20, 'send_email': 200, 'token_refresh': 200,
+    'batch': 50, 'throttled': 200, 'large_bodies': 10,
+}
+# Metrics where a lower value is better, for --compare
+LOWER_IS_BETTER = ('p50_ms', 'p99_ms', 'peak_rss_mb')
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process, None where the resource module is missing"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def timed(iterations: int, operation: Callable[[], int], warmup: int = 5) -> Tuple[List[float], int, float]:
+    """Run `operation` repeatedly, returning (latencies, items processed, elapsed seconds)"""
+    for _ in range(min(warmup, iterations)):
+        operation()
+    latencies = []
+    items = 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        op_start = time.perf_counter()
+        items += operation()
+        latencies.append(time.perf_counter() - op_start)
+    return latencies, items, time.perf_counter() - start
+
+
+def run_scenario(name: str, iterations: int) -> Dict:
+    """Run one scenario in this process against the stub at BENCH_BASE_URL"""
+    import mail_api
+    from graph_batch import GraphBatch
+    mail_api.GRAPH_API_ENDPOINT = os.environ['BENCH_BASE_URL'] + '/v1.0'
+    mail_api.TOKEN_URL = os.environ['BENCH_BASE_URL'] + '/token'
+
+    client = mail_api.EmailClient()
+    client.retry_policy.backoff_base = 0.001
+
+    def get_messages():
+        return len(client.get_messages(top=50))
+
+    def paginate():
+        return sum(1 for _ in client.iter_messages(page_size=100))
+
+    def send_email():
+        client.send_email(['bench@example.com'], 'Benchmark', 'Benchmark body')
+        return 1
+
+    def token_refresh():
+        client.refresh_access_token()
+        return 1
+
+    def batch():
+        with GraphBatch(client) as graph_batch:
+            futures = [graph_batch.get_message(f'msg-{i}') for i in range(20)]
+        return sum(1 for future in futures if future.result())
+
+    def large_bodies():
+        return sum(1 for message in client.stream_messages(page_size=50, body='text') if message.body)
+
+    operations = {
+        'get_messages': get_messages, 'paginate': paginate, 'send_email': send_email,
+        'token_refresh': token_refresh, 'batch': batch, 'throttled': get_messages, 'large_bodies': large_bodies,
+    }
+    latencies, items, elapsed = timed(iterations, operations[name])
+    client.close()
+    latencies.sort()
+    counters = client.retry_metrics.snapshot()
+    peak = peak_rss_mb()
+    return {
+        'operations': iterations,
+        'items': items,
+        'elapsed_s': round(elapsed, 4),
+        'ops_per_s': round(iterations / elapsed, 2),
+        'items_per_s': round(items / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+        'requests': counters.get('requests', 0),
+        'retries': counters.get('retries', 0),
+        'peak_rss_mb': round(peak, 1) if peak is not None else None,
+    }
+
+
+def spawn_scenario(name: str, iterations: int, latency: float) -> Dict:
+    """Start a stub for the scenario and run the scenario in a child interpreter"""
+    with StubGraphServer(latency=latency, **SCENARIOS[name]) as server, \
+            tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, 'config.txt'), 'w', encoding='utf-8') as f:
+            f.write(CONFIG_TEMPLATE)
+        env = dict(os.environ, BENCH_BASE_URL=server.base_url)
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run-scenario', name, '--iterations', str(iterations)],
+            cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True
+        )
+    return json.loads(result.stdout.decode('utf-8').strip().splitlines()[-1])
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: Dict, baseline: Dict) -> None:
+    """Print relative changes against a baseline result file"""
+    print(f"{'scenario':<15}{'metric':<13}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, result in current['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        for metric in ('ops_per_s', 'p50_ms', 'p99_ms', 'peak_rss_mb'):
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = change > 0 if metric in LOWER_IS_BETTER else change < 0
+            flag = ' !' if worse and abs(change) >= 10 else ''
+            print(f"{name:<15}{metric:<13}{old:>12}{new:>12}{change:>+9.1f}%{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"Comma-separated scenarios, from: {', '.join(SCENARIOS)}")
+    parser.add_argument('--iterations', type=int, help='Operations per scenario, defaults per scenario')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Latency the stub adds to every response')
+    parser.add_argument('--output', help='Write results JSON to this file instead of stdout')
+    parser.add_argument('--compare', help='Baseline results JSON to compare against')
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        print(json.dumps(run_scenario(args.run_scenario, args.iterations)))
+        return
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'latency_ms': args.latency_ms,
+        'scenarios': {},
+    }
+    for name in names:
+        iterations = args.iterations or DEFAULT_ITERATIONS[name]
+        results['scenarios'][name] = spawn_scenario(name, iterations, args.latency_ms / 1000)
+        print(f"{name}: {results['scenarios'][name]['ops_per_s']} ops/s, "
+              f"p99 {results['scenarios'][name]['p99_ms']} ms", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+"""
+Local Microsoft Graph API stub
+Serves just enough of the Graph and token endpoints to benchmark EmailClient
+without network access
+"""
+
+import hashlib
+import itertools
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+from typing import Optional, Tuple
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+import requests
+
+try:
+    from http.server import ThreadingHTTPServer
+except ImportError:
+    # Python 3.6
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+
+LOREM = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod '
+         'tempor incididunt ut labore et dolore magna aliqua. ')
+
+
+def make_message(index: int, body_size: int = 32) -> dict:
+    """Build a fake Graph message resource with a body of about `body_size` characters"""
+    content = f'Body of stub message {index}. '
+    content += (LOREM * (body_size // len(LOREM) + 1))[:max(0, body_size - len(content))]
+    return {
+        'id': f'msg-{index}',
+        'changeKey': f'ck-{index}',
+        'subject': f'Stub message {index}',
+        'receivedDateTime': '2024-01-01T00:00:00Z',
+        'from': {'emailAddress': {'address': f'sender{index}@example.com'}},
+        'bodyPreview': content[:255],
+        'body': {'contentType': 'text', 'content': content}
+    }
+
+
+def project(message: dict, query: dict, headers) -> dict:
+    """Apply $select and the outlook.body-content-type preference like Graph does"""
+    if 'html' in headers.get('Prefer', '') and 'body' in message:
+        message['body'] = {
+            'contentType': 'html',
+            'content': f"<html><body><p>{message['body']['content']}</p></body></html>"
+        }
+    if '$select' not in query:
+        return message
+    fields = set(query['$select'][0].split(',')) | {'id', '@odata.etag'}
+    return dict((key, value) for key, value in message.items() if key in fields)
+
+
+# folder id -> (displayName, parent folder id or None for top-level folders)
+STUB_FOLDERS = {
+    'inbox': ('Inbox', None),
+    'junkemail': ('Junk Email', None),
+    'archive': ('Archive', None),
+    'sentitems': ('Sent Items', None),
+    'projects': ('Projects', 'inbox'),
+    'receipts': ('Receipts', 'inbox'),
+    'projects-2023': ('2023', 'projects'),
+}
+
+
+class StubContent:
+    """Raw attachment content of `size` bytes, generated while it is written"""
+
+    PATTERN = bytes(range(256)) * 256
+
+    def __init__(self, size: int):
+        self.size = size
+
+    def chunks(self):
+        remaining = self.size
+        while remaining > 0:
+            chunk = self.PATTERN[:remaining]
+            remaining -= len(chunk)
+            yield chunk
+
+
+def not_found(path: str) -> Tuple[int, dict]:
+    return 404, {'error': {'code': 'NotFound', 'message': path}}
+
+
+class StubGraphHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; avoid Nagle/delayed-ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, payload: Optional[dict]) -> None:
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if isinstance(payload, StubContent):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(payload.size))
+            self.end_headers()
+            for chunk in payload.chunks():
+                self.wfile.write(chunk)
+            return
+        retry_after = payload.pop('_retry_after', None) if payload is not None else None
+        etag = payload.pop('_etag', None) if payload is not None else None
+        body = json.dumps(payload).encode('utf-8') if payload is not None and status != 304 else b''
+        self.send_response(status)
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if payload is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/authorize':
+            # Sign the user in at once and redirect back with a code
+            query = parse_qs(url.query)
+            params = {'code': f'code-{next(self.server.ids)}', 'state': query.get('state', [''])[0]}
+            self.send_response(302)
+            self.send_header('Location', f"{query['redirect_uri'][0]}?{urlencode(params)}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_json(*self.route('GET', self.path, self.headers, None))
+
+    def do_POST(self):
+        body = self.read_body()
+        path = urlsplit(self.path).path
+        if path == '/devicecode':
+            device_code = f'device-{next(self.server.ids)}'
+            with self.server.lock:
+                self.server.device_codes[device_code] = self.server.device_code_polls
+            self.send_json(200, {
+                'device_code': device_code,
+                'user_code': device_code.upper(),
+                'verification_uri': f'{self.server.base_url}/devicelogin',
+                'expires_in': 900,
+                'interval': 0,
+                'message': f'To sign in, open {self.server.base_url}/devicelogin and enter {device_code.upper()}'
+            })
+            return
+        if path == '/token':
+            self.server.request_counts['token'] += 1
+            form = parse_qs(body.decode('utf-8'))
+            device_code = form.get('device_code', [None])[0]
+            if device_code is not None:
+                with self.server.lock:
+                    pending = self.server.device_codes.get(device_code, 0)
+                    self.server.device_codes[device_code] = pending - 1
+                if pending > 0:
+                    self.send_json(400, {'error': 'authorization_pending'})
+                    return
+            self.send_json(200, {
+                'access_token': 'stub-access-token',
+                'refresh_token': 'stub-refresh-token',
+                'expires_in': 3600
+            })
+            return
+        payload = json.loads(body) if body else None
+        self.send_json(*self.route('POST', self.path, self.headers, payload))
+
+    def do_PUT(self):
+        self.send_json(*self.route('PUT', self.path, self.headers, self.read_body()))
+
+    def do_PATCH(self):
+        body = self.read_body()
+        self.send_json(*self.route('PATCH', self.path, self.headers, json.loads(body) if body else None))
+
+    def do_DELETE(self):
+        self.send_json(*self.route('DELETE', self.path, self.headers, None))
+
+    def route(self, method: str, path: str, headers, payload) -> Tuple[int, Optional[dict]]:
+        """Dispatch a Graph request, also used for each $batch item"""
+        url = urlsplit(path)
+        parts = url.path.strip('/').split('/')
+        if parts and parts[0] == 'v1.0':
+            parts = parts[1:]
+        self.server.request_counts['/'.join(parts[:2])] += 1
+
+        if method == 'POST' and parts == ['$batch']:
+            return self.run_batch(payload)
+        with self.server.lock:
+            failure = self.server.fail_next.pop(0) if self.server.fail_next else None
+            if failure is None and self.server.throttle_every:
+                self.server.routed += 1
+                if self.server.routed % self.server.throttle_every == 0:
+                    failure = (429, 0)
+        if failure is not None:
+            status, retry_after = failure
+            return status, {'error': {'code': 'TooManyRequests', 'message': 'Stub throttling'},
+                            '_retry_after': retry_after}
+        if method == 'POST' and parts == ['me', 'sendMail']:
+            return 202, None
+        if parts and parts[0] == 'subscriptions':
+            return self.subscription(method, parts[1:], payload)
+        if parts and parts[0] == 'upload':
+            return self.upload(method, parts[1], headers, payload)
+        if method == 'POST' and len(parts) == 4 and parts[:2] == ['me', 'messages'] and parts[3] == 'move':
+            with self.server.lock:
+                self.server.moved.append((parts[2], payload['destinationId']))
+            return 201, {'id': f'{parts[2]}-moved', 'parentFolderId': payload['destinationId']}
+        if parts[:2] == ['me', 'messages'] and (len(parts) == 2 or parts[2].startswith('draft-')):
+            return self.draft(method, parts[2:], payload)
+        if method == 'GET' and len(parts) >= 4 and parts[:2] == ['me', 'messages'] and parts[3] == 'attachments':
+            return self.attachment(parts[4:])
+        if method == 'GET' and len(parts) == 3 and parts[:2] == ['me', 'messages']:
+            index = parts[2].rpartition('-')[2]
+            if not index.isdigit() or int(index) >= self.server.message_count:
+                return not_found(url.path)
+            message = self.make_message(int(index))
+            etag = f'W/"{message["changeKey"]}"'
+            if headers.get('If-None-Match') == etag:
+                return 304, {'_etag': etag}
+            message['@odata.etag'] = etag
+            message = project(message, parse_qs(url.query), headers)
+            message['_etag'] = etag
+            return 200, message
+        if method == 'GET' and parts == ['me', 'mailFolders']:
+            return self.folder_page(None, url)
+        if method == 'GET' and len(parts) == 4 and parts[:2] == ['me', 'mailFolders'] and parts[3] == 'childFolders':
+            return self.folder_page(parts[2], url)
+        # me/mailFolders/{folder_id}/messages[/delta]
+        if method == 'GET' and len(parts) >= 4 and parts[:2] == ['me', 'mailFolders'] and parts[3] == 'messages':
+            if len(parts) == 4:
+                return self.message_page(url, headers)
+            if parts[4:] == ['delta']:
+                return self.delta_page(url, headers)
+        return not_found(url.path)
+
+    def run_batch(self, payload: dict) -> Tuple[int, dict]:
+        """Execute JSON $batch items in order and collect their responses"""
+        items = payload.get('requests', [])
+        if len(items) > 20:
+            return 400, {'error': {'code': 'BadRequest', 'message': 'Too many requests in batch'}}
+        responses = []
+        for item in items:
+            status, body = self.route(item['method'], item['url'], item.get('headers', {}), item.get('body'))
+            response = {'id': item['id'], 'status': status, 'headers': {}}
+            if body is not None and '_retry_after' in body:
+                response['headers']['Retry-After'] = str(body.pop('_retry_after'))
+            if body is not None and '_etag' in body:
+                response['headers']['ETag'] = body.pop('_etag')
+            if body is not None:
+                response['body'] = body
+            responses.append(response)
+        return 200, {'responses': responses}
+
+    def attachment(self, parts) -> Tuple[int, object]:
+        """List the server.attachment_count attachments of a message, or serve one's $value"""
+        size = self.server.attachment_size
+        if not parts:
+            return 200, {'value': [
+                {'id': f'att-{i}', 'name': f'file{i}.bin', 'contentType': 'application/octet-stream',
+                 'size': size, 'isInline': False}
+                for i in range(self.server.attachment_count)
+            ]}
+        if len(parts) == 2 and parts[1] == '$value':
+            return 200, StubContent(size)
+        return not_found('/'.join(parts))
+
+    def draft(self, method: str, parts, payload) -> Tuple[int, Optional[dict]]:
+        """Create, extend, send and delete draft messages"""
+        drafts = self.server.drafts
+        if method == 'POST' and not parts:
+            with self.server.lock:
+                draft_id = f'draft-{next(self.server.ids)}'
+                drafts[draft_id] = {'message': payload, 'attachments': list(payload.get('attachments', []))}
+            return 201, {'id': draft_id}
+        draft = drafts.get(parts[0])
+        if draft is None:
+            return not_found(parts[0])
+        if method == 'DELETE' and len(parts) == 1:
+            del drafts[parts[0]]
+            return 204, None
+        if method == 'POST' and parts[1:] == ['send']:
+            self.server.sent.append(drafts.pop(parts[0]))
+            return 202, None
+        if method == 'POST' and parts[1:] == ['attachments']:
+            draft['attachments'].append(payload)
+            return 201, payload
+        if method == 'POST' and parts[1:] == ['attachments', 'createUploadSession']:
+            item = payload['AttachmentItem']
+            with self.server.lock:
+                upload_id = str(next(self.server.ids))
+                self.server.uploads[upload_id] = {
+                    'item': item, 'received': 0, 'sha256': hashlib.sha256(), 'draft': draft
+                }
+            return 201, {'uploadUrl': f'{self.server.base_url}/upload/{upload_id}',
+                         'nextExpectedRanges': ['0-']}
+        return not_found('/'.join(parts))
+
+    def subscription(self, method: str, parts, payload) -> Tuple[int, Optional[dict]]:
+        """Create, renew and delete subscriptions, validating notification URLs like Graph"""
+        subscriptions = self.server.subscriptions
+        if method == 'POST' and not parts:
+            token = f'validation-{next(self.server.ids)}'
+            try:
+                response = requests.post(payload['notificationUrl'], params={'validationToken': token}, timeout=10)
+                valid = response.status_code == 200 and response.text == token
+            except requests.RequestException:
+                valid = False
+            if not valid:
+                return 400, {'error': {'code': 'ValidationError', 'message': 'Notification URL validation failed'}}
+            subscription = dict(payload, id=f'sub-{next(self.server.ids)}')
+            subscriptions[subscription['id']] = subscription
+            return 201, dict(subscription)
+        if not parts or parts[0] not in subscriptions:
+            return not_found('/'.join(parts))
+        if method == 'PATCH':
+            subscriptions[parts[0]].update(payload)
+            return 200, dict(subscriptions[parts[0]])
+        if method == 'DELETE':
+            del subscriptions[parts[0]]
+            return 204, None
+        return not_found('/'.join(parts))
+
+    def upload(self, method: str, upload_id: str, headers, payload) -> Tuple[int, Optional[dict]]:
+        """Accept upload session chunks in order, reporting nextExpectedRanges"""
+        upload = self.server.uploads.get(upload_id)
+        if upload is None:
+            return not_found(upload_id)
+        size = upload['item']['size']
+        if method == 'GET':
+            return 200, {'nextExpectedRanges': [f"{upload['received']}-{size - 1}"]}
+        if method == 'DELETE':
+            del self.server.uploads[upload_id]
+            return 204, None
+        byte_range, _, total = headers['Content-Range'].partition(' ')[2].partition('/')
+        start, _, end = byte_range.partition('-')
+        if int(start) != upload['received'] or int(end) - int(start) + 1 != len(payload) or int(total) != size:
+            return 416, {'error': {'code': 'InvalidRange', 'message': headers['Content-Range']}}
+        upload['sha256'].update(payload)
+        upload['received'] += len(payload)
+        if upload['received'] < size:
+            return 200, {'nextExpectedRanges': [f"{upload['received']}-{size - 1}"]}
+        del self.server.uploads[upload_id]
+        item = dict(upload['item'], sha256=upload['sha256'].hexdigest())
+        upload['draft']['attachments'].append(item)
+        return 201, None
+
+    def make_message(self, index: int, folder_id: str = 'inbox') -> dict:
+        """Build message `index`; messages outside the inbox get ids prefixed with their folder"""
+        message = make_message(index, self.server.body_size)
+        if folder_id != 'inbox':
+            message['id'] = f"{folder_id}-{message['id']}"
+        return message
+
+    def folder_page(self, parent_id: Optional[str], url) -> Tuple[int, dict]:
+        """List the child folders of `parent_id` from server.folders, two per page"""
+        folders = self.server.folders
+        children = [
+            {'id': folder_id, 'displayName': name, 'parentFolderId': parent or 'root',
+             'childFolderCount': sum(1 for _, p in folders.values() if p == folder_id),
+             'totalItemCount': self.server.message_count}
+            for folder_id, (name, parent) in folders.items() if parent == parent_id
+        ]
+        query = parse_qs(url.query)
+        skip = int(query.get('$skip', ['0'])[0])
+        page = {'value': children[skip:skip + 2]}
+        if skip + 2 < len(children):
+            page['@odata.nextLink'] = f'{self.server.base_url}{url.path}?$skip={skip + 2}'
+        return 200, page
+
+    def message_page(self, url, headers) -> Tuple[int, dict]:
+        """Serve one page of the folder, with @odata.nextLink while more remain"""
+        folder_id = url.path.strip('/').split('/')[3]
+        query = parse_qs(url.query)
+        top = int(query.get('$top', ['10'])[0])
+        skip = int(query.get('$skip', ['0'])[0])
+        end = min(skip + top, self.server.message_count)
+        page = {'value': [project(self.make_message(i, folder_id), query, headers) for i in range(skip, end)]}
+        if end < self.server.message_count:
+            next_query = dict((key, values[0]) for key, values in query.items())
+            next_query['$skip'] = str(end)
+            page['@odata.nextLink'] = f'{self.server.base_url}{url.path}?{urlencode(next_query)}'
+        return 200, page
+
+    def delta_page(self, url, headers) -> Tuple[int, dict]:
+        """Serve messages/delta: the full folder first, then only server.delta_changes"""
+        query = parse_qs(url.query)
+        delta_url = f'{self.server.base_url}{url.path}'
+        changes = self.server.delta_changes
+        if '$deltatoken' in query:
+            start = int(query['$deltatoken'][0])
+            return 200, {'value': changes[start:], '@odata.deltaLink': f'{delta_url}?$deltatoken={len(changes)}'}
+
+        page_size = 50
+        for preference in headers.get('Prefer', '').split(','):
+            name, _, value = preference.strip().partition('=')
+            if name == 'odata.maxpagesize':
+                page_size = int(value)
+        skip = int(query.get('$skiptoken', ['0'])[0])
+        end = min(skip + page_size, self.server.message_count)
+        page = {'value': [project(self.make_message(i), query, headers) for i in range(skip, end)]}
+        if end < self.server.message_count:
+            page['@odata.nextLink'] = f'{delta_url}?$skiptoken={end}'
+        else:
+            page['@odata.deltaLink'] = f'{delta_url}?$deltatoken={len(changes)}'
+        return 200, page
+
+
+class StubGraphServer:
+    """Run the stub Graph server on an ephemeral localhost port
+
+    Args:
+        message_count: Number of messages every folder contains
+        body_size: Approximate characters in each message body
+        attachment_count: Number of attachments every message lists
+        attachment_size: Bytes in each listed attachment
+        latency: Seconds added before every response, including the token endpoint
+        throttle_every: Answer every Nth Graph request (and $batch item) with 429
+
+    Append items (or {'id': ..., '@removed': {...}} markers) to
+    `delta_changes` to have them returned by the next delta round.
+    `request_counts` counts requests per 'me/<collection>' prefix,
+    including $batch items. Append (status, retry_after) pairs to
+    `fail_next` to make the next Graph requests fail with that status.
+    Drafts sent through messages/{id}/send are appended to `sent`, with
+    uploaded attachments carrying the sha256 of the received bytes.
+    Moves through messages/{id}/move are appended to `moved` as
+    (message ID, destination ID) pairs.
+    `/authorize` redirects straight back with a code, and device codes from
+    `/devicecode` are pending for `device_code_polls` token polls.
+    """
+
+    def __init__(self, handler_class=StubGraphHandler, message_count: int = 1000, body_size: int = 32,
+                 attachment_count: int = 1, attachment_size: int = 1024, latency: float = 0.0,
+                 throttle_every: int = 0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self.server.daemon_threads = True
+        self.server.message_count = message_count
+        self.server.body_size = body_size
+        self.server.delta_changes = []
+        self.server.request_counts = Counter()
+        self.server.fail_next = []
+        self.server.latency = latency
+        self.server.throttle_every = throttle_every
+        self.server.routed = 0
+        self.server.attachment_count = attachment_count
+        self.server.attachment_size = attachment_size
+        self.server.drafts = {}
+        self.server.uploads = {}
+        self.server.sent = []
+        self.server.moved = []
+        self.server.subscriptions = {}
+        self.server.device_codes = {}
+        self.server.device_code_polls = 2
+        self.server.folders = dict(STUB_FOLDERS)
+        self.server.ids = itertools.count()
+        self.server.lock = threading.Lock()
+        self.server.base_url = self.base_url
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def graph_endpoint(self) -> str:
+        return f'{self.base_url}/v1.0'
+
+    @property
+    def token_url(self) -> str:
+        return f'{self.base_url}/token'
+
+    @property
+    def request_counts(self) -> Counter:
+        return self.server.request_counts
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
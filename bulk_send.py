@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""
+Bulk Sending
+Durable SQLite outbox and a worker pool that drains it through EmailClient,
+with per-account concurrency caps and retries that never send a message twice
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+
+import requests
+
+import mail_api
+from mail_api import EmailClient, create_session
+from proxy_resolver import ProxyResolver
+from throttling import THROTTLE_STATUSES, RateLimiter, RetryMetrics
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    account TEXT NOT NULL,
+    recipients TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    content TEXT NOT NULL,
+    is_html INTEGER NOT NULL,
+    attachments TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_status_due ON outbox (status, next_attempt_at);
+"""
+
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+class OutboxMessage:
+    """A queued message claimed from the outbox"""
+
+    __slots__ = ('id', 'key', 'account', 'recipients', 'subject', 'content', 'is_html', 'attachments', 'attempts')
+
+    def __init__(self, row: sqlite3.Row):
+        self.id = row['id']
+        self.key = row['key']
+        self.account = row['account']
+        self.recipients = json.loads(row['recipients'])
+        self.subject = row['subject']
+        self.content = row['content']
+        self.is_html = bool(row['is_html'])
+        self.attachments = json.loads(row['attachments']) if row['attachments'] else None
+        self.attempts = row['attempts']
+
+
+class Outbox:
+    """SQLite queue of messages to send, surviving restarts
+
+    Each message has a unique key; enqueueing the same key twice keeps the
+    first copy, so producers can safely repeat themselves.
+
+    Args:
+        path: Database file path, ':memory:' for a throwaway outbox
+    """
+
+    def __init__(self, path: str = 'outbox.db'):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def enqueue(self, to_recipients: List[str], subject: str, content: str, is_html: bool = False,
+                account: str = 'default', attachments: Optional[List[str]] = None,
+                key: Optional[str] = None) -> str:
+        """Queue a message and return its key
+
+        Args:
+            key: Optional idempotency key, defaults to a random UUID
+        """
+        key = key or uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR IGNORE INTO outbox (key, account, recipients, subject, content, is_html, attachments, '
+                'status, next_attempt_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, account, json.dumps(to_recipients), subject, content, int(is_html),
+                 json.dumps(attachments) if attachments else None, PENDING, now, now)
+            )
+            self._conn.commit()
+        return key
+
+    def enqueue_many(self, messages: Iterable[Dict]) -> int:
+        """Queue many messages in one transaction
+
+        Args:
+            messages: Dicts of enqueue() keyword arguments
+
+        Returns:
+            Number of messages added, not counting repeated keys
+        """
+        now = time.time()
+        rows = [
+            (message.get('key') or uuid.uuid4().hex, message.get('account', 'default'),
+             json.dumps(message['to_recipients']), message['subject'], message['content'],
+             int(message.get('is_html', False)),
+             json.dumps(message['attachments']) if message.get('attachments') else None, PENDING, now, now)
+            for message in messages
+        ]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO outbox (key, account, recipients, subject, content, is_html, attachments, '
+                'status, next_attempt_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            self._conn.commit()
+            return self._conn.total_changes - before
+
+    def claim(self, exclude_accounts: Iterable[str] = ()) -> Optional[OutboxMessage]:
+        """Take the oldest due message, skipping the given accounts, and mark it as sending"""
+        exclude_accounts = list(exclude_accounts)
+        query = 'SELECT * FROM outbox WHERE status = ? AND next_attempt_at <= ?'
+        if exclude_accounts:
+            query += f" AND account NOT IN ({','.join('?' * len(exclude_accounts))})"
+        query += ' ORDER BY next_attempt_at, id LIMIT 1'
+        with self._lock:
+            row = self._conn.execute(query, [PENDING, time.time()] + exclude_accounts).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                'UPDATE outbox SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?',
+                (SENDING, time.time(), row['id'])
+            )
+            self._conn.commit()
+        message = OutboxMessage(row)
+        message.attempts += 1
+        return message
+
+    def next_due(self) -> Optional[float]:
+        """Time at which the next pending message becomes due, None if nothing is pending"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT MIN(next_attempt_at) FROM outbox WHERE status = ?', (PENDING,)
+            ).fetchone()[0]
+
+    def mark_sent(self, message_id: int) -> None:
+        self._set_status(message_id, SENT, None)
+
+    def mark_failed(self, message_id: int, error: str) -> None:
+        self._set_status(message_id, FAILED, error)
+
+    def retry_later(self, message_id: int, error: str, delay: float) -> None:
+        """Put a message back in the queue to be tried again after `delay` seconds"""
+        with self._lock:
+            self._conn.execute(
+                'UPDATE outbox SET status = ?, last_error = ?, next_attempt_at = ?, updated_at = ? WHERE id = ?',
+                (PENDING, error, time.time() + delay, time.time(), message_id)
+            )
+            self._conn.commit()
+
+    def _set_status(self, message_id: int, status: str, error: Optional[str]) -> None:
+        with self._lock:
+            self._conn.execute(
+                'UPDATE outbox SET status = ?, last_error = ?, updated_at = ? WHERE id = ?',
+                (status, error, time.time(), message_id)
+            )
+            self._conn.commit()
+
+    def recover(self) -> int:
+        """Fail messages left in 'sending' by a crashed run
+
+        Graph may or may not have accepted them, and resending could
+        deliver twice, so they are failed for review instead of retried.
+
+        Returns:
+            Number of messages recovered
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                'UPDATE outbox SET status = ?, last_error = ?, updated_at = ? WHERE status = ?',
+                (FAILED, 'Interrupted while sending, delivery unknown', time.time(), SENDING)
+            )
+            self._conn.commit()
+            return cursor.rowcount
+
+    def requeue_failed(self) -> int:
+        """Queue all failed messages again, e.g. after fixing their cause"""
+        with self._lock:
+            cursor = self._conn.execute(
+                'UPDATE outbox SET status = ?, next_attempt_at = ?, updated_at = ? WHERE status = ?',
+                (PENDING, time.time(), time.time(), FAILED)
+            )
+            self._conn.commit()
+            return cursor.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        """Number of messages per status"""
+        with self._lock:
+            rows = self._conn.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall()
+        return dict((status, count) for status, count in rows)
+
+    def failures(self, limit: int = 100) -> List[Dict]:
+        """Failed messages with their last error"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT key, account, recipients, subject, attempts, last_error FROM outbox '
+                'WHERE status = ? ORDER BY id LIMIT ?', (FAILED, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+def _failed_to_connect(error: requests.ConnectionError) -> bool:
+    """Whether a connection error happened before any of the request was sent"""
+    from urllib3.exceptions import NewConnectionError
+    reason = error.args[0] if error.args else None
+    # requests wraps urllib3's MaxRetryError, which carries the underlying error
+    reason = getattr(reason, 'reason', reason)
+    return isinstance(reason, NewConnectionError)
+
+
+def classify_error(error: Exception) -> Optional[str]:
+    """Decide how a failed send is handled
+
+    sendMail is not idempotent, so only failures that prove Graph never saw
+    the request are retried: 429 or 503 with Retry-After, and connections
+    that could not be opened. Gateway errors, timeouts and connections
+    dropped mid-request may follow an accepted message, as may a draft
+    whose send failed with DeliveryUnknownError.
+
+    Returns:
+        'retry' if Graph certainly did not accept the message and it may
+        succeed later, 'unknown' if it may have been sent, None if it will
+        never succeed as is
+    """
+    if isinstance(error, mail_api.DeliveryUnknownError):
+        return 'unknown'
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        if status in THROTTLE_STATUSES:
+            return 'retry' if error.response.headers.get('Retry-After') else 'unknown'
+        return 'unknown' if status in (502, 504) else None
+    if isinstance(error, requests.ConnectTimeout):
+        return 'retry'
+    if isinstance(error, requests.Timeout):
+        return 'unknown'
+    if isinstance(error, requests.ConnectionError):
+        return 'retry' if _failed_to_connect(error) else 'unknown'
+    return None
+
+
+class BulkSender:
+    """Drain an outbox with a pool of worker threads
+
+    Each account's messages are sent by at most `per_account` workers at a
+    time. Messages Graph rejected temporarily, after EmailClient's own
+    retries, are requeued with backoff up to `max_attempts`; a message that
+    may have been accepted, after a timeout, gateway error or dropped
+    connection, is failed rather than risk a duplicate.
+
+    Args:
+        outbox: Outbox to drain
+        clients: Optional EmailClient per account; missing accounts get a
+            client sharing one session, proxy resolver and rate limiter
+        workers: Number of sending threads
+        per_account: Maximum concurrent sends per account
+        max_attempts: Attempts per message before it is failed
+        retry_delay: Seconds before the first requeued attempt, doubled each time
+        on_progress: Optional callback receiving progress dicts
+        progress_interval: Minimum seconds between progress reports
+        token_manager: Optional token_manager.TokenManager for created clients
+    """
+
+    def __init__(self, outbox: Outbox, clients: Optional[Dict[str, EmailClient]] = None, workers: int = 8,
+                 per_account: int = 4, max_attempts: int = 3, retry_delay: float = 30.0,
+                 on_progress: Optional[Callable[[Dict], None]] = None, progress_interval: float = 5.0,
+                 token_manager=None):
+        self.outbox = outbox
+        self.clients = dict(clients or {})
+        self._owned_clients = []
+        self.workers = workers
+        self.per_account = per_account
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.on_progress = on_progress
+        self.progress_interval = progress_interval
+        self.token_manager = token_manager
+        self._session = None
+        self._proxy_resolver = None
+        self._rate_limiter = None
+        self.retry_metrics = RetryMetrics()
+        self._active = Counter()
+        self._counts = Counter()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._started_at = None
+        self._last_progress = 0.0
+
+    @classmethod
+    def from_config(cls, config=None, **kwargs) -> 'BulkSender':
+        """Create sender for the outbox configured in the optional [outbox] section"""
+        if config is None:
+            config = mail_api.load_config()
+        kwargs.setdefault('workers', config.getint('outbox', 'workers', fallback=8))
+        kwargs.setdefault('per_account', config.getint('outbox', 'per_account', fallback=4))
+        kwargs.setdefault('max_attempts', config.getint('outbox', 'max_attempts', fallback=3))
+        kwargs.setdefault('retry_delay', config.getfloat('outbox', 'retry_delay', fallback=30.0))
+        return cls(Outbox(config.get('outbox', 'path', fallback='outbox.db')), **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        """Close the clients and session created by this sender"""
+        for client in self._owned_clients:
+            client.close()
+        self._owned_clients = []
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def client(self, account: str) -> EmailClient:
+        """Get the client sending for `account`, creating it on first use"""
+        with self._condition:
+            client = self.clients.get(account)
+            if client is None:
+                if self._session is None:
+                    config = mail_api.load_config()
+                    self._session = create_session(config)
+                    self._proxy_resolver = ProxyResolver.from_config(config)
+                    self._rate_limiter = RateLimiter.from_config(config)
+                client = EmailClient(
+                    session=self._session, proxy_resolver=self._proxy_resolver,
+                    token_manager=self.token_manager, account=account,
+                    rate_limiter=self._rate_limiter, retry_metrics=self.retry_metrics
+                )
+                self.clients[account] = client
+                self._owned_clients.append(client)
+            return client
+
+    def stop(self) -> None:
+        """Stop claiming new messages; run() returns once in-flight sends finish"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def run(self) -> Dict:
+        """Send until the outbox has no pending messages, or stop() is called
+
+        Returns:
+            Summary dict with 'sent', 'failed', 'retried' and 'unknown'
+            counts, 'elapsed' seconds, 'per_minute' throughput and the
+            outbox's remaining status counts
+        """
+        recovered = self.outbox.recover()
+        if recovered:
+            logger.warning(f"{recovered} messages were interrupted while sending and marked failed")
+        self._stopped = False
+        self._counts = Counter()
+        self._started_at = time.monotonic()
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='bulk-send') as pool:
+            for future in [pool.submit(self._work) for _ in range(self.workers)]:
+                future.result()
+        summary = self.progress()
+        summary['outbox'] = self.outbox.counts()
+        logger.info(f"Bulk send finished: {summary['sent']} sent, {summary['failed']} failed "
+                    f"in {summary['elapsed']:.1f}s ({summary['per_minute']:.0f}/min)")
+        return summary
+
+    def progress(self) -> Dict:
+        """Counters of the current run"""
+        with self._condition:
+            counts = dict(self._counts)
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0.0
+        summary = dict((key, counts.get(key, 0)) for key in ('sent', 'failed', 'retried', 'unknown'))
+        summary['elapsed'] = elapsed
+        summary['per_minute'] = summary['sent'] * 60 / elapsed if elapsed > 0 else 0.0
+        return summary
+
+    def _claim(self) -> Optional[OutboxMessage]:
+        """Claim the next message an account has capacity for, waiting while others are in flight"""
+        with self._condition:
+            while not self._stopped:
+                full = [account for account, count in self._active.items() if count >= self.per_account]
+                message = self.outbox.claim(full)
+                if message is not None:
+                    self._active[message.account] += 1
+                    return message
+                next_due = self.outbox.next_due()
+                if next_due is None and not any(self._active.values()):
+                    return None
+                # Wait for an in-flight send to finish or a requeued message to become due
+                timeout = 1.0 if next_due is None else min(1.0, max(0.01, next_due - time.time()))
+                self._condition.wait(timeout)
+            return None
+
+    def _work(self) -> None:
+        while True:
+            message = self._claim()
+            if message is None:
+                return
+            outcome = 'failed'
+            try:
+                outcome = self._send(message)
+            finally:
+                with self._condition:
+                    self._active[message.account] -= 1
+                    self._counts[outcome] += 1
+                    self._condition.notify_all()
+            self._report()
+
+    def _send(self, message: OutboxMessage) -> str:
+        """Send one message and record the result in the outbox"""
+        try:
+            self.client(message.account).send_email(
+                message.recipients, message.subject, message.content, message.is_html,
+                attachments=message.attachments
+            )
+        except Exception as e:
+            kind = classify_error(e)
+            if kind == 'retry' and message.attempts < self.max_attempts:
+                delay = self.retry_delay * 2 ** (message.attempts - 1)
+                self.outbox.retry_later(message.id, str(e), delay)
+                logger.warning(f"Message {message.key} failed ({e}), retrying in {delay:.0f}s")
+                return 'retried'
+            self.outbox.mark_failed(message.id, str(e))
+            return 'unknown' if kind == 'unknown' else 'failed'
+        self.outbox.mark_sent(message.id)
+        return 'sent'
+
+    def _report(self) -> None:
+        now = time.monotonic()
+        with self._condition:
+            if now - self._last_progress < self.progress_interval:
+                return
+            self._last_progress = now
+        progress = self.progress()
+        if self.on_progress is not None:
+            self.on_progress(progress)
+        else:
+            logger.info(f"Bulk send progress: {progress['sent']} sent, {progress['failed']} failed, "
+                        f"{progress['retried']} retried ({progress['per_minute']:.0f}/min)")
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Content Cache
+Size-bounded on-disk cache of message bodies and attachments. Small items
+live in SQLite, large ones in content-addressed files, and the least
+recently used entries are evicted first
+"""
+
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Iterable, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    change_key TEXT,
+    etag TEXT,
+    size INTEGER NOT NULL,
+    digest TEXT,
+    data BLOB,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest);
+"""
+
+# Cache hits whose last_access updates are written together
+TOUCH_BATCH_SIZE = 64
+
+
+class CacheEntry:
+    """A cached item; small items carry `data`, large ones a file `path`"""
+
+    __slots__ = ('key', 'change_key', 'etag', 'size', 'data', 'path')
+
+    def __init__(self, key: str, change_key: Optional[str], etag: Optional[str], size: int,
+                 data: Optional[bytes] = None, path: Optional[str] = None):
+        self.key = key
+        self.change_key = change_key
+        self.etag = etag
+        self.size = size
+        self.data = data
+        self.path = path
+
+    def read(self) -> bytes:
+        if self.data is not None:
+            return self.data
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+class ContentCache:
+    """Cache keyed by message (or attachment) id and validated by changeKey
+
+    Several processes may share a directory: the size cap is checked
+    against the index, not a per-process counter. Hits update last_access
+    in batches of TOUCH_BATCH_SIZE, and before any eviction or close().
+
+    Args:
+        directory: Directory holding the index database and content files
+        max_bytes: Total size above which least recently used entries are evicted
+        inline_limit: Items up to this size are stored inside SQLite
+    """
+
+    def __init__(self, directory: str = 'cache', max_bytes: int = 512 * 1024 * 1024,
+                 inline_limit: int = 16 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.inline_limit = inline_limit
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+        self._touched = {}
+
+    @classmethod
+    def from_config(cls, config) -> Optional['ContentCache']:
+        """Create cache from the optional [cache] section of config.txt, None unless enabled"""
+        if not config.getboolean('cache', 'enabled', fallback=False):
+            return None
+        return cls(
+            directory=config.get('cache', 'directory', fallback='cache'),
+            max_bytes=int(config.getfloat('cache', 'max_size_mb', fallback=512) * 1024 * 1024),
+            inline_limit=int(config.getfloat('cache', 'inline_limit_kb', fallback=16) * 1024)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touches()
+            self._conn.commit()
+            self._conn.close()
+
+    @property
+    def total_bytes(self) -> int:
+        """Size of all entries in the index, including other processes' entries"""
+        with self._lock:
+            return self._total_bytes()
+
+    def _total_bytes(self) -> int:
+        return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.directory, 'objects', digest[:2], digest[2:])
+
+    def get(self, key: str, change_key: Optional[str] = None) -> Optional[CacheEntry]:
+        """Look up an entry, marking it recently used
+
+        Args:
+            key: Cache key, e.g. 'message:<id>'
+            change_key: If given, only return the entry if it was stored for this changeKey
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT change_key, etag, size, digest, data FROM entries WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or (change_key is not None and row[0] != change_key):
+                return None
+            entry_change_key, etag, size, digest, data = row
+            path = self._object_path(digest) if digest else None
+            if path is not None and not os.path.exists(path):
+                self._delete(key)
+                self._conn.commit()
+                return None
+            self._touched[key] = time.time()
+            if len(self._touched) >= TOUCH_BATCH_SIZE:
+                self._flush_touches()
+                self._conn.commit()
+        return CacheEntry(key, entry_change_key, etag, size, data=data, path=path)
+
+    def put(self, key: str, data: bytes, change_key: Optional[str] = None, etag: Optional[str] = None) -> None:
+        """Store bytes, inline if small and as a content-addressed file otherwise"""
+        if len(data) <= self.inline_limit:
+            self._insert(key, change_key, etag, len(data), None, data)
+            return
+        self.put_stream(key, [data], change_key, etag)
+
+    def put_stream(self, key: str, chunks: Iterable[bytes], change_key: Optional[str] = None,
+                   etag: Optional[str] = None) -> CacheEntry:
+        """Store a stream of chunks as a content-addressed file without buffering it in memory"""
+        import hashlib
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.directory, 'objects'))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            hex_digest = digest.hexdigest()
+            path = self._object_path(hex_digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._insert(key, change_key, etag, size, hex_digest, None)
+        return CacheEntry(key, change_key, etag, size, path=path)
+
+    def open(self, key: str, change_key: Optional[str] = None) -> Optional[BinaryIO]:
+        """Open a cached item for reading, None on a miss"""
+        entry = self.get(key, change_key)
+        if entry is None:
+            return None
+        if entry.path is not None:
+            return open(entry.path, 'rb')
+        return io.BytesIO(entry.data)
+
+    def copy_to(self, key: str, destination: str, change_key: Optional[str] = None) -> bool:
+        """Copy a cached item to a file, returning False on a miss"""
+        source = self.open(key, change_key)
+        if source is None:
+            return False
+        with source, open(destination, 'wb') as f:
+            shutil.copyfileobj(source, f)
+        return True
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._delete(key)
+            self._conn.commit()
+
+    def _insert(self, key: str, change_key: Optional[str], etag: Optional[str], size: int,
+                digest: Optional[str], data: Optional[bytes]) -> None:
+        with self._lock:
+            old = self._conn.execute('SELECT digest FROM entries WHERE key = ?', (key,)).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO entries (key, change_key, etag, size, digest, data, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, change_key, etag, size, digest, data, time.time())
+            )
+            self._touched.pop(key, None)
+            # The new row is in place, so a file it shares with the old row stays
+            if old is not None and old[0] and old[0] != digest:
+                self._release(old[0])
+            self._evict(keep=key)
+            self._conn.commit()
+
+    def _delete(self, key: str) -> int:
+        """Remove an entry and its file unless another entry shares it, caller holds the lock
+
+        Returns:
+            Size of the removed entry, 0 if there was none
+        """
+        row = self._conn.execute('SELECT size, digest FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return 0
+        size, digest = row
+        self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+        self._touched.pop(key, None)
+        if digest:
+            self._release(digest)
+        return size
+
+    def _release(self, digest: str) -> None:
+        """Remove a content file no entry refers to anymore, caller holds the lock"""
+        shared = self._conn.execute('SELECT 1 FROM entries WHERE digest = ? LIMIT 1', (digest,)).fetchone()
+        if shared is None:
+            try:
+                os.unlink(self._object_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def _flush_touches(self) -> None:
+        """Write pending last_access updates, caller holds the lock and commits"""
+        if self._touched:
+            touched, self._touched = self._touched, {}
+            self._conn.executemany('UPDATE entries SET last_access = ? WHERE key = ?',
+                                   [(accessed, key) for key, accessed in touched.items()])
+
+    def _evict(self, keep: str) -> None:
+        """Drop least recently used entries until the cache fits, caller holds the lock
+
+        Args:
+            keep: Key of the entry just stored, which is never evicted by its own insert
+        """
+        total = self._total_bytes()
+        if total <= self.max_bytes:
+            return
+        self._flush_touches()
+        while total > self.max_bytes:
+            row = self._conn.execute(
+                'SELECT key FROM entries WHERE key != ? ORDER BY last_access LIMIT 1', (keep,)
+            ).fetchone()
+            if row is None:
+                return
+            total -= self._delete(row[0])
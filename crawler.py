@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Mailbox Crawler
+Discovers the whole mail folder tree and downloads folders in parallel into
+a sink, checkpointing every page so an interrupted crawl resumes where it
+stopped
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.generator import BytesGenerator
+from email.message import EmailMessage
+from email.utils import format_datetime, parsedate_to_datetime
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional
+
+import mail_api
+from mail_api import EmailClient, build_message_query
+from instrumentation import configure_logging
+from message_store import MessageStore
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    folder_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    next_link TEXT,
+    done INTEGER NOT NULL DEFAULT 0,
+    count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def _address(recipient: Optional[Dict]) -> str:
+    address = (recipient or {}).get('emailAddress') or {}
+    if address.get('name'):
+        return f"{address['name']} <{address.get('address', '')}>"
+    return address.get('address', '')
+
+
+class AppendFileSink:
+    """Base for sinks appending to one file; the checkpoint records its size after each page"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'ab')
+
+    def position(self) -> int:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def truncate(self, position: int) -> None:
+        """Drop anything written after the last checkpoint"""
+        self._file.truncate(position)
+        self._file.seek(position)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class JsonlSink(AppendFileSink):
+    """Write one JSON object per line, with the folder path under '_folder'"""
+
+    def write(self, folder: Dict, messages: List[Dict]) -> None:
+        for message in messages:
+            record = dict(message, _folder=folder['path'])
+            self._file.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+
+
+class MboxSink(AppendFileSink):
+    """Write messages in mbox format, rebuilt from the Graph message fields
+
+    Messages are reconstructed from their JSON properties (sender,
+    recipients, subject, date and body); fetch `$value` for byte-exact MIME.
+    """
+
+    def write(self, folder: Dict, messages: List[Dict]) -> None:
+        for message in messages:
+            email_message = EmailMessage()
+            email_message['From'] = _address(message.get('from'))
+            recipients = [_address(r) for r in message.get('toRecipients', [])]
+            if recipients:
+                email_message['To'] = ', '.join(recipients)
+            email_message['Subject'] = message.get('subject') or ''
+            received = message.get('receivedDateTime')
+            if received:
+                email_message['Date'] = format_datetime(datetime.strptime(received, '%Y-%m-%dT%H:%M:%S%z'))
+            email_message['X-Folder'] = folder['path']
+            email_message['X-Graph-Id'] = message['id']
+            body = message.get('body') or {}
+            subtype = 'html' if (body.get('contentType') or '').lower() == 'html' else 'plain'
+            email_message.set_content(body.get('content') or message.get('bodyPreview') or '', subtype=subtype)
+            sender = (message.get('from') or {}).get('emailAddress', {}).get('address') or 'MAILER-DAEMON'
+            date = email_message['Date']
+            stamp = parsedate_to_datetime(date).strftime('%a %b %d %H:%M:%S %Y') if date else time.asctime()
+            self._file.write(f'From {sender} {stamp}\n'.encode('utf-8'))
+            BytesGenerator(self._file, mangle_from_=True).flatten(email_message)
+            self._file.write(b'\n')
+
+
+class SqliteSink:
+    """Write messages into a MessageStore; rewriting a page is harmless, so no truncation is needed"""
+
+    def __init__(self, path: str):
+        self.store = MessageStore(path)
+
+    def write(self, folder: Dict, messages: List[Dict]) -> None:
+        self.store.apply_changes(folder['id'], messages)
+
+    def position(self) -> int:
+        return 0
+
+    def truncate(self, position: int) -> None:
+        pass
+
+    def close(self) -> None:
+        self.store.close()
+
+
+SINKS = {'jsonl': JsonlSink, 'mbox': MboxSink, 'sqlite': SqliteSink}
+
+
+def open_sink(kind: str, path: str):
+    """Create a sink by name: 'jsonl', 'mbox' or 'sqlite'"""
+    if kind not in SINKS:
+        raise ValueError(f"Unknown sink {kind!r}, expected one of {', '.join(SINKS)}")
+    return SINKS[kind](path)
+
+
+class CrawlCheckpoint:
+    """SQLite record of each folder's next page and the sink position
+
+    Args:
+        path: Database file path, ':memory:' for a crawl that cannot resume
+    """
+
+    def __init__(self, path: str = 'crawl.db'):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(CHECKPOINT_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def add_folders(self, folders: Iterable[Dict]) -> None:
+        """Record discovered folders, keeping the progress of known ones"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO folders (folder_id, path) VALUES (?, ?)',
+                [(folder['id'], folder['path']) for folder in folders]
+            )
+
+    def folder(self, folder_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM folders WHERE folder_id = ?', (folder_id,)).fetchone()
+        return dict(row) if row else None
+
+    def save_page(self, folder_id: str, next_link: Optional[str], count: int, sink_position: int) -> None:
+        """Record a written page and the sink position in one transaction"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE folders SET next_link = ?, done = ?, count = count + ? WHERE folder_id = ?',
+                (next_link, int(next_link is None), count, folder_id)
+            )
+            self._conn.execute(
+                'INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', ('sink_position', str(sink_position))
+            )
+
+    def sink_position(self) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key = 'sink_position'").fetchone()
+        return int(row['value']) if row else None
+
+    def totals(self) -> Dict[str, int]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT COUNT(*) AS folders, COALESCE(SUM(done), 0) AS done, '
+                'COALESCE(SUM(count), 0) AS messages FROM folders'
+            ).fetchone()
+        return dict(row)
+
+
+class MailboxCrawler:
+    """Download every folder of a mailbox in parallel into a sink
+
+    Folders are discovered recursively through mailFolders and
+    childFolders, then fetched by a bounded pool of workers, one folder per
+    worker at a time. After each page is written, the folder's nextLink and
+    the sink position are checkpointed together; a resumed crawl truncates
+    the sink back to the checkpoint and continues from the saved nextLinks.
+
+    Args:
+        client: Email client to crawl with, shared by all workers
+        sink: Sink with write(folder, messages), position(), truncate() and close()
+        checkpoint: Optional checkpoint, defaults to an in-memory one
+        workers: Folders fetched at the same time
+        page_size: Messages requested per page, at most 1000
+        select: Message fields to fetch, defaults to subject, receivedDateTime and from
+        body: Body to fetch: 'none', 'preview', 'text' or 'html'
+        include_hidden: Whether to include hidden folders
+        on_progress: Optional callback receiving (folder, messages written so far)
+    """
+
+    def __init__(self, client: EmailClient, sink, checkpoint: Optional[CrawlCheckpoint] = None, workers: int = 4,
+                 page_size: int = 100, select: Optional[List[str]] = None, body: str = 'text',
+                 include_hidden: bool = False, on_progress: Optional[Callable[[Dict, int], None]] = None):
+        self.client = client
+        self.sink = sink
+        self.checkpoint = checkpoint if checkpoint is not None else CrawlCheckpoint(':memory:')
+        self.workers = workers
+        self.page_size = min(page_size, mail_api.MAX_PAGE_SIZE)
+        self.select = select
+        self.body = body
+        self.include_hidden = include_hidden
+        self.on_progress = on_progress
+        self._write_lock = threading.Lock()
+        self._position = 0
+
+    def discover(self) -> List[Dict]:
+        """List every folder depth first, adding a '/'-separated 'path' to each"""
+        folders = []
+        pending = [(None, '')]
+        while pending:
+            parent_id, parent_path = pending.pop()
+            for folder in self.client.list_folders(parent_id, include_hidden=self.include_hidden):
+                folder['path'] = f"{parent_path}/{folder['displayName']}" if parent_path else folder['displayName']
+                folders.append(folder)
+                if folder.get('childFolderCount'):
+                    pending.append((folder['id'], folder['path']))
+        return folders
+
+    def run(self) -> Dict:
+        """Crawl all folders not finished by an earlier run
+
+        Returns:
+            Dict with 'folders', 'messages' written in this run, 'elapsed' seconds
+            and the checkpoint totals
+        """
+        start = time.monotonic()
+        position = self.checkpoint.sink_position()
+        if position is not None:
+            self.sink.truncate(position)
+        self._position = self.sink.position()
+        folders = self.discover()
+        self.checkpoint.add_folders(folders)
+        todo = [folder for folder in folders if not self.checkpoint.folder(folder['id'])['done']]
+        logger.info(f"Crawling {len(todo)} of {len(folders)} folders with {self.workers} workers")
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='crawler') as pool:
+            counts = list(pool.map(self._crawl_folder, todo))
+
+        summary = {'folders': len(todo), 'messages': sum(counts), 'elapsed': time.monotonic() - start}
+        summary['totals'] = self.checkpoint.totals()
+        logger.info(f"Crawled {summary['messages']} messages from {summary['folders']} folders "
+                    f"in {summary['elapsed']:.1f}s")
+        return summary
+
+    def _crawl_folder(self, folder: Dict) -> int:
+        # Oldest first, so mail arriving during the crawl lands after the pages already read
+        query_params, prefer = build_message_query(self.select, self.body, orderby='receivedDateTime ASC')
+        query_params['$top'] = self.page_size
+        url = self.checkpoint.folder(folder['id'])['next_link']
+        if url is None:
+            url = f"{mail_api.GRAPH_API_ENDPOINT}/me/mailFolders/{folder['id']}/messages"
+        else:
+            # A saved nextLink already carries the query parameters
+            query_params = None
+
+        written = 0
+        while url:
+            page = self.client._get_page(url, query_params, prefer=prefer)
+            messages = page.get('value', [])
+            url = page.get('@odata.nextLink')
+            query_params = None
+            with self._write_lock:
+                try:
+                    self.sink.write(folder, messages)
+                except Exception:
+                    # Other workers keep writing, so drop the partial page now rather than on resume
+                    self.sink.truncate(self._position)
+                    raise
+                self._position = self.sink.position()
+                self.checkpoint.save_page(folder['id'], url, len(messages), self._position)
+            written += len(messages)
+            if self.on_progress is not None:
+                self.on_progress(folder, written)
+        logger.info(f"Crawled {folder['path']}: {written} messages")
+        return written
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Archive every folder of the mailbox')
+    parser.add_argument('output', help='Output file')
+    parser.add_argument('--sink', choices=sorted(SINKS), default='jsonl', help='Output format')
+    parser.add_argument('--checkpoint', default='crawl.db', help='Checkpoint database, reused to resume')
+    parser.add_argument('--workers', type=int, help='Folders fetched at the same time')
+    parser.add_argument('--body', choices=mail_api.BODY_MODES, default='text', help='Body to include')
+    args = parser.parse_args()
+
+    config = mail_api.load_config()
+    configure_logging(config)
+    workers = args.workers or config.getint('crawler', 'workers', fallback=4)
+    page_size = config.getint('crawler', 'page_size', fallback=100)
+    sink = open_sink(args.sink, args.output)
+    try:
+        with EmailClient() as client, CrawlCheckpoint(args.checkpoint) as checkpoint:
+            crawler = MailboxCrawler(client, sink, checkpoint, workers=workers, page_size=page_size, body=args.body)
+            summary = crawler.run()
+        print(f"Crawled {summary['messages']} messages from {summary['folders']} folders "
+              f"({summary['totals']['messages']} in total)")
+    finally:
+        sink.close()
+
+
+if __name__ == '__main__':
+    main()
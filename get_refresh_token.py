@@ -2,61 +2,42 @@
 """
 Microsoft OAuth2 Authentication Script
 Used to obtain Microsoft access_token and refresh_token
+
+Any number of accounts are provisioned concurrently, either in tabs of one
+shared browser with a callback server per account on an ephemeral port, or
+through the browser-free device code flow, and their tokens are written
+straight into the token store.
 """
 
-from DrissionPage import Chromium
-import requests
-from typing import Dict
-import logging
-import configparser
-from urllib.parse import quote, parse_qs
-import time
-from datetime import datetime
-import winreg
+import argparse
 import base64
 import hashlib
+import logging
+import os
 import secrets
 import string
-from http.server import HTTPServer, BaseHTTPRequestHandler
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
 
-def get_proxy():
-    try:
-        with winreg.OpenKey(winreg.HKEY_CURRENT_USER, r"Software\Microsoft\Windows\CurrentVersion\Internet Settings") as key:
-            proxy_enable, _ = winreg.QueryValueEx(key, "ProxyEnable")
-            proxy_server, _ = winreg.QueryValueEx(key, "ProxyServer")
-            
-            if proxy_enable and proxy_server:
-                proxy_parts = proxy_server.split(":")
-                if len(proxy_parts) == 2:
-                    return {"http": f"http://{proxy_server}", "https": f"http://{proxy_server}"}
-    except WindowsError:
-        pass
-    return {"http": None, "https": None}
-
-def load_config():
-    config = configparser.ConfigParser()
-    config.read('config.txt', encoding='utf-8')
-    return config
+import requests
 
-def save_config(config):
-    with open('config.txt', 'w', encoding='utf-8') as f:
-        config.write(f)
+import mail_api
+from mail_api import create_session, get_timeout
+from instrumentation import configure_logging
+from proxy_resolver import ProxyResolver
+from token_store import AccountToken, TokenStore, open_token_store
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 加载配置
-config = load_config()
-microsoft_config = config['microsoft']
-
-CLIENT_ID = microsoft_config['client_id']
-REDIRECT_URI = microsoft_config['redirect_uri']
-
 # API端点
 AUTH_URL = 'https://login.microsoftonline.com/common/oauth2/v2.0/authorize'
 TOKEN_URL = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
+DEVICE_CODE_URL = 'https://login.microsoftonline.com/common/oauth2/v2.0/devicecode'
+DEVICE_CODE_GRANT = 'urn:ietf:params:oauth:grant-type:device_code'
 
 # 权限范围
 SCOPES = [
@@ -66,6 +47,16 @@ SCOPES = [
     'https://graph.microsoft.com/User.Read'
 ]
 
+CALLBACK_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'callback.html')
+
+# (account name, optional login hint e-mail address)
+Account = Tuple[str, Optional[str]]
+
+
+class AuthorizationError(Exception):
+    """Sign-in was declined, expired, timed out or returned no tokens"""
+
+
 def generate_code_verifier(length=128) -> str:
     """生成PKCE验证码"""
     alphabet = string.ascii_letters + string.digits + '-._~'
@@ -76,122 +67,294 @@ def generate_code_challenge(code_verifier: str) -> str:
     sha256_hash = hashlib.sha256(code_verifier.encode()).digest()
     return base64.urlsafe_b64encode(sha256_hash).decode().rstrip('=')
 
-def request_authorization(tab) -> tuple:
-    """Request Microsoft OAuth2 Authorization"""
-    code_verifier = generate_code_verifier()
-    code_challenge = generate_code_challenge(code_verifier)
-    
-    scope = ' '.join(SCOPES)
-    auth_params = {
-        'client_id': CLIENT_ID,
-        'response_type': 'code',
-        'redirect_uri': REDIRECT_URI,
-        'scope': scope,
-        'response_mode': 'query',
-        'prompt': 'select_account',
-        'code_challenge': code_challenge,
-        'code_challenge_method': 'S256'
-    }
-    
-    params = '&'.join([f'{k}={quote(v)}' for k, v in auth_params.items()])
-    auth_url = f'{AUTH_URL}?{params}'
-    
-    tab.get(auth_url)
-    logger.info("Waiting for user login and authorization...")
-    
-    tab.wait.url_change(text='localhost:8000', timeout=300)
-    
-    callback_url = tab.url
-    logger.info(f"Callback URL: {callback_url}")
-    
-    query_components = parse_qs(callback_url.split('?')[1]) if '?' in callback_url else {}
-    
-    if 'code' not in query_components:
-        raise ValueError("Failed to get authorization code")
-    
-    auth_code = query_components['code'][0]
-    logger.info("Successfully obtained authorization code")
-    
-    return auth_code, code_verifier
-
-def get_tokens(auth_code: str, code_verifier: str) -> Dict[str, str]:
-    """Get access token and refresh token using authorization code"""
-    token_params = {
-        'client_id': CLIENT_ID,
-        'code': auth_code,
-        'redirect_uri': REDIRECT_URI,
-        'grant_type': 'authorization_code',
-        'scope': ' '.join(SCOPES),
-        'code_verifier': code_verifier
-    }
-    
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    
-    try:
-        response = requests.post(TOKEN_URL, data=token_params, headers=headers, proxies=get_proxy())
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        logger.error(f"Failed to get token: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            logger.error(f"Response content: {e.response.text}")
-        raise
+def parse_accounts(lines) -> List[Account]:
+    """Parse 'name [login_hint]' lines, skipping blank lines and # comments"""
+    accounts = []
+    for line in lines:
+        fields = line.split('#', 1)[0].replace(',', ' ').split()
+        if fields:
+            accounts.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return accounts
+
 
 class OAuthHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
     def do_GET(self):
-        if '/?code=' in self.path:
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html; charset=utf-8')
-            self.end_headers()
-            
-            with open('templates/callback.html', 'r', encoding='utf-8') as f:
-                content = f.read()
-                self.wfile.write(content.encode('utf-8'))
-        else:
+        query = parse_qs(urlsplit(self.path).query)
+        if 'code' not in query and 'error' not in query:
             self.send_response(404)
             self.end_headers()
+            return
 
-def start_server():
-    server = HTTPServer(('localhost', 8000), OAuthHandler)
-    server.serve_forever()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.end_headers()
+        try:
+            with open(CALLBACK_TEMPLATE, 'r', encoding='utf-8') as f:
+                self.wfile.write(f.read().encode('utf-8'))
+        except OSError:
+            self.wfile.write(b'Authorization complete, you can close this window.')
+        self.server.callback.deliver(query)
 
-def main():
-    server_thread = threading.Thread(target=start_server)
-    server_thread.daemon = True
-    server_thread.start()
-    
-    try:
-        browser = Chromium()
-        tab = browser.new_tab() 
 
-        logger.info("Opening browser for authorization...")
-        
+class CallbackServer:
+    """Receive one authorization redirect on an ephemeral localhost port
+
+    Microsoft identity platform accepts any port for http://localhost
+    redirect URIs, so each concurrent sign-in gets its own server.
+
+    Args:
+        redirect_uri: Registered redirect URI, whose host and path are kept
+    """
+
+    def __init__(self, redirect_uri: str):
+        parts = urlsplit(redirect_uri)
+        host = parts.hostname or 'localhost'
+        self.server = HTTPServer((host, 0), OAuthHandler)
+        self.server.callback = self
+        self.redirect_uri = urlunsplit((parts.scheme or 'http', f'{host}:{self.server.server_address[1]}',
+                                        parts.path or '/', '', ''))
+        self.query = None
+        self._received = threading.Event()
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, name='oauth-callback', daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def deliver(self, query: Dict[str, List[str]]) -> None:
+        if self.query is None:
+            self.query = query
+            self._received.set()
+
+    def wait(self, timeout: float) -> Dict[str, List[str]]:
+        """Wait for the redirect and return its query parameters"""
+        if not self._received.wait(timeout):
+            raise AuthorizationError(f"No authorization redirect within {timeout:g}s")
+        return self.query
+
+
+class Provisioner:
+    """Obtain tokens for many accounts concurrently and save them to a token store
+
+    Args:
+        client_id: Application (client) ID
+        redirect_uri: Registered localhost redirect URI for the browser flow
+        token_store: Store the tokens are saved to
+        session: Optional HTTP session for token requests
+        proxy_resolver: Optional proxy resolver for token requests
+        timeout: Seconds each account has to complete its sign-in
+        workers: Accounts signing in at the same time
+        request_timeout: (connect, read) timeout of token requests
+    """
+
+    def __init__(self, client_id: str, redirect_uri: str, token_store: TokenStore,
+                 session: requests.Session = None, proxy_resolver: ProxyResolver = None,
+                 timeout: float = 300, workers: int = 4, request_timeout: tuple = (10, 30)):
+        self.client_id = client_id
+        self.redirect_uri = redirect_uri
+        self.token_store = token_store
+        self.session = session if session is not None else requests.Session()
+        self.proxy_resolver = proxy_resolver if proxy_resolver is not None else ProxyResolver()
+        self.timeout = timeout
+        self.workers = workers
+        self.request_timeout = request_timeout
+        self._browser_lock = threading.Lock()
+
+    def _post(self, url: str, data: Dict) -> requests.Response:
+        return self.session.post(url, data=data, headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                                 proxies=self.proxy_resolver.resolve(), timeout=self.request_timeout)
+
+    def exchange_code(self, auth_code: str, code_verifier: str, redirect_uri: str) -> Dict:
+        """Get access token and refresh token using authorization code"""
+        token_params = {
+            'client_id': self.client_id,
+            'code': auth_code,
+            'redirect_uri': redirect_uri,
+            'grant_type': 'authorization_code',
+            'scope': ' '.join(SCOPES),
+            'code_verifier': code_verifier
+        }
         try:
-            auth_code, code_verifier = request_authorization(tab)
-            logger.info("Successfully obtained authorization code!")
-            
-            tokens = get_tokens(auth_code, code_verifier)
-            
-            if 'refresh_token' in tokens:
-                logger.info("Successfully obtained refresh_token!")
-                config['tokens']['refresh_token'] = tokens['refresh_token']
-                if 'access_token' in tokens:
-                    config['tokens']['access_token'] = tokens['access_token']
-                    expires_at = time.time() + tokens['expires_in']
-                    expires_at_str = datetime.fromtimestamp(expires_at).strftime('%Y-%m-%d %H:%M:%S')
-                    config['tokens']['expires_at'] = expires_at_str
-                save_config(config)
-
-                time.sleep(15)
+            response = self._post(TOKEN_URL, token_params)
+            response.raise_for_status()
+            return response.json()
+        except requests.RequestException as e:
+            logger.error(f"Failed to get token: {e}")
+            if hasattr(e, 'response') and e.response is not None:
+                logger.error(f"Response content: {e.response.text}")
+            raise
+
+    def authorize_browser(self, browser, account: str, login_hint: Optional[str] = None) -> Dict:
+        """Sign an account in through a new tab of the shared browser and return its tokens"""
+        code_verifier = generate_code_verifier()
+        state = secrets.token_urlsafe(16)
+        with CallbackServer(self.redirect_uri) as callback:
+            auth_params = {
+                'client_id': self.client_id,
+                'response_type': 'code',
+                'redirect_uri': callback.redirect_uri,
+                'scope': ' '.join(SCOPES),
+                'response_mode': 'query',
+                'prompt': 'select_account',
+                'state': state,
+                'code_challenge': generate_code_challenge(code_verifier),
+                'code_challenge_method': 'S256'
+            }
+            if login_hint:
+                auth_params['login_hint'] = login_hint
+
+            with self._browser_lock:
+                tab = browser.new_tab()
+            try:
+                logger.info(f"[{account}] Waiting for user login and authorization...")
+                tab.get(f'{AUTH_URL}?{urlencode(auth_params)}')
+                query = callback.wait(self.timeout)
+            finally:
                 tab.close()
+
+        if query.get('state', [None])[0] != state:
+            raise AuthorizationError("Authorization redirect carried an unexpected state")
+        if 'error' in query:
+            raise AuthorizationError(f"{query['error'][0]}: {query.get('error_description', [''])[0]}")
+        logger.info(f"[{account}] Successfully obtained authorization code")
+        return self.exchange_code(query['code'][0], code_verifier, callback.redirect_uri)
+
+    def authorize_device_code(self, account: str, login_hint: Optional[str] = None) -> Dict:
+        """Sign an account in with the device code flow, without a browser on this machine"""
+        response = self._post(DEVICE_CODE_URL, {'client_id': self.client_id, 'scope': ' '.join(SCOPES)})
+        response.raise_for_status()
+        device = response.json()
+        who = f"{account} ({login_hint})" if login_hint else account
+        print(f"[{who}] {device['message']}", flush=True)
+
+        interval = device.get('interval', 5)
+        deadline = time.monotonic() + min(device.get('expires_in', 900), self.timeout)
+        while time.monotonic() < deadline:
+            time.sleep(interval)
+            response = self._post(TOKEN_URL, {
+                'grant_type': DEVICE_CODE_GRANT,
+                'client_id': self.client_id,
+                'device_code': device['device_code']
+            })
+            if response.ok:
+                return response.json()
+            error = response.json().get('error') if response.content else None
+            if error == 'authorization_pending':
+                continue
+            if error == 'slow_down':
+                interval += 5
+                continue
+            if error is None:
+                response.raise_for_status()
+            raise AuthorizationError(f"{error}: {response.json().get('error_description', '')}")
+        raise AuthorizationError(f"Device code not redeemed within {self.timeout:g}s")
+
+    def save(self, account: str, tokens: Dict) -> AccountToken:
+        """Write a token response to the store"""
+        if 'refresh_token' not in tokens:
+            raise AuthorizationError("Token response has no refresh_token, was offline_access granted?")
+        token = AccountToken(account, tokens['refresh_token'])
+        if 'access_token' in tokens:
+            token.access_token = tokens['access_token']
+            token.expires_at = time.time() + tokens['expires_in']
+        self.token_store.save(token)
+        return token
+
+    def provision(self, accounts: List[Account], device_code: bool = False) -> Dict:
+        """Sign in and store tokens for all accounts, `workers` at a time
+
+        Returns:
+            Dict with the 'provisioned' account names, 'failed' account
+            errors and 'elapsed' seconds
+        """
+        start = time.monotonic()
+        browser = None
+        if not device_code:
+            from DrissionPage import Chromium
+            browser = Chromium()
+
+        def provision_one(account: Account) -> Optional[str]:
+            name, login_hint = account
+            try:
+                if device_code:
+                    tokens = self.authorize_device_code(name, login_hint)
+                else:
+                    tokens = self.authorize_browser(browser, name, login_hint)
+                self.save(name, tokens)
+            except Exception as e:
+                logger.error(f"[{name}] Provisioning failed: {e}")
+                return str(e) or type(e).__name__
+            logger.info(f"[{name}] Successfully obtained refresh_token!")
+            return None
+
+        try:
+            with ThreadPoolExecutor(self.workers, thread_name_prefix='provision') as pool:
+                errors = list(pool.map(provision_one, accounts))
         finally:
-            browser.quit()
-        
-    except Exception as e:
-        logger.error(f"Program execution error: {e}")
-        raise
+            if browser is not None:
+                browser.quit()
+
+        failed = {name: error for (name, _), error in zip(accounts, errors) if error is not None}
+        return {
+            'provisioned': [name for name, _ in accounts if name not in failed],
+            'failed': failed,
+            'elapsed': time.monotonic() - start
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sign accounts in and store their refresh tokens')
+    parser.add_argument('--account', action='append', default=[], metavar='NAME[=EMAIL]',
+                        help='Account to provision, optionally with a login hint; repeatable')
+    parser.add_argument('--accounts', metavar='FILE', help="File of 'name [email]' lines")
+    parser.add_argument('--device-code', action='store_true', help='Use the device code flow instead of a browser')
+    parser.add_argument('--workers', type=int, help='Accounts signing in at the same time')
+    parser.add_argument('--timeout', type=float, help='Seconds each account has to sign in')
+    parser.add_argument('--skip-existing', action='store_true', help='Skip accounts that already have a refresh token')
+    args = parser.parse_args()
+
+    config = mail_api.load_config()
+    configure_logging(config)
+    accounts = parse_accounts(account.replace('=', ' ', 1) for account in args.account)
+    if args.accounts:
+        with open(args.accounts, 'r', encoding='utf-8') as f:
+            accounts.extend(parse_accounts(f))
+    if not accounts:
+        accounts = [('default', None)]
+
+    token_store = open_token_store(config)
+    session = create_session(config)
+    try:
+        if args.skip_existing:
+            existing = {name for name, token in token_store.load_all().items() if token.refresh_token}
+            accounts = [account for account in accounts if account[0] not in existing]
+        provisioner = Provisioner(
+            mail_api.settings.client_id,
+            config.get('microsoft', 'redirect_uri', fallback='http://localhost:8000/'),
+            token_store,
+            session=session,
+            proxy_resolver=ProxyResolver.from_config(config),
+            timeout=args.timeout or config.getfloat('provisioning', 'timeout', fallback=300),
+            workers=args.workers or config.getint('provisioning', 'workers', fallback=4),
+            request_timeout=get_timeout(config)
+        )
+        logger.info(f"Provisioning {len(accounts)} accounts with {provisioner.workers} workers")
+        summary = provisioner.provision(accounts, device_code=args.device_code)
+    finally:
+        session.close()
+        token_store.close()
+
+    print(f"Provisioned {len(summary['provisioned'])} of {len(accounts)} accounts in {summary['elapsed']:.1f}s")
+    for name, error in summary['failed'].items():
+        print(f"  {name}: {error}")
+    if summary['failed']:
+        raise SystemExit(1)
 
 if __name__ == '__main__':
     main()
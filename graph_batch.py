@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Microsoft Graph JSON Batching
+Bundles up to 20 Graph operations into a single $batch round trip
+"""
+
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+from urllib.parse import quote, urlencode
+
+import requests
+
+import mail_api
+from mail_api import EmailClient, build_email_message, build_message_query
+from throttling import THROTTLE_STATUSES
+
+logger = logging.getLogger(__name__)
+
+# Largest number of requests Graph accepts in one $batch call
+MAX_BATCH_SIZE = 20
+
+
+def encode_query(query_params: Dict) -> str:
+    """Encode query parameters for a batch item URL, keeping $ and , readable"""
+    return urlencode(query_params, quote_via=quote, safe='$,')
+
+
+class GraphBatchError(Exception):
+    """A single batched request failed"""
+
+    def __init__(self, status: int, body: Optional[Dict]):
+        error = (body or {}).get('error', {})
+        super().__init__(f"Batch request failed with status {status}: {error.get('message', '')}")
+        self.status = status
+        self.code = error.get('code')
+        self.body = body
+
+
+class GraphBatch:
+    """Queue Graph requests and send them as JSON $batch requests
+
+    Each queued operation returns a concurrent.futures.Future that resolves
+    to the same value the matching EmailClient method returns, or raises
+    GraphBatchError for that item alone. Queued requests are sent when
+    `max_size` are pending, every `flush_interval` seconds if set, on
+    flush() and when leaving the context manager:
+
+        with GraphBatch(client) as batch:
+            sent = [batch.send_email([to], subject, content) for to in recipients]
+        for future in sent:
+            future.result()
+
+    Args:
+        client: Email client used for authentication and HTTP
+        max_size: Requests per $batch call, at most 20
+        flush_interval: Optional seconds between background flushes
+    """
+
+    def __init__(self, client: EmailClient, max_size: int = MAX_BATCH_SIZE,
+                 flush_interval: Optional[float] = None):
+        self.client = client
+        self.max_size = max(1, min(max_size, MAX_BATCH_SIZE))
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._closed = threading.Event()
+        self._flusher = None
+        if flush_interval:
+            self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        """Send everything still queued and stop the background flusher"""
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+    def add(self, method: str, url: str, body: Optional[Dict] = None, headers: Optional[Dict] = None,
+            transform: Optional[Callable] = None) -> Future:
+        """Queue a request
+
+        Args:
+            method: HTTP method
+            url: Graph URL relative to the API version, e.g. '/me/messages/{id}'
+            body: Optional JSON body
+            headers: Optional request headers
+            transform: Optional function turning the response body into the future's result
+        """
+        request = {'id': str(next(self._ids)), 'method': method, 'url': url}
+        if body is not None:
+            request['body'] = body
+            headers = dict(headers or {})
+            headers.setdefault('Content-Type', 'application/json')
+        if headers:
+            request['headers'] = headers
+
+        future = Future()
+        with self._lock:
+            self._pending.append((request, future, transform))
+            full = len(self._pending) >= self.max_size
+        if full:
+            self.flush()
+        return future
+
+    def send_email(self, to_recipients: List[str], subject: str, content: str, is_html: bool = False) -> Future:
+        """Queue an email, the future resolves to True once it is accepted"""
+        return self.add(
+            'POST', '/me/sendMail',
+            body=build_email_message(to_recipients, subject, content, is_html),
+            transform=lambda body: True
+        )
+
+    def get_messages(self, folder_id: str = 'inbox', top: int = 10, select: Optional[List[str]] = None,
+                     body: str = 'text', filter: Optional[str] = None, search: Optional[str] = None) -> Future:
+        """Queue a read of the newest messages of a folder, resolving to a list of messages
+
+        Projection and filtering arguments are the same as for EmailClient.get_messages.
+        """
+        query_params, prefer = build_message_query(select, body, filter, search)
+        query_params['$top'] = min(top, mail_api.MAX_PAGE_SIZE)
+        return self.add(
+            'GET', f'/me/mailFolders/{folder_id}/messages?{encode_query(query_params)}',
+            headers={'Prefer': prefer} if prefer else None,
+            transform=lambda body: body['value']
+        )
+
+    def get_message(self, message_id: str, select: Optional[List[str]] = None, body: str = 'text') -> Future:
+        """Queue a read of a single message, resolving to the message
+
+        Use with EmailClient.get_messages(body='none') to list headers first
+        and then load only the bodies that are needed, 20 per round trip.
+        """
+        query_params, prefer = build_message_query(select, body, orderby=None)
+        return self.add('GET', f'/me/messages/{message_id}?{encode_query(query_params)}',
+                        headers={'Prefer': prefer} if prefer else None)
+
+    def move_message(self, message_id: str, destination_id: str) -> Future:
+        """Queue a move of a message to another folder, resolving to the message's new ID
+
+        Args:
+            message_id: Message to move
+            destination_id: Folder ID or well-known name such as 'inbox'
+        """
+        return self.add('POST', f'/me/messages/{message_id}/move', body={'destinationId': destination_id},
+                        transform=lambda body: body['id'])
+
+    def flush(self) -> None:
+        """Send all queued requests now"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for start in range(0, len(pending), self.max_size):
+            self._send(pending[start:start + self.max_size])
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Background batch flush failed: {e}")
+
+    def _send(self, items: List, retry_auth: bool = True, attempt: int = 0) -> None:
+        """Send one $batch request and resolve the futures of its items
+
+        Items throttled individually inside the batch are sent again in a
+        smaller batch once the longest Retry-After among them has passed.
+        """
+        try:
+            self.client.ensure_token_valid()
+            headers = {
+                'Authorization': f'Bearer {self.client.access_token}',
+                'Content-Type': 'application/json'
+            }
+            response = self.client._request(
+                'POST',
+                f'{mail_api.GRAPH_API_ENDPOINT}/$batch',
+                headers=headers,
+                json={'requests': [request for request, _, _ in items]}
+            )
+            if response.status_code == 401 and retry_auth:
+                self.client.refresh_access_token()
+                return self._send(items, retry_auth=False, attempt=attempt)
+            response.raise_for_status()
+            responses = {item['id']: item for item in response.json().get('responses', [])}
+        except requests.RequestException as e:
+            logger.error(f"Failed to send batch: {e}")
+            for _, future, _ in items:
+                future.set_exception(e)
+            return
+
+        policy = self.client.retry_policy
+        throttled = []
+        delay = 0.0
+        for item in items:
+            request, future, transform = item
+            result = responses.get(request['id'])
+            retry_after = (result.get('headers') or {}).get('Retry-After') if result is not None else None
+            if result is not None and policy.should_retry_status(request['method'], result['status'], attempt,
+                                                                 retry_after):
+                if result['status'] in THROTTLE_STATUSES:
+                    self.client.retry_metrics.increment('throttled')
+                throttled.append(item)
+                delay = max(delay, policy.delay(attempt, retry_after))
+            elif result is None:
+                future.set_exception(GraphBatchError(0, {'error': {'message': 'Missing from batch response'}}))
+            elif result['status'] >= 400:
+                future.set_exception(GraphBatchError(result['status'], result.get('body')))
+            else:
+                body = result.get('body')
+                try:
+                    future.set_result(transform(body) if transform else body)
+                except Exception as e:
+                    future.set_exception(e)
+
+        if throttled:
+            self.client.retry_metrics.increment('retries', len(throttled))
+            logger.warning(f"{len(throttled)} batched requests throttled, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            self._send(throttled, attempt=attempt + 1)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Request Instrumentation
+Latency histograms, payload sizes and token refresh timings for Graph calls,
+with hooks for custom sinks, an OpenMetrics text exporter and JSON logging
+"""
+
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from types import ModuleType
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from throttling import RetryMetrics
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# Collections whose next path segment is an id, replaced by {id} in endpoint labels
+_ID_COLLECTIONS = frozenset(['messages', 'mailFolders', 'childFolders', 'attachments', 'subscriptions', 'users'])
+_VERSION = re.compile(r'^(v1\.0|beta)$')
+# Key segments such as Messages('AAMk...') in upload session URLs
+_KEY_SEGMENT = re.compile(r'\(.*\)')
+
+
+def endpoint_label(url: str) -> str:
+    """Reduce a request URL to a low-cardinality endpoint name, e.g. 'me/messages/{id}'"""
+    parts = [part for part in urlsplit(url).path.split('/') if part]
+    if parts and _VERSION.match(parts[0]):
+        parts = parts[1:]
+    elif parts and parts[-1] == 'token':
+        return 'token'
+    elif parts and parts[0] == 'upload':
+        return 'upload'
+    labels = []
+    previous = None
+    for part in parts:
+        labels.append('{id}' if previous in _ID_COLLECTIONS else _KEY_SEGMENT.sub('({id})', part))
+        previous = part
+    return '/'.join(labels) or '/'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Histogram:
+    """Cumulative-bucket histogram, one series per label set"""
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...], unit: str = ''):
+        self.name = name
+        self.help = help
+        self.unit = unit
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self) -> Dict[Tuple, Dict]:
+        """Per label set: cumulative bucket counts, sum and count"""
+        with self._lock:
+            series = dict((key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items())
+        result = {}
+        for key, (counts, total, count) in series.items():
+            cumulative = []
+            running = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                running += bucket_count
+                cumulative.append((bound, running))
+            result[key] = {'buckets': cumulative, 'sum': total, 'count': count}
+        return result
+
+    def expose(self) -> List[str]:
+        lines = [f'# TYPE {self.name} histogram', f'# HELP {self.name} {self.help}']
+        if self.unit:
+            lines.insert(1, f'# UNIT {self.name} {self.unit}')
+        for key, series in sorted(self.snapshot().items()):
+            for bound, count in series['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', le))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+class Instrumentation:
+    """Collects metrics of every Graph request made by the clients sharing it
+
+    Records request latency per endpoint, method and status, request and
+    response sizes, token refresh durations and, through `retry_metrics`,
+    the retry, throttle and rate limit counters. Hooks receive every event
+    as a dict, e.g. to forward them to another metrics system.
+    """
+
+    def __init__(self):
+        self.retry_metrics = RetryMetrics()
+        self.request_latency = Histogram(
+            'graph_request_duration_seconds', 'Graph request latency per attempt', LATENCY_BUCKETS, 'seconds')
+        self.request_size = Histogram(
+            'graph_request_size_bytes', 'Graph request body size', SIZE_BUCKETS, 'bytes')
+        self.response_size = Histogram(
+            'graph_response_size_bytes', 'Graph response body size', SIZE_BUCKETS, 'bytes')
+        self.token_refresh = Histogram(
+            'token_refresh_duration_seconds', 'Access token refresh latency', LATENCY_BUCKETS, 'seconds')
+        self._hooks = []
+
+    @classmethod
+    def from_config(cls, config) -> 'Instrumentation':
+        """Create instrumentation from the optional [metrics] section of config.txt
+
+        With log_format = json every event is also logged at INFO, with its
+        fields attached for JsonFormatter. Logging itself is left to the
+        application, see configure_logging().
+        """
+        instrumentation = cls()
+        if config.get('metrics', 'log_format', fallback='text') == 'json':
+            instrumentation.add_hook(log_event)
+        return instrumentation
+
+    def add_hook(self, hook: Callable[[Dict], None]) -> None:
+        """Call `hook(event)` for every recorded event"""
+        self._hooks.append(hook)
+
+    def emit(self, event: Dict) -> None:
+        for hook in self._hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                logger.error(f"Instrumentation hook failed: {e}")
+
+    def record_request(self, method: str, url: str, status: Optional[int], duration: float,
+                       request_bytes: int = 0, response_bytes: Optional[int] = None, attempt: int = 0,
+                       account: Optional[str] = None) -> None:
+        """Record one HTTP attempt; status is None when no response arrived"""
+        endpoint = endpoint_label(url)
+        status_label = str(status) if status is not None else 'error'
+        self.request_latency.observe(duration, method=method, endpoint=endpoint, status=status_label)
+        if request_bytes:
+            self.request_size.observe(request_bytes, method=method, endpoint=endpoint)
+        if response_bytes is not None:
+            self.response_size.observe(response_bytes, method=method, endpoint=endpoint)
+        if self._hooks:
+            self.emit({
+                'event': 'graph_request', 'method': method, 'endpoint': endpoint, 'status': status,
+                'duration': round(duration, 6), 'request_bytes': request_bytes,
+                'response_bytes': response_bytes, 'attempt': attempt, 'account': account
+            })
+
+    def record_token_refresh(self, account: str, duration: float, success: bool) -> None:
+        outcome = 'success' if success else 'failure'
+        self.token_refresh.observe(duration, outcome=outcome)
+        if self._hooks:
+            self.emit({'event': 'token_refresh', 'account': account, 'duration': round(duration, 6),
+                       'outcome': outcome})
+
+    def time_token_refresh(self, account: str) -> 'RefreshTimer':
+        """Context manager timing a token refresh"""
+        return RefreshTimer(self, account)
+
+    def counters(self) -> Dict[str, int]:
+        return self.retry_metrics.snapshot()
+
+    def summary(self) -> Dict:
+        """Per-endpoint request count, p50 and p99 latency, for logs and benchmarks"""
+        by_endpoint = defaultdict(lambda: {'count': 0, 'errors': 0})
+        for key, series in self.request_latency.snapshot().items():
+            labels = dict(key)
+            entry = by_endpoint[f"{labels['method']} {labels['endpoint']}"]
+            entry['count'] += series['count']
+            if not labels['status'].startswith('2') and not labels['status'].startswith('3'):
+                entry['errors'] += series['count']
+        for name, entry in by_endpoint.items():
+            method, endpoint = name.split(' ', 1)
+            entry['p50'] = self._merged_quantile(0.5, method, endpoint)
+            entry['p99'] = self._merged_quantile(0.99, method, endpoint)
+        return {'endpoints': dict(by_endpoint), 'counters': self.counters()}
+
+    def _merged_quantile(self, q: float, method: str, endpoint: str) -> Optional[float]:
+        merged = None
+        total = 0
+        for key, series in self.request_latency.snapshot().items():
+            labels = dict(key)
+            if labels['method'] != method or labels['endpoint'] != endpoint:
+                continue
+            counts = [count for _, count in series['buckets']]
+            merged = counts if merged is None else [a + b for a, b in zip(merged, counts)]
+            total += series['count']
+        if not total:
+            return None
+        for bound, count in zip(self.request_latency.buckets + (float('inf'),), merged):
+            if count >= q * total:
+                return bound
+        return None
+
+    def expose(self) -> str:
+        """Render all metrics in the OpenMetrics text format"""
+        lines = []
+        for name, value in sorted(self.counters().items()):
+            metric = f'mail_{name}'
+            lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric}_total {value}')
+        for histogram in (self.request_latency, self.request_size, self.response_size, self.token_refresh):
+            lines.extend(histogram.expose())
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+class RefreshTimer:
+    def __init__(self, instrumentation: Instrumentation, account: str):
+        self.instrumentation = instrumentation
+        self.account = account
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.record_token_refresh(self.account, time.perf_counter() - self._start, exc_type is None)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_instrumentation(config=None) -> Instrumentation:
+    """Get the process-wide instrumentation shared by clients created without one"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Instrumentation.from_config(config) if config is not None else Instrumentation()
+        return _default
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as one JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        event = getattr(record, 'event', None)
+        if event is not None:
+            entry.update(event)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def enable_json_logging(level: int = logging.INFO) -> None:
+    """Switch the root logger to JSON lines on stderr"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+
+def configure_logging(config, level: int = logging.INFO) -> None:
+    """Set up logging for a command line entry point
+
+    Writes JSON lines when [metrics] log_format = json and plain text
+    otherwise. Only scripts call this; the library never touches the root logger.
+    """
+    if config.get('metrics', 'log_format', fallback='text') == 'json':
+        enable_json_logging(level)
+    else:
+        logging.basicConfig(level=level)
+
+
+def log_event(event: Dict) -> None:
+    """Hook logging each event, with its fields attached for JsonFormatter"""
+    logger.info(event['event'], extra={'event': event})
+
+
+class _InstrumentationModule(ModuleType):
+    # The HTTP server lives in its own module so importing this one stays cheap.
+    # Module __getattr__ needs Python 3.7, a method on the module's class does not
+    def __getattr__(self, name):
+        if name in ('MetricsHandler', 'MetricsServer'):
+            import metrics_server
+            return getattr(metrics_server, name)
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+sys.modules[__name__].__class__ = _InstrumentationModule
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Junk Triage
+Scores the junk folder page by page with a sender, domain and keyword rule
+model and moves the messages it rescues back to the inbox in $batch calls
+"""
+
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import mail_api
+from graph_batch import MAX_BATCH_SIZE, GraphBatch
+from instrumentation import configure_logging
+from mail_api import EmailClient
+from throttling import MAILBOX_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# Fields the rule model reads from each message
+TRIAGE_FIELDS = ('subject', 'from', 'bodyPreview', 'receivedDateTime')
+
+RULE_KEYS = ('threshold', 'senders', 'domains', 'keywords')
+
+
+def sender_address(message: Dict) -> str:
+    """Lowercase sender address of a Graph message, '' if it has none"""
+    return (((message.get('from') or {}).get('emailAddress') or {}).get('address') or '').strip().lower()
+
+
+def _normalize_phrase(phrase: str) -> str:
+    return ' '.join(phrase.lower().split())
+
+
+class RuleModel:
+    """Additive sender, domain and keyword scores deciding which junk is legitimate
+
+    A message scores the weight of its sender address, plus the weights of
+    its sender's domain and every parent domain, plus the weight of each
+    distinct keyword in its subject or preview. Messages scoring at least
+    `threshold` are rescued; negative weights keep a message in junk.
+
+    Weights are compiled once into dict lookups and a single keyword regex,
+    so scoring a page costs a few hash lookups and one scan per message.
+    Keywords match case-insensitively as whole words, and a phrase wins
+    over the shorter keywords it contains.
+
+    Args:
+        senders: Weight per sender address
+        domains: Weight per domain, which also applies to its subdomains
+        keywords: Weight per word or phrase
+        threshold: Lowest score of a rescued message
+    """
+
+    def __init__(self, senders: Optional[Dict[str, float]] = None, domains: Optional[Dict[str, float]] = None,
+                 keywords: Optional[Dict[str, float]] = None, threshold: float = 1.0):
+        self.senders = dict((address.strip().lower(), float(weight))
+                            for address, weight in (senders or {}).items())
+        self.domains = dict((domain.strip().lower().lstrip('@.'), float(weight))
+                            for domain, weight in (domains or {}).items())
+        self.keywords = dict((_normalize_phrase(keyword), float(weight))
+                             for keyword, weight in (keywords or {}).items() if keyword.strip())
+        self.threshold = float(threshold)
+        self._domain_scores = {}
+        self._pattern = None
+        if self.keywords:
+            alternatives = sorted(self.keywords, key=len, reverse=True)
+            self._pattern = re.compile(
+                r'(?<!\w)(?:' + '|'.join(r'\s+'.join(map(re.escape, keyword.split())) for keyword in alternatives)
+                + r')(?!\w)',
+                re.IGNORECASE
+            )
+
+    @classmethod
+    def load(cls, path: str, threshold: Optional[float] = None) -> 'RuleModel':
+        """Load a model from a JSON file
+
+            {"threshold": 2,
+             "senders": {"billing@contoso.com": 5},
+             "domains": {"contoso.com": 3, "promo.contoso.com": -4},
+             "keywords": {"invoice": 1.5, "unsubscribe": -1}}
+
+        Args:
+            path: Rules file
+            threshold: Overrides the file's threshold if set
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            rules = json.load(f)
+        unknown = set(rules) - set(RULE_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown keys in rules file {path}: {', '.join(sorted(unknown))}")
+        if threshold is not None:
+            rules['threshold'] = threshold
+        return cls(**rules)
+
+    def domain_score(self, domain: str) -> float:
+        """Summed weights of a domain and its parent domains"""
+        score = self._domain_scores.get(domain)
+        if score is None:
+            labels = domain.split('.')
+            score = sum(self.domains.get('.'.join(labels[i:]), 0.0) for i in range(len(labels)))
+            self._domain_scores[domain] = score
+        return score
+
+    def keyword_score(self, text: str) -> float:
+        """Summed weights of the distinct keywords in a text"""
+        if self._pattern is None or not text:
+            return 0.0
+        found = set(_normalize_phrase(match) for match in self._pattern.findall(text))
+        return sum(self.keywords[keyword] for keyword in found)
+
+    def score_batch(self, messages: Iterable[Dict]) -> List[float]:
+        """Score a page of Graph messages"""
+        senders = self.senders
+        scores = []
+        for message in messages:
+            address = sender_address(message)
+            score = senders.get(address, 0.0)
+            if '@' in address:
+                score += self.domain_score(address.rpartition('@')[2])
+            score += self.keyword_score(f"{message.get('subject') or ''}\n{message.get('bodyPreview') or ''}")
+            scores.append(score)
+        return scores
+
+    def score(self, message: Dict) -> float:
+        """Score one Graph message"""
+        return self.score_batch([message])[0]
+
+    def explain(self, message: Dict) -> List[Tuple[str, float]]:
+        """Rules that matched a message, as (rule, weight) pairs"""
+        rules = []
+        address = sender_address(message)
+        if address in self.senders:
+            rules.append((f'sender:{address}', self.senders[address]))
+        labels = address.rpartition('@')[2].split('.') if '@' in address else []
+        for i in range(len(labels)):
+            domain = '.'.join(labels[i:])
+            if domain in self.domains:
+                rules.append((f'domain:{domain}', self.domains[domain]))
+        if self._pattern is not None:
+            text = f"{message.get('subject') or ''}\n{message.get('bodyPreview') or ''}"
+            for keyword in sorted(set(_normalize_phrase(match) for match in self._pattern.findall(text))):
+                rules.append((f'keyword:{keyword}', self.keywords[keyword]))
+        return rules
+
+
+class JunkTriage:
+    """Rescue legitimate messages from the junk folder
+
+    run() pages through the folder fetching only the fields the model reads,
+    up to 1000 messages per request, and scores each page as it arrives.
+    Rescued messages are moved once the scan is done, as moving them
+    earlier would shift the offsets of the pages still to come. Moves go
+    out as $batch calls of 20, `workers` of them at a time, so thousands of
+    messages take a few dozen round trips. Graph serves only
+    MAILBOX_CONCURRENCY requests per mailbox at once, so `workers` is
+    capped at that, and moves it throttles anyway are retried by GraphBatch.
+
+    Args:
+        client: Email client of the mailbox
+        model: Rule model deciding what to rescue
+        folder_id: Folder to triage, defaults to 'junkemail'
+        destination_id: Folder rescued messages are moved to, defaults to 'inbox'
+        page_size: Messages requested per page, at most 1000
+        workers: $batch calls sent at the same time, at most MAILBOX_CONCURRENCY
+    """
+
+    def __init__(self, client: EmailClient, model: RuleModel, folder_id: str = 'junkemail',
+                 destination_id: str = 'inbox', page_size: int = mail_api.MAX_PAGE_SIZE,
+                 workers: int = MAILBOX_CONCURRENCY):
+        self.client = client
+        self.model = model
+        self.folder_id = folder_id
+        self.destination_id = destination_id
+        self.page_size = min(page_size, mail_api.MAX_PAGE_SIZE)
+        if workers > MAILBOX_CONCURRENCY:
+            logger.warning(f"Graph serves {MAILBOX_CONCURRENCY} concurrent requests per mailbox, "
+                           f"using {MAILBOX_CONCURRENCY} workers instead of {workers}")
+        self.workers = max(1, min(workers, MAILBOX_CONCURRENCY))
+
+    def scan(self, limit: Optional[int] = None) -> Tuple[int, List[Dict]]:
+        """Score the folder, newest first
+
+        Args:
+            limit: Maximum number of messages to score, defaults to all
+
+        Returns:
+            Tuple of (messages scored, rescued messages as dicts with id,
+            sender, subject, receivedDateTime and score)
+        """
+        messages = self.client.iter_messages(self.folder_id, page_size=self.page_size, limit=limit,
+                                             select=list(TRIAGE_FIELDS), body='preview')
+        scanned = 0
+        rescued = []
+        page = []
+        for message in messages:
+            page.append(message)
+            if len(page) >= self.page_size:
+                rescued.extend(self._score_page(page))
+                scanned += len(page)
+                page = []
+        if page:
+            rescued.extend(self._score_page(page))
+            scanned += len(page)
+        return scanned, rescued
+
+    def _score_page(self, page: List[Dict]) -> List[Dict]:
+        threshold = self.model.threshold
+        return [
+            {
+                'id': message['id'],
+                'sender': sender_address(message),
+                'subject': message.get('subject'),
+                'receivedDateTime': message.get('receivedDateTime'),
+                'score': score
+            }
+            for message, score in zip(page, self.model.score_batch(page)) if score >= threshold
+        ]
+
+    def move(self, message_ids: List[str]) -> Tuple[int, List[Tuple[str, str]]]:
+        """Move messages to the destination folder in $batch calls
+
+        Returns:
+            Tuple of (messages moved, (message ID, error) pairs of failed moves)
+        """
+        chunks = [message_ids[start:start + MAX_BATCH_SIZE] for start in range(0, len(message_ids), MAX_BATCH_SIZE)]
+        if not chunks:
+            return 0, []
+        with ThreadPoolExecutor(min(self.workers, len(chunks)), thread_name_prefix='junk-triage') as pool:
+            results = list(pool.map(self._move_chunk, chunks))
+        moved = sum(count for count, _ in results)
+        failed = [failure for _, failures in results for failure in failures]
+        return moved, failed
+
+    def _move_chunk(self, message_ids: List[str]) -> Tuple[int, List[Tuple[str, str]]]:
+        with GraphBatch(self.client) as batch:
+            futures = [(message_id, batch.move_message(message_id, self.destination_id))
+                       for message_id in message_ids]
+        moved = 0
+        failed = []
+        for message_id, future in futures:
+            try:
+                future.result()
+                moved += 1
+            except Exception as e:
+                failed.append((message_id, str(e)))
+        return moved, failed
+
+    def run(self, limit: Optional[int] = None, dry_run: bool = False) -> Dict:
+        """Scan the folder and move the rescued messages
+
+        Args:
+            limit: Maximum number of messages to score, defaults to all
+            dry_run: Only report what would be rescued
+
+        Returns:
+            Summary dict with 'scanned', 'rescued', 'moved' and 'failed'
+            counts, 'elapsed' seconds, the rescued 'messages' and the
+            (message ID, error) pairs in 'errors'
+        """
+        start = time.monotonic()
+        scanned, rescued = self.scan(limit)
+        logger.info(f"Scored {scanned} messages in {self.folder_id}, {len(rescued)} to rescue")
+        moved, failed = (0, []) if dry_run else self.move([message['id'] for message in rescued])
+        for message_id, error in failed:
+            logger.warning(f"Failed to move message {message_id}: {error}")
+        summary = {
+            'scanned': scanned,
+            'rescued': len(rescued),
+            'moved': moved,
+            'failed': len(failed),
+            'elapsed': time.monotonic() - start,
+            'messages': rescued,
+            'errors': failed
+        }
+        logger.info(f"Junk triage finished: {moved} moved to {self.destination_id}, {len(failed)} failed "
+                    f"in {summary['elapsed']:.1f}s")
+        return summary
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Move legitimate messages out of the junk folder')
+    parser.add_argument('--rules', help='Rules file, defaults to [junk_triage] rules')
+    parser.add_argument('--threshold', type=float, help="Lowest score of a rescued message, overrides the rules file's")
+    parser.add_argument('--limit', type=int, help='Score at most this many of the newest messages')
+    parser.add_argument('--workers', type=int,
+                        help=f'$batch calls sent at the same time, at most {MAILBOX_CONCURRENCY}')
+    parser.add_argument('--dry-run', action='store_true', help='Only list the messages that would be rescued')
+    args = parser.parse_args()
+
+    config = mail_api.load_config()
+    configure_logging(config)
+    rules = args.rules or config.get('junk_triage', 'rules', fallback='junk_rules.json')
+    if not os.path.exists(rules):
+        parser.error(f"rules file {rules} not found; copy junk_rules.example.json to {rules} "
+                     f"and adjust its weights, or pass --rules")
+    threshold = args.threshold
+    if threshold is None and config.has_option('junk_triage', 'threshold'):
+        threshold = config.getfloat('junk_triage', 'threshold')
+    model = RuleModel.load(rules, threshold=threshold)
+    workers = args.workers or config.getint('junk_triage', 'workers', fallback=MAILBOX_CONCURRENCY)
+    page_size = config.getint('junk_triage', 'page_size', fallback=mail_api.MAX_PAGE_SIZE)
+
+    with EmailClient() as client:
+        triage = JunkTriage(client, model, page_size=page_size, workers=workers)
+        summary = triage.run(limit=args.limit, dry_run=args.dry_run)
+    for message in summary['messages']:
+        print(f"{message['score']:6.1f}  {message['sender']}  {message['subject']}")
+    verb = 'Would move' if args.dry_run else 'Moved'
+    count = summary['rescued'] if args.dry_run else summary['moved']
+    print(f"{verb} {count} of {summary['scanned']} messages to the inbox ({summary['failed']} failed)")
+
+
+if __name__ == '__main__':
+    main()
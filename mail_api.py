@@ -4,60 +4,303 @@ Microsoft Mail Processing Script
 Used for sending and receiving emails with Microsoft account
 """
 
-import requests
 import logging
 from datetime import datetime
-from typing import Dict, List
-import configparser
-import winreg
+from typing import Dict, Iterator, List, Optional, Tuple
+import json
+import os
+import sys
 import time
+from types import ModuleType
+from urllib.parse import urlencode
 
-def get_proxy():
-    try:
-        with winreg.OpenKey(winreg.HKEY_CURRENT_USER, r"Software\Microsoft\Windows\CurrentVersion\Internet Settings") as key:
-            proxy_enable, _ = winreg.QueryValueEx(key, "ProxyEnable")
-            proxy_server, _ = winreg.QueryValueEx(key, "ProxyServer")
-            
-            if proxy_enable and proxy_server:
-                proxy_parts = proxy_server.split(":")
-                if len(proxy_parts) == 2:
-                    return {"http": f"http://{proxy_server}", "https": f"http://{proxy_server}"}
-    except WindowsError:
-        pass
-    return {"http": None, "https": None}
+from attachments import (ATTACHMENT_SELECT, DOWNLOAD_CHUNK_SIZE, LARGE_ATTACHMENT_SIZE, UPLOAD_CHUNK_SIZE,
+                         UploadSession, file_attachment, guess_content_type, split_attachments)
+from content_cache import ContentCache
+from instrumentation import Instrumentation, configure_logging, get_instrumentation
+from mail_message import JsonPageStream, Message
+from mail_query import QUERY_FIELDS, MessageQuery, quote_search
+from message_store import MessageStore
+from proxy_resolver import ProxyResolver
+from settings import Settings, lazy_import
+from throttling import RateLimiter, RetryMetrics, RetryPolicy, THROTTLE_STATUSES
+from token_store import AccountToken, TokenStore, open_token_store
+
+# Loaded on first attribute access, keeping the import of this module cheap
+requests = lazy_import('requests')
+
+logger = logging.getLogger(__name__)
+
+# config.txt, read when the first client is created rather than at import
+settings = Settings()
 
 def load_config():
-    """Load configuration from config.txt"""
-    config = configparser.ConfigParser()
-    config.read('config.txt', encoding='utf-8')
-    return config
+    """Get the configuration from config.txt
+
+    Every module reads configuration through this function. The parser is
+    shared and re-read only when the file changes, so treat it as read-only
+    unless passing it to save_config().
+    """
+    return settings.config
 
 def save_config(config):
     """Save configuration to config.txt"""
-    with open('config.txt', 'w', encoding='utf-8') as f:
-        config.write(f)
+    settings.save(config)
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+class _MailApiModule(ModuleType):
+    # CLIENT_ID used to be read from config.txt at import time. A property on
+    # the module's class keeps it lazy, since module __getattr__ needs Python 3.7
+    @property
+    def CLIENT_ID(self) -> str:
+        return settings.client_id
+
+sys.modules[__name__].__class__ = _MailApiModule
+
+def create_session(config) -> 'requests.Session':
+    """Create a connection-pooled, keep-alive HTTP session
+    
+    Pool and keep-alive settings are read from the optional [http] section
+    of config.txt:
+    
+        pool_connections: Number of per-host connection pools to keep
+        pool_maxsize: Maximum connections kept alive per host
+        pool_block: Whether to wait for a free connection when a host's pool is full
+        keep_alive: Whether to reuse connections between requests
+    """
+    pool_connections = config.getint('http', 'pool_connections', fallback=10)
+    pool_maxsize = config.getint('http', 'pool_maxsize', fallback=10)
+    pool_block = config.getboolean('http', 'pool_block', fallback=False)
+    keep_alive = config.getboolean('http', 'keep_alive', fallback=True)
+    
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+def get_timeout(config) -> tuple:
+    """Get (connect, read) request timeout in seconds from the [http] section"""
+    connect_timeout = config.getfloat('http', 'connect_timeout', fallback=10)
+    read_timeout = config.getfloat('http', 'read_timeout', fallback=30)
+    return connect_timeout, read_timeout
+
+def build_email_message(to_recipients: List[str], subject: str, content: str, is_html: bool = False,
+                        attachments: Optional[List[Dict]] = None) -> Dict:
+    """Build the sendMail request body, optionally with inline fileAttachment resources"""
+    email_msg = {
+        'message': {
+            'subject': subject,
+            'body': {
+                'contentType': 'HTML' if is_html else 'Text',
+                'content': content
+            },
+            'toRecipients': [
+                {
+                    'emailAddress': {
+                        'address': recipient
+                    }
+                } for recipient in to_recipients
+            ]
+        }
+    }
+    if attachments:
+        email_msg['message']['attachments'] = attachments
+    return email_msg
 
-config = load_config()
-microsoft_config = config['microsoft']
+def build_message_query(select: Optional[List[str]] = None, body: str = 'text', filter: Optional[str] = None,
+                        search: Optional[str] = None,
+                        orderby: Optional[str] = 'receivedDateTime DESC') -> Tuple[Dict, Optional[str]]:
+    """Build message query parameters and Prefer header
+    
+    Args:
+        select: Message fields to return, defaults to subject, receivedDateTime and from
+        body: Body to include: 'none', 'preview' (bodyPreview), 'text' or 'html'
+        filter: Optional OData $filter expression
+        search: Optional KQL query, sent quoted as $search; Graph does not allow $orderby with it
+        orderby: $orderby expression, None for server order
+        
+    Returns:
+        Tuple of (query parameters, Prefer header or None)
+    """
+    if body not in BODY_MODES:
+        raise ValueError(f"body must be one of {', '.join(BODY_MODES)}, not {body!r}")
+    
+    fields = list(select) if select is not None else list(DEFAULT_SELECT)
+    if body == 'preview' and 'bodyPreview' not in fields:
+        fields.append('bodyPreview')
+    elif body in ('text', 'html') and 'body' not in fields:
+        fields.append('body')
+    
+    query_params = {'$select': ','.join(fields)}
+    if filter:
+        query_params['$filter'] = filter
+    if search:
+        query_params['$search'] = quote_search(search)
+    elif orderby:
+        query_params['$orderby'] = orderby
+    
+    prefer = f'outlook.body-content-type="{body}"' if body in ('text', 'html') else None
+    return query_params, prefer
 
-CLIENT_ID = microsoft_config['client_id']
 GRAPH_API_ENDPOINT = 'https://graph.microsoft.com/v1.0'
 TOKEN_URL = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
+# Largest $top Graph accepts for message collections
+MAX_PAGE_SIZE = 1000
+# Message fields returned when no $select is given
+DEFAULT_SELECT = ('subject', 'receivedDateTime', 'from')
+BODY_MODES = ('none', 'preview', 'text', 'html')
+FOLDER_SELECT = ('id', 'displayName', 'parentFolderId', 'childFolderCount', 'totalItemCount')
+# Bytes read at a time from streamed responses
+STREAM_CHUNK_SIZE = 65536
+
+
+class DeliveryUnknownError(Exception):
+    """Sending a draft failed in a way that does not tell whether the message went out
+
+    The draft is kept so it can be checked in the mailbox before sending again.
+    """
+
+    def __init__(self, draft_id: str, error: Exception):
+        super().__init__(f"Delivery of draft {draft_id} is unknown: {error}")
+        self.draft_id = draft_id
+        self.error = error
+
 
 class EmailClient:
-    def __init__(self):
+    def __init__(self, session: 'requests.Session' = None, proxy_resolver: ProxyResolver = None,
+                 token_manager=None, account: str = 'default', token_store: TokenStore = None,
+                 retry_policy: RetryPolicy = None, rate_limiter: RateLimiter = None,
+                 retry_metrics: RetryMetrics = None, cache: ContentCache = None,
+                 instrumentation: Instrumentation = None):
+        """Create email client
+        
+        Args:
+            session: Optional HTTP session to share between clients,
+                defaults to a new pooled session configured from config.txt
+            proxy_resolver: Optional proxy resolver to share between clients,
+                defaults to one configured from the [proxy] section of config.txt
+            token_manager: Optional token_manager.TokenManager supplying tokens,
+                defaults to the single [tokens] section of config.txt
+            account: Account this client acts as
+            token_store: Optional token store, defaults to the one selected by
+                the [token_store] section of config.txt
+            retry_policy: Optional retry policy, defaults to the [retry] section of config.txt
+            rate_limiter: Optional per-mailbox rate limiter to share between clients,
+                defaults to one configured from the [retry] section of config.txt
+            retry_metrics: Optional counters to share between clients
+            cache: Optional content cache for get_message and download_attachment, defaults
+                to the [cache] section of config.txt (disabled unless enabled = true)
+            instrumentation: Optional metrics collector, defaults to the
+                process-wide one from instrumentation.get_instrumentation()
+        """
         config = load_config()
-        if not config.has_section('tokens'):
-            config.add_section('tokens')
         self.config = config
-        self.refresh_token = config['tokens'].get('refresh_token', '')
-        self.access_token = config['tokens'].get('access_token', '')
-        expires_at_str = config['tokens'].get('expires_at', '1970-01-01 00:00:00')
-        self.expires_at = datetime.strptime(expires_at_str, '%Y-%m-%d %H:%M:%S').timestamp()
+        self._owns_session = session is None
+        self.session = session if session is not None else create_session(config)
+        self.timeout = get_timeout(config)
+        self.proxy_resolver = proxy_resolver if proxy_resolver is not None else ProxyResolver.from_config(config)
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy.from_config(config)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter.from_config(config)
+        self.instrumentation = instrumentation if instrumentation is not None else get_instrumentation(config)
+        self.retry_metrics = retry_metrics if retry_metrics is not None else RetryMetrics()
+        # Counters also add up in the instrumentation's totals
+        if self.retry_metrics.parent is None and self.retry_metrics is not self.instrumentation.retry_metrics:
+            self.retry_metrics.parent = self.instrumentation.retry_metrics
+        self._store = None
+        self._owns_cache = cache is None
+        self.cache = cache if cache is not None else ContentCache.from_config(config)
+        self.token_manager = token_manager
+        self.account = account
+        self._owns_token_store = token_store is None
+        self.token_store = token_store if token_store is not None else open_token_store(config)
+        token = self.token_store.load(account) or AccountToken(account, '')
+        self.refresh_token = token.refresh_token
+        self.access_token = token.access_token
+        self.expires_at = token.expires_at
+    
+    def __enter__(self):
+        return self
     
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def close(self) -> None:
+        """Close the HTTP session if it is owned by this client"""
+        if self._owns_session:
+            self.session.close()
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+        if self._owns_cache and self.cache is not None:
+            self.cache.close()
+            self.cache = None
+        if self._owns_token_store:
+            self.token_store.close()
+    
+    def _request(self, method: str, url: str, rate_limited: bool = True, **kwargs) -> 'requests.Response':
+        """Send an HTTP request through the pooled session
+        
+        Throttled (429/503) and transient (502/504) responses are retried
+        according to the retry policy, waiting for Retry-After when given.
+        Other methods than idempotent ones are only retried on 429/503 with
+        Retry-After, and never on connection errors.
+        
+        Args:
+            rate_limited: Whether the request counts against the mailbox's rate limit
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('proxies', self.proxy_resolver.resolve())
+        
+        attempt = 0
+        while True:
+            if rate_limited and self.rate_limiter.acquire(self.account) > 0:
+                self.retry_metrics.increment('rate_limited')
+            self.retry_metrics.increment('requests')
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.instrumentation.record_request(method, url, None, time.perf_counter() - start,
+                                                    attempt=attempt, account=self.account)
+                if not self.retry_policy.should_retry_error(method, attempt):
+                    raise
+                delay = self.retry_policy.delay(attempt)
+                self.retry_metrics.increment('retries')
+                logger.warning(f"{method} {url} failed ({e}), retrying in {delay:.1f}s")
+            else:
+                self._record(method, url, response, time.perf_counter() - start, attempt, kwargs.get('stream'))
+                retry_after = response.headers.get('Retry-After')
+                if not self.retry_policy.should_retry_status(method, response.status_code, attempt, retry_after):
+                    return response
+                if response.status_code in THROTTLE_STATUSES:
+                    self.retry_metrics.increment('throttled')
+                delay = self.retry_policy.delay(attempt, retry_after)
+                self.retry_metrics.increment('retries')
+                logger.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+    
+    def _record(self, method: str, url: str, response: 'requests.Response', duration: float, attempt: int,
+                stream: bool) -> None:
+        """Record a completed attempt; streamed bodies are sized from Content-Length"""
+        body = response.request.body
+        request_bytes = len(body) if isinstance(body, (bytes, str)) else 0
+        if stream:
+            length = response.headers.get('Content-Length')
+            response_bytes = int(length) if length and length.isdigit() else None
+        else:
+            response_bytes = len(response.content)
+        self.instrumentation.record_request(method, url, response.status_code, duration, request_bytes,
+                                            response_bytes, attempt, self.account)
+
     def is_token_expired(self) -> bool:
         """Check if access token is expired or about to expire"""
         buffer_time = 300
@@ -65,90 +308,531 @@ class EmailClient:
     
     def refresh_access_token(self) -> None:
         """Refresh access token"""
+        if self.token_manager is not None:
+            self._use_token(self.token_manager.refresh(self.account))
+            return
+        with self.instrumentation.time_token_refresh(self.account):
+            self._refresh_now()
+
+    def _refresh_now(self) -> None:
         refresh_params = {
-            'client_id': CLIENT_ID,
+            'client_id': settings.client_id,
             'refresh_token': self.refresh_token,
             'grant_type': 'refresh_token',
         }
         
         try:
-            response = requests.post(TOKEN_URL, data=refresh_params, proxies=get_proxy())
+            response = self._request('POST', TOKEN_URL, rate_limited=False, data=refresh_params)
             response.raise_for_status()
             tokens = response.json()
             
             self.access_token = tokens['access_token']
             self.expires_at = time.time() + tokens['expires_in']
-            expires_at_str = datetime.fromtimestamp(self.expires_at).strftime('%Y-%m-%d %H:%M:%S')
-            
-            self.config['tokens']['access_token'] = self.access_token
-            self.config['tokens']['expires_at'] = expires_at_str
-            
             if 'refresh_token' in tokens:
                 self.refresh_token = tokens['refresh_token']
-                self.config['tokens']['refresh_token'] = self.refresh_token
-            save_config(self.config)
+            self.token_store.save(AccountToken(self.account, self.refresh_token, self.access_token, self.expires_at))
         except requests.RequestException as e:
             logger.error(f"Failed to refresh access token: {e}")
             raise
 
     def ensure_token_valid(self):
         """Ensure token is valid"""
+        if self.token_manager is not None:
+            self._use_token(self.token_manager.get_token(self.account))
+            return
         if not self.access_token or self.is_token_expired():
             self.refresh_access_token()
 
-    def get_messages(self, folder_id: str = 'inbox', top: int = 10) -> List[Dict]:
+    def _use_token(self, token) -> None:
+        self.access_token = token.access_token
+        self.refresh_token = token.refresh_token
+        self.expires_at = token.expires_at
+
+    def get_messages(self, folder_id: str = 'inbox', top: int = 10, select: Optional[List[str]] = None,
+                     body: str = 'text', filter: Optional[str] = None, search: Optional[str] = None,
+                     orderby: Optional[str] = 'receivedDateTime DESC') -> List[Dict]:
         """Get messages from specified folder
         
         Args:
             folder_id: Folder ID, defaults to 'inbox'
             top: Number of messages to retrieve
+            select: Message fields to return, defaults to subject, receivedDateTime and from
+            body: Body to include: 'none', 'preview' (bodyPreview), 'text' or 'html'
+            filter: Optional OData $filter expression
+            search: Optional $search query, results then come in relevance order
+            orderby: $orderby expression, None for server order
+        """
+        page_size = min(top, MAX_PAGE_SIZE)
+        return list(self.iter_messages(folder_id, page_size=page_size, limit=top, select=select,
+                                       body=body, filter=filter, search=search, orderby=orderby))
+
+    def iter_messages(self, folder_id: str = 'inbox', page_size: int = 50, limit: Optional[int] = None,
+                      select: Optional[List[str]] = None, body: str = 'text', filter: Optional[str] = None,
+                      search: Optional[str] = None,
+                      orderby: Optional[str] = 'receivedDateTime DESC') -> Iterator[Dict]:
+        """Iterate over messages in specified folder, newest first
+        
+        Pages are requested lazily by following @odata.nextLink, so only one
+        page is held in memory at a time. Projection and filtering arguments
+        are the same as for get_messages.
+        
+        Args:
+            folder_id: Folder ID, defaults to 'inbox'
+            page_size: Number of messages requested per page, at most 1000
+            limit: Maximum number of messages to yield, defaults to all
+        """
+        if limit is not None and limit <= 0:
+            return
+        
+        url = f'{GRAPH_API_ENDPOINT}/me/mailFolders/{folder_id}/messages'
+        query_params, prefer = build_message_query(select, body, filter, search, orderby)
+        query_params['$top'] = min(page_size, MAX_PAGE_SIZE)
+        
+        count = 0
+        while url:
+            page = self._get_page(url, query_params, prefer=prefer)
+            for message in page.get('value', []):
+                yield message
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            # nextLink already carries the original query parameters
+            url = page.get('@odata.nextLink')
+            query_params = None
+
+    def stream_messages(self, folder_id: str = 'inbox', page_size: int = 50, limit: Optional[int] = None,
+                        select: Optional[List[str]] = None, body: str = 'text', filter: Optional[str] = None,
+                        search: Optional[str] = None,
+                        orderby: Optional[str] = 'receivedDateTime DESC') -> Iterator[Message]:
+        """Iterate over messages as compact Message objects, newest first
+        
+        Each page is parsed incrementally while it downloads, so neither the
+        page body nor its dict tree is ever held in memory as a whole.
+        Arguments are the same as for iter_messages.
         """
+        if limit is not None and limit <= 0:
+            return
+        
+        url = f'{GRAPH_API_ENDPOINT}/me/mailFolders/{folder_id}/messages'
+        query_params, prefer = build_message_query(select, body, filter, search, orderby)
+        query_params['$top'] = min(page_size, MAX_PAGE_SIZE)
+        
+        count = 0
+        while url:
+            response = self._open_stream(url, query_params, prefer=prefer)
+            with response:
+                page = JsonPageStream(response.iter_content(STREAM_CHUNK_SIZE))
+                for item in page.items():
+                    yield Message.from_graph(item)
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
+            url = page.metadata.get('@odata.nextLink')
+            query_params = None
+
+    def _open_stream(self, url: str, query_params: Optional[Dict] = None, retry_auth: bool = True,
+                     prefer: Optional[str] = None, accept: str = 'application/json') -> 'requests.Response':
+        """Send a GET request and return the response with its body not yet read"""
         self.ensure_token_valid()
         
         headers = {
             'Authorization': f'Bearer {self.access_token}',
-            'Accept': 'application/json',
-            'Prefer': 'outlook.body-content-type="text"'
+            'Accept': accept
         }
+        if prefer:
+            headers['Prefer'] = prefer
+        
+        try:
+            response = self._request('GET', url, headers=headers, params=query_params, stream=True)
+            if response.status_code == 401 and retry_auth:
+                response.close()
+                self.refresh_access_token()
+                return self._open_stream(url, query_params, retry_auth=False, prefer=prefer, accept=accept)
+            response.raise_for_status()
+            return response
+        except requests.RequestException as e:
+            logger.error(f"Failed to get messages: {e}")
+            raise
+
+    def get_message(self, message_id: str, select: Optional[List[str]] = None, body: str = 'text',
+                    change_key: Optional[str] = None) -> Dict:
+        """Get a single message, e.g. to load the body of a message listed with body='none'
+        
+        With a content cache configured, a cached copy is returned without any
+        request when `change_key` matches it, and is otherwise revalidated
+        with If-None-Match so unchanged messages are not downloaded again.
+        
+        Args:
+            message_id: Message ID
+            select: Message fields to return, defaults to subject, receivedDateTime and from
+            body: Body to include: 'none', 'preview', 'text' or 'html'
+            change_key: Optional changeKey of the wanted version, e.g. from a listing
+        """
+        query_params, prefer = build_message_query(select, body, orderby=None)
+        url = f'{GRAPH_API_ENDPOINT}/me/messages/{message_id}'
+        if self.cache is None:
+            return self._get_page(url, query_params, prefer=prefer)
+        
+        if 'changeKey' not in query_params['$select'].split(','):
+            query_params['$select'] += ',changeKey'
+        key = f'message:{message_id}?{urlencode(sorted(query_params.items()))}'
+        if prefer:
+            key += f'#{prefer}'
+        entry = self.cache.get(key)
+        if entry is not None and change_key is not None and entry.change_key == change_key:
+            self.retry_metrics.increment('cache_hits')
+            return json.loads(entry.read())
         
-        query_params = {
-            '$top': top,
-            '$select': 'subject,receivedDateTime,from,body',
-            '$orderby': 'receivedDateTime DESC'
+        response = self._get_conditional(url, query_params, entry.etag if entry is not None else None, prefer=prefer)
+        if response.status_code == 304:
+            self.retry_metrics.increment('cache_revalidated')
+            return json.loads(entry.read())
+        self.retry_metrics.increment('cache_misses')
+        message = response.json()
+        etag = response.headers.get('ETag') or message.get('@odata.etag')
+        self.cache.put(key, response.content, change_key=message.get('changeKey'), etag=etag)
+        return message
+
+    def _get_conditional(self, url: str, query_params: Dict, etag: Optional[str], retry_auth: bool = True,
+                         prefer: Optional[str] = None) -> 'requests.Response':
+        """Get a resource with If-None-Match, returning the 200 or 304 response"""
+        self.ensure_token_valid()
+        
+        headers = {
+            'Authorization': f'Bearer {self.access_token}',
+            'Accept': 'application/json'
         }
+        if prefer:
+            headers['Prefer'] = prefer
+        if etag:
+            headers['If-None-Match'] = etag
         
         try:
-            response = requests.get(
-                f'{GRAPH_API_ENDPOINT}/me/mailFolders/{folder_id}/messages',
-                headers=headers,
-                params=query_params,
-                proxies=get_proxy()
-            )
+            response = self._request('GET', url, headers=headers, params=query_params)
+            if response.status_code == 401 and retry_auth:
+                self.refresh_access_token()
+                return self._get_conditional(url, query_params, etag, retry_auth=False, prefer=prefer)
             response.raise_for_status()
-            return response.json()['value']
+            return response
         except requests.RequestException as e:
-            logger.error(f"Failed to get messages: {e}")
-            if response.status_code == 401:
+            logger.error(f"Failed to get message: {e}")
+            raise
+
+    def sync_folder(self, folder_id: str = 'inbox', store: MessageStore = None,
+                    page_size: int = 50) -> Dict[str, int]:
+        """Incrementally sync a folder into the local message store
+        
+        The first call downloads the whole folder through messages/delta; later
+        calls resume from the saved deltaLink and only transfer messages that
+        were added, changed or deleted since.
+        
+        Args:
+            folder_id: Folder ID, defaults to 'inbox'
+            store: Message store to sync into, defaults to the [sync] store_path database
+            page_size: Number of changes requested per page
+            
+        Returns:
+            Dict with counts of 'added', 'updated' and 'deleted' messages
+        """
+        if store is None:
+            store = self.store
+        
+        url = store.get_delta_link(folder_id)
+        query_params = None
+        if url is None:
+            url = f'{GRAPH_API_ENDPOINT}/me/mailFolders/{folder_id}/messages/delta'
+            query_params = {'$select': 'subject,receivedDateTime,from,body,changeKey,hasAttachments'}
+        prefer = f'outlook.body-content-type="text", odata.maxpagesize={page_size}'
+        
+        totals = {'added': 0, 'updated': 0, 'deleted': 0}
+        while url:
+            try:
+                page = self._get_page(url, query_params, prefer=prefer)
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code == 410 and query_params is None:
+                    # Delta token expired, Graph requires a full resync
+                    logger.info(f"Delta link for {folder_id} expired, resyncing")
+                    store.reset_folder(folder_id)
+                    return self.sync_folder(folder_id, store, page_size)
+                raise
+            
+            for key, count in store.apply_changes(folder_id, page.get('value', [])).items():
+                totals[key] += count
+            
+            if '@odata.deltaLink' in page:
+                store.set_delta_link(folder_id, page['@odata.deltaLink'])
+            url = page.get('@odata.nextLink')
+            query_params = None
+        
+        logger.info(f"Synced {folder_id}: {totals['added']} added, "
+                    f"{totals['updated']} updated, {totals['deleted']} deleted")
+        return totals
+
+    @property
+    def store(self) -> MessageStore:
+        """Local message store at the [sync] store_path, opened on first use"""
+        if self._store is None:
+            self._store = MessageStore(self._store_path())
+        return self._store
+
+    def _store_path(self) -> str:
+        return self.config.get('sync', 'store_path', fallback='messages.db')
+
+    def find_messages(self, query: MessageQuery = None, folder_id: str = 'inbox', top: int = 50,
+                      select: Optional[List[str]] = None, body: str = 'preview', local: Optional[bool] = None,
+                      **predicates) -> List[Dict]:
+        """Find messages matching simple predicates, newest first
+        
+        Predicates are compiled to a $filter, or to a $search when they
+        include words, and results are checked against them again. Folders
+        mirrored with sync_folder are searched in the local full-text index
+        instead, without any request.
+        
+        Args:
+            query: MessageQuery to run; or pass its predicates as keyword
+                arguments: sender, since, until, has_attachments,
+                subject_contains and text
+            folder_id: Folder ID, defaults to 'inbox'
+            top: Maximum number of messages to return
+            select: Message fields to return from Graph; fields the
+                predicates need are always added
+            body: Body to include from Graph: 'none', 'preview', 'text' or 'html'
+            local: True to only search the local store, False to always ask
+                Graph, None to use the store once the folder has been synced
+        """
+        if query is None:
+            query = MessageQuery(**predicates)
+        elif predicates:
+            raise TypeError("Pass either a MessageQuery or predicate keyword arguments, not both")
+        
+        if local is None:
+            local = (self._store is not None or os.path.exists(self._store_path())) and \
+                self.store.get_delta_link(folder_id) is not None
+        if local:
+            return self.store.search(query, folder_id, top)
+        
+        filter, search = query.to_graph()
+        fields = list(select) if select is not None else list(DEFAULT_SELECT)
+        fields.extend(field for field in QUERY_FIELDS if field not in fields)
+        messages = []
+        # $search cannot be ordered, so it comes in relevance order and is sorted below
+        for message in self.iter_messages(folder_id, page_size=max(top, 50), select=fields, body=body,
+                                          filter=filter, search=search,
+                                          orderby=None if search else 'receivedDateTime DESC'):
+            if query.matches(message):
+                messages.append(message)
+                if len(messages) >= top:
+                    break
+        if search:
+            messages.sort(key=lambda message: message.get('receivedDateTime') or '', reverse=True)
+        return messages
+
+    def _get_page(self, url: str, query_params: Optional[Dict] = None, retry_auth: bool = True,
+                  prefer: Optional[str] = None) -> Dict:
+        """Get one page of a Graph collection, or a single resource
+        
+        Args:
+            prefer: Optional Prefer header, e.g. the body content type
+        """
+        self.ensure_token_valid()
+        
+        headers = {
+            'Authorization': f'Bearer {self.access_token}',
+            'Accept': 'application/json'
+        }
+        if prefer:
+            headers['Prefer'] = prefer
+        
+        try:
+            response = self._request('GET', url, headers=headers, params=query_params)
+            if response.status_code == 401 and retry_auth:
                 self.refresh_access_token()
-                return self.get_messages(folder_id, top)
+                return self._get_page(url, query_params, retry_auth=False, prefer=prefer)
+            response.raise_for_status()
+            return response.json()
+        except requests.RequestException as e:
+            logger.error(f"Failed to get messages: {e}")
             raise
 
+    def list_folders(self, parent_id: Optional[str] = None, include_hidden: bool = False) -> List[Dict]:
+        """List mail folders at the top of the mailbox, or the child folders of `parent_id`
+        
+        Returns:
+            List of dicts with id, displayName, parentFolderId, childFolderCount and totalItemCount
+        """
+        if parent_id is None:
+            url = f'{GRAPH_API_ENDPOINT}/me/mailFolders'
+        else:
+            url = f'{GRAPH_API_ENDPOINT}/me/mailFolders/{parent_id}/childFolders'
+        query_params = {'$select': ','.join(FOLDER_SELECT), '$top': 100}
+        if include_hidden:
+            query_params['includeHiddenFolders'] = 'true'
+        
+        folders = []
+        while url:
+            page = self._get_page(url, query_params)
+            folders.extend(page.get('value', []))
+            url = page.get('@odata.nextLink')
+            query_params = None
+        return folders
+
     def get_junk_messages(self, top: int = 10) -> List[Dict]:
         """Get messages from junk email folder"""
         return self.get_messages(folder_id='junkemail', top=top)
 
-    def send_email(self, to_recipients: List[str], subject: str, content: str, is_html: bool = False) -> bool:
+    def list_attachments(self, message_id: str) -> List[Dict]:
+        """List a message's attachments without their content
+        
+        Returns:
+            List of dicts with id, name, contentType, size and isInline
+        """
+        url = f'{GRAPH_API_ENDPOINT}/me/messages/{message_id}/attachments'
+        return self._get_page(url, {'$select': ','.join(ATTACHMENT_SELECT)}).get('value', [])
+
+    def download_attachment(self, message_id: str, attachment_id: str, path: str) -> int:
+        """Stream an attachment's raw content to a file, one chunk at a time
+        
+        The file is written under a temporary name and renamed when complete,
+        so an interrupted download never leaves a truncated file at `path`.
+        With a content cache configured, attachments are streamed into the
+        cache and copied from there, so each one is downloaded only once.
+        
+        Returns:
+            Number of bytes written
+        """
+        url = f'{GRAPH_API_ENDPOINT}/me/messages/{message_id}/attachments/{attachment_id}/$value'
+        key = f'attachment:{message_id}/{attachment_id}'
+        partial_path = f'{path}.part'
+        try:
+            if self.cache is None:
+                with self._open_stream(url, accept='*/*') as response, open(partial_path, 'wb') as f:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+            elif self.cache.copy_to(key, partial_path):
+                self.retry_metrics.increment('cache_hits')
+            else:
+                self.retry_metrics.increment('cache_misses')
+                with self._open_stream(url, accept='*/*') as response:
+                    self.cache.put_stream(key, response.iter_content(DOWNLOAD_CHUNK_SIZE))
+                if not self.cache.copy_to(key, partial_path):
+                    raise FileNotFoundError(f"Attachment {attachment_id} was evicted from the cache")
+        except (requests.RequestException, OSError) as e:
+            logger.error(f"Failed to download attachment {attachment_id}: {e}")
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        written = os.path.getsize(partial_path)
+        os.replace(partial_path, path)
+        logger.info(f"Downloaded attachment {attachment_id} to {path} ({written} bytes)")
+        return written
+
+    def create_upload_session(self, message_id: str, path: str, name: Optional[str] = None,
+                              content_type: Optional[str] = None,
+                              chunk_size: int = UPLOAD_CHUNK_SIZE) -> UploadSession:
+        """Create a Graph upload session for attaching a large file to a draft message"""
+        attachment_item = {
+            'attachmentType': 'file',
+            'name': name or os.path.basename(path),
+            'size': os.path.getsize(path),
+            'contentType': content_type or guess_content_type(path)
+        }
+        response = self._send_json(
+            'POST',
+            f'{GRAPH_API_ENDPOINT}/me/messages/{message_id}/attachments/createUploadSession',
+            {'AttachmentItem': attachment_item}
+        )
+        return UploadSession(self, response.json()['uploadUrl'], path, chunk_size)
+
+    def upload_attachment(self, message_id: str, path: str, name: Optional[str] = None,
+                          content_type: Optional[str] = None) -> None:
+        """Attach a file to a draft message, through an upload session if it is over 3 MB"""
+        if os.path.getsize(path) <= LARGE_ATTACHMENT_SIZE:
+            self._send_json('POST', f'{GRAPH_API_ENDPOINT}/me/messages/{message_id}/attachments',
+                            file_attachment(path, name, content_type))
+            return
+        self.create_upload_session(message_id, path, name, content_type).upload()
+
+    def _send_json(self, method: str, url: str, payload: Optional[Dict] = None,
+                   retry_auth: bool = True) -> 'requests.Response':
+        """Send a Graph request with an optional JSON body and return the successful response"""
+        self.ensure_token_valid()
+        
+        headers = {'Authorization': f'Bearer {self.access_token}'}
+        
+        try:
+            response = self._request(method, url, headers=headers, json=payload)
+            if response.status_code == 401 and retry_auth:
+                self.refresh_access_token()
+                return self._send_json(method, url, payload, retry_auth=False)
+            response.raise_for_status()
+            return response
+        except requests.RequestException as e:
+            logger.error(f"{method} {url} failed: {e}")
+            raise
+
+    def _send_with_uploads(self, to_recipients: List[str], subject: str, content: str, is_html: bool,
+                           inline: List[str], separate: List[str]) -> bool:
+        """Send a message as a draft that attachments are added to before sending
+
+        The draft is deleted if uploading fails or Graph rejects the send with
+        a client error. After a gateway error, throttling or a dropped
+        connection the message may still go out, so the draft is kept and
+        DeliveryUnknownError is raised.
+        """
+        email_msg = build_email_message(to_recipients, subject, content, is_html,
+                                        [file_attachment(path) for path in inline])
+        draft_id = self._send_json('POST', f'{GRAPH_API_ENDPOINT}/me/messages', email_msg['message']).json()['id']
+        try:
+            for path in separate:
+                self.upload_attachment(draft_id, path)
+        except requests.RequestException:
+            self._delete_draft(draft_id)
+            raise
+        try:
+            self._send_json('POST', f'{GRAPH_API_ENDPOINT}/me/messages/{draft_id}/send')
+        except requests.RequestException as e:
+            response = getattr(e, 'response', None)
+            if response is not None and 400 <= response.status_code < 500 and response.status_code != 429:
+                self._delete_draft(draft_id)
+                raise
+            logger.warning(f"Sending draft {draft_id} failed ({e}), keeping it as it may have been sent")
+            raise DeliveryUnknownError(draft_id, e) from e
+        logger.info(f"Email successfully sent to {', '.join(to_recipients)}")
+        return True
+
+    def _delete_draft(self, draft_id: str) -> None:
+        try:
+            self._send_json('DELETE', f'{GRAPH_API_ENDPOINT}/me/messages/{draft_id}')
+        except requests.RequestException:
+            logger.warning(f"Could not delete unsent draft {draft_id}")
+
+    def send_email(self, to_recipients: List[str], subject: str, content: str, is_html: bool = False,
+                   retry_auth: bool = True, attachments: Optional[List[str]] = None) -> bool:
         """Send email
         
+        Small attachments are sent inline with the message. Files over 3 MB,
+        or small files that together would not fit in one request, are
+        added to a draft first, large ones through chunked upload sessions.
+        
         Args:
             to_recipients: List of recipient email addresses
             subject: Email subject
             content: Email content
             is_html: Whether content is HTML format, defaults to False
+            retry_auth: Whether to refresh the token and retry once on 401
+            attachments: Optional paths of files to attach
             
         Returns:
             bool: Whether sending was successful
+            
+        Raises:
+            DeliveryUnknownError: Sending a draft failed without telling
+                whether the message went out; the draft is kept
         """
+        inline, separate = split_attachments(attachments or [])
+        if separate:
+            return self._send_with_uploads(to_recipients, subject, content, is_html, inline, separate)
+        
         self.ensure_token_valid()
         
         headers = {
@@ -156,41 +840,29 @@ class EmailClient:
             'Content-Type': 'application/json'
         }
         
-        email_msg = {
-            'message': {
-                'subject': subject,
-                'body': {
-                    'contentType': 'HTML' if is_html else 'Text',
-                    'content': content
-                },
-                'toRecipients': [
-                    {
-                        'emailAddress': {
-                            'address': recipient
-                        }
-                    } for recipient in to_recipients
-                ]
-            }
-        }
+        email_msg = build_email_message(to_recipients, subject, content, is_html,
+                                        [file_attachment(path) for path in inline])
         
         try:
-            response = requests.post(
+            response = self._request(
+                'POST',
                 f'{GRAPH_API_ENDPOINT}/me/sendMail',
                 headers=headers,
-                json=email_msg,
-                proxies=get_proxy()
+                json=email_msg
             )
+            if response.status_code == 401 and retry_auth:
+                self.refresh_access_token()
+                return self.send_email(to_recipients, subject, content, is_html, retry_auth=False,
+                                       attachments=attachments)
             response.raise_for_status()
             logger.info(f"Email successfully sent to {', '.join(to_recipients)}")
             return True
         except requests.RequestException as e:
             logger.error(f"Failed to send email: {e}")
-            if response.status_code == 401:
-                self.refresh_access_token()
-                return self.send_email(to_recipients, subject, content, is_html)
             raise
 
 def main():
+    configure_logging(load_config())
     try:
         client = EmailClient()
         
@@ -202,25 +874,23 @@ def main():
         if client.send_email(recipients, subject, content):
             print("Email sent successfully!")
         
-        # Get inbox messages, top=n means get latest n messages
-        messages = client.get_messages(top=1)
+        # Get inbox messages, limit=n means get latest n messages
         print("\nLatest inbox message:")
-        for msg in messages:
+        for msg in client.stream_messages(page_size=1, limit=1):
             print("\n" + "="*50)
-            print(f"Subject: {msg['subject']}")
-            print(f"From: {msg['from']['emailAddress']['address']}")
-            print(f"Time: {msg['receivedDateTime']}")
-            print(f"\nContent:{msg['body']['content']}")
+            print(f"Subject: {msg.subject}")
+            print(f"From: {msg.sender}")
+            print(f"Time: {msg.received_at}")
+            print(f"\nContent:{msg.body}")
             
-        # Get junk messages, top=n means get latest n messages
-        junk_messages = client.get_junk_messages(top=1)
+        # Get junk messages, limit=n means get latest n messages
         print("\nLatest junk folder message:")
-        for msg in junk_messages:
+        for msg in client.stream_messages('junkemail', page_size=1, limit=1):
             print("\n" + "="*50)
-            print(f"Subject: {msg['subject']}")
-            print(f"From: {msg['from']['emailAddress']['address']}")
-            print(f"Time: {msg['receivedDateTime']}")
-            print(f"\nContent:{msg['body']['content']}")
+            print(f"Subject: {msg.subject}")
+            print(f"From: {msg.sender}")
+            print(f"Time: {msg.received_at}")
+            print(f"\nContent:{msg.body}")
             
     except Exception as e:
         logger.error(f"Program execution error: {e}")
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Mail Daemon
+Resident process that keeps connections and tokens warm and syncs every
+mailbox folder on its own adaptive schedule, draining cleanly on SIGTERM
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import random
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import mail_api
+from mail_api import EmailClient, create_session
+from instrumentation import configure_logging
+from message_store import MessageStore
+from proxy_resolver import ProxyResolver
+from throttling import RateLimiter, RetryMetrics
+from token_manager import TokenManager
+from token_store import DEFAULT_ACCOUNT, open_token_store
+
+logger = logging.getLogger(__name__)
+
+
+def account_store_path(store_path: str, account: str) -> str:
+    """Message store file of an account, with the account name before the extension unless it is 'default'"""
+    if account == DEFAULT_ACCOUNT:
+        return store_path
+    root, ext = os.path.splitext(store_path)
+    return f'{root}.{account}{ext or ".db"}'
+
+
+class SyncJob:
+    """One mailbox folder synced on an adaptive interval"""
+
+    def __init__(self, account: str, folder_id: str, interval: float):
+        self.account = account
+        self.folder_id = folder_id
+        self.interval = interval
+        self.due = 0.0
+        self.runs = 0
+        self.changes = 0
+        self.errors = 0
+        self.last_error = None
+
+    def status(self) -> Dict:
+        return {
+            'account': self.account,
+            'folder': self.folder_id,
+            'interval': round(self.interval, 1),
+            'due_in': round(max(0.0, self.due - time.monotonic()), 1),
+            'runs': self.runs,
+            'changes': self.changes,
+            'errors': self.errors,
+            'last_error': self.last_error
+        }
+
+
+class MailDaemon:
+    """Keep the folders of many mailboxes in sync from one resident process
+
+    Every (account, folder) job runs a delta sync into the account's message
+    store. After a sync with changes the job runs again in `min_interval`;
+    every idle or failed sync multiplies its interval by `backoff` up to
+    `max_interval`, with 10% jitter so mailboxes drift apart. A job never
+    overlaps itself, and jobs are only handed to a worker once one is free,
+    so a due job waits in the schedule rather than a queue. Clients share
+    one connection pool, proxy resolver and rate limiter, and the token
+    manager refreshes tokens in the background, so runs pay neither
+    connection setup nor token requests.
+
+    stop() stops scheduling, lets running syncs finish and closes
+    everything; due jobs that have not started are dropped.
+
+    Args:
+        accounts: Accounts to sync, defaults to every account of the token manager
+        folders: Folder IDs synced for every account
+        token_manager: Token manager, defaults to TokenManager.from_config()
+        workers: Syncs running at the same time
+        min_interval: Seconds between syncs of a folder with new changes
+        max_interval: Longest interval an idle folder backs off to
+        backoff: Factor the interval grows by after each idle or failed sync
+        store_path: Message store of the 'default' account; other accounts
+            get their own file beside it
+        on_changes: Optional callback receiving (account, folder_id, counts)
+            after every sync that found changes
+    """
+
+    def __init__(self, accounts: Optional[List[str]] = None, folders: Optional[List[str]] = None,
+                 token_manager: TokenManager = None, workers: int = 4, min_interval: float = 30,
+                 max_interval: float = 900, backoff: float = 2.0, store_path: str = 'messages.db',
+                 on_changes: Optional[Callable[[str, str, Dict[str, int]], None]] = None):
+        config = mail_api.load_config()
+        self.config = config
+        self._owns_token_manager = token_manager is None
+        self.token_manager = token_manager if token_manager is not None else TokenManager.from_config(config)
+        self.accounts = list(accounts) if accounts else self.token_manager.accounts
+        self.folders = list(folders) if folders else ['inbox']
+        self.workers = workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.store_path = store_path
+        self.on_changes = on_changes
+        self.session = create_session(config)
+        self.proxy_resolver = ProxyResolver.from_config(config)
+        self.rate_limiter = RateLimiter.from_config(config)
+        self.retry_metrics = RetryMetrics()
+        self.token_store = open_token_store(config)
+        self.clients = {}
+        self.stores = {}
+        self.jobs = [SyncJob(account, folder_id, min_interval) for account in self.accounts
+                     for folder_id in self.folders]
+        self._schedule = []
+        self._sequence = itertools.count()
+        # Reentrant, as stop() may run in a signal handler while the scheduler holds it
+        self._lock = threading.RLock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopping = False
+        self._in_flight = 0
+        self._executor = None
+
+    @classmethod
+    def from_config(cls, config=None, **kwargs) -> 'MailDaemon':
+        """Create daemon from the optional [daemon] section of config.txt
+
+            folders: Comma-separated folder IDs, defaults to inbox
+            workers, min_interval, max_interval, backoff: As for MailDaemon
+        """
+        if config is None:
+            config = mail_api.load_config()
+        folders = config.get('daemon', 'folders', fallback='inbox')
+        kwargs.setdefault('folders', [folder.strip() for folder in folders.split(',') if folder.strip()])
+        kwargs.setdefault('workers', config.getint('daemon', 'workers', fallback=4))
+        kwargs.setdefault('min_interval', config.getfloat('daemon', 'min_interval', fallback=30))
+        kwargs.setdefault('max_interval', config.getfloat('daemon', 'max_interval', fallback=900))
+        kwargs.setdefault('backoff', config.getfloat('daemon', 'backoff', fallback=2.0))
+        kwargs.setdefault('store_path', config.get('sync', 'store_path', fallback='messages.db'))
+        return cls(**kwargs)
+
+    def client(self, account: str) -> EmailClient:
+        """Get the warm client of an account, created on first use"""
+        with self._lock:
+            client = self.clients.get(account)
+            if client is None:
+                client = self.clients[account] = EmailClient(
+                    session=self.session, proxy_resolver=self.proxy_resolver, token_manager=self.token_manager,
+                    account=account, token_store=self.token_store, rate_limiter=self.rate_limiter,
+                    retry_metrics=self.retry_metrics
+                )
+                self.stores[account] = MessageStore(account_store_path(self.store_path, account))
+            return client
+
+    def status(self) -> List[Dict]:
+        """Schedule and counters of every job"""
+        with self._lock:
+            return [job.status() for job in self.jobs]
+
+    def stop(self) -> None:
+        """Stop scheduling new syncs; run() returns once running ones finish"""
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+
+    def run(self) -> None:
+        """Run until stop(), then drain running syncs and close all resources"""
+        logger.info(f"Daemon syncing {len(self.folders)} folders of {len(self.accounts)} accounts "
+                    f"with {self.workers} workers")
+        self.token_manager.start()
+        for account in self.accounts:
+            self.client(account)
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='daemon')
+        now = time.monotonic()
+        with self._lock:
+            for job in self.jobs:
+                # Spread the first round so mailboxes do not all start at once
+                self._push(job, now + random.uniform(0, min(self.min_interval, 5)))
+        try:
+            self._run_scheduler()
+        finally:
+            logger.info("Draining running syncs")
+            self._executor.shutdown(wait=True)
+            self.close()
+            logger.info("Daemon stopped")
+
+    def close(self) -> None:
+        for client in self.clients.values():
+            client.close()
+        for store in self.stores.values():
+            store.close()
+        self.token_store.close()
+        self.session.close()
+        if self._owns_token_manager:
+            self.token_manager.stop()
+
+    def _push(self, job: SyncJob, due: float) -> None:
+        """Queue a job, caller holds the lock"""
+        job.due = due
+        heapq.heappush(self._schedule, (due, next(self._sequence), job))
+        self._wakeup.notify()
+
+    def _run_scheduler(self) -> None:
+        while True:
+            with self._lock:
+                while not self._stopping:
+                    if self._in_flight >= self.workers:
+                        # Due jobs stay in the schedule until a worker is free
+                        self._wakeup.wait()
+                    elif self._schedule:
+                        delay = self._schedule[0][0] - time.monotonic()
+                        if delay <= 0:
+                            job = heapq.heappop(self._schedule)[2]
+                            self._in_flight += 1
+                            break
+                        self._wakeup.wait(delay)
+                    else:
+                        self._wakeup.wait()
+                if self._stopping:
+                    return
+            self._executor.submit(self._run_job, job)
+
+    def _run_job(self, job: SyncJob) -> None:
+        changed = False
+        try:
+            counts = self.client(job.account).sync_folder(job.folder_id, store=self.stores[job.account])
+            changed = any(counts.values())
+            if changed and self.on_changes is not None:
+                self.on_changes(job.account, job.folder_id, counts)
+        except Exception as e:
+            logger.warning(f"Sync of {job.account}/{job.folder_id} failed: {e}")
+            job.errors += 1
+            job.last_error = str(e)
+        else:
+            job.changes += sum(counts.values())
+        finally:
+            job.runs += 1
+            job.interval = self.min_interval if changed else min(job.interval * self.backoff, self.max_interval)
+            with self._lock:
+                self._in_flight -= 1
+                if not self._stopping:
+                    self._push(job, time.monotonic() + job.interval * random.uniform(0.9, 1.1))
+                self._wakeup.notify()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Keep mailboxes in sync from a resident process')
+    parser.add_argument('--account', action='append', help='Account to sync, repeatable; defaults to all')
+    parser.add_argument('--folder', action='append', help='Folder ID to sync, repeatable; defaults to [daemon] folders')
+    parser.add_argument('--workers', type=int, help='Syncs running at the same time')
+    parser.add_argument('--metrics', action='store_true', help='Serve /metrics on the [metrics] host and port')
+    args = parser.parse_args()
+
+    config = mail_api.load_config()
+    configure_logging(config)
+    kwargs = {'accounts': args.account}
+    if args.folder:
+        kwargs['folders'] = args.folder
+    if args.workers:
+        kwargs['workers'] = args.workers
+    daemon = MailDaemon.from_config(config, **kwargs)
+
+    def shutdown(signum, frame):
+        logger.info(f"Received {signal.Signals(signum).name}, shutting down")
+        # A second signal terminates at once
+        signal.signal(signum, signal.SIG_DFL)
+        daemon.stop()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    metrics = None
+    if args.metrics:
+        from metrics_server import MetricsServer
+        metrics = MetricsServer.from_config(config)
+        metrics.start()
+    try:
+        daemon.run()
+    finally:
+        if metrics is not None:
+            metrics.stop()
+    for job in daemon.status():
+        logger.info(f"{job['account']}/{job['folder']}: {job['runs']} syncs, {job['changes']} changes, "
+                    f"{job['errors']} errors")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Compact Message Objects
+Slot-based message type and an incremental parser that builds messages
+straight from a streamed Graph collection response
+"""
+
+import codecs
+import json
+import re
+from typing import Dict, Iterable, Iterator, Optional
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+
+# Fields parsed into Message attributes; everything else is kept in Message.extra
+_HEADER_FIELDS = frozenset([
+    'id', 'changeKey', 'subject', 'receivedDateTime', 'from', 'body', 'bodyPreview',
+    'hasAttachments', 'isRead'
+])
+# Graph fields stored as they are in a Message attribute
+_FIELD_ATTRIBUTES = {
+    'id': 'id', 'changeKey': 'change_key', 'subject': 'subject', 'receivedDateTime': 'received_at',
+    'bodyPreview': 'preview', 'hasAttachments': 'has_attachments', 'isRead': 'is_read'
+}
+
+
+class Message:
+    """Mail message with slots for the common Graph fields
+
+    The body keeps the string the JSON decoder produced, so building a
+    message copies no content. Item access mirrors the raw Graph dict for
+    existing code, e.g. msg['from']['emailAddress']['address'].
+    """
+
+    __slots__ = (
+        'id', 'change_key', 'subject', 'sender', 'sender_name', 'received_at',
+        'preview', 'has_attachments', 'is_read', 'body_type', 'body', 'extra'
+    )
+
+    def __init__(self, id: str, subject: Optional[str] = None, sender: Optional[str] = None,
+                 sender_name: Optional[str] = None, received_at: Optional[str] = None,
+                 body: Optional[str] = None, body_type: Optional[str] = None,
+                 change_key: Optional[str] = None, preview: Optional[str] = None,
+                 has_attachments: Optional[bool] = None, is_read: Optional[bool] = None,
+                 extra: Optional[Dict] = None):
+        self.id = id
+        self.change_key = change_key
+        self.subject = subject
+        self.sender = sender
+        self.sender_name = sender_name
+        self.received_at = received_at
+        self.preview = preview
+        self.has_attachments = has_attachments
+        self.is_read = is_read
+        self.body_type = body_type
+        self.body = body
+        self.extra = extra
+
+    @classmethod
+    def from_graph(cls, data: Dict) -> 'Message':
+        """Build a message from a Graph message resource"""
+        sender = (data.get('from') or {}).get('emailAddress') or {}
+        body = data.get('body')
+        extra = None
+        if len(data) > len(_HEADER_FIELDS.intersection(data)):
+            extra = dict((key, value) for key, value in data.items() if key not in _HEADER_FIELDS)
+        return cls(
+            data['id'],
+            subject=data.get('subject'),
+            sender=sender.get('address'),
+            sender_name=sender.get('name'),
+            received_at=data.get('receivedDateTime'),
+            body=body.get('content') if body else None,
+            body_type=body.get('contentType') if body else None,
+            change_key=data.get('changeKey'),
+            preview=data.get('bodyPreview'),
+            has_attachments=data.get('hasAttachments'),
+            is_read=data.get('isRead'),
+            extra=extra
+        )
+
+    @property
+    def body_bytes(self) -> Optional[bytes]:
+        """Body content encoded as UTF-8, None if the body was not fetched"""
+        return self.body.encode('utf-8') if self.body is not None else None
+
+    def _field(self, key: str):
+        """Value of a Graph field held in a slot, None if the message has none"""
+        attribute = _FIELD_ATTRIBUTES.get(key)
+        if attribute is not None:
+            return getattr(self, attribute)
+        if key == 'from':
+            if self.sender is None and self.sender_name is None:
+                return None
+            address = {'address': self.sender}
+            if self.sender_name is not None:
+                address['name'] = self.sender_name
+            return {'emailAddress': address}
+        if key == 'body':
+            return {'contentType': self.body_type, 'content': self.body} if self.body is not None else None
+        return None
+
+    def to_dict(self) -> Dict:
+        """Convert back to the Graph message dict shape"""
+        data = dict(self.extra) if self.extra else {}
+        for key in _HEADER_FIELDS:
+            value = self._field(key)
+            if value is not None:
+                data[key] = value
+        return data
+
+    def __getitem__(self, key: str):
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        value = self._field(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __repr__(self) -> str:
+        return f'Message(id={self.id!r}, subject={self.subject!r}, sender={self.sender!r})'
+
+
+class JsonPageStream:
+    """Incrementally parse a Graph collection page from a stream of byte chunks
+
+    Items of the 'value' array are decoded one at a time as enough bytes
+    arrive, so at most one item and one chunk are held in memory. Other
+    top-level properties, such as @odata.nextLink, are collected in
+    `metadata` while parsing; read it after items() is exhausted.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], array_key: str = 'value'):
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self.array_key = array_key
+        self.metadata = {}
+
+    def _read_more(self) -> bool:
+        if self._eof:
+            return False
+        if self._pos > 65536:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        for chunk in self._chunks:
+            if chunk:
+                self._buffer += self._text_decoder.decode(chunk)
+                return True
+        self._buffer += self._text_decoder.decode(b'', final=True)
+        self._eof = True
+        return False
+
+    def _skip_whitespace(self) -> str:
+        """Skip whitespace and return the next character without consuming it"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read_more():
+                raise ValueError('Unexpected end of JSON stream')
+
+    def _expect(self, chars: str) -> str:
+        char = self._skip_whitespace()
+        if char not in chars:
+            raise ValueError(f'Expected one of {chars!r} at offset {self._pos}, got {char!r}')
+        self._pos += 1
+        return char
+
+    def _decode_value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._read_more():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self._buffer) and not self._eof and not isinstance(value, (dict, list, str)):
+                self._read_more()
+                continue
+            self._pos = end
+            return value
+
+    def items(self) -> Iterator[Dict]:
+        """Yield the items of the array one by one"""
+        self._expect('{')
+        if self._skip_whitespace() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._decode_value()
+            self._expect(':')
+            if key == self.array_key:
+                self._expect('[')
+                if self._skip_whitespace() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._decode_value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.metadata[key] = self._decode_value()
+            if self._expect(',}') == '}':
+                return
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Message Queries
+Simple message predicates compiled to Graph $filter or $search, or to SQL
+over the local message store and its full-text index
+"""
+
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple, Union
+
+DateLike = Union[datetime, str]
+
+# Fields a query needs in each message to check its predicates
+QUERY_FIELDS = ('subject', 'receivedDateTime', 'from', 'hasAttachments')
+
+
+# Date, optional time with fraction, optional Z or +HH:MM offset
+_ISO_DATETIME = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?)?'
+    r'(Z|[+-]\d{2}:?\d{2})?$'
+)
+
+
+def _parse_iso_datetime(value: str) -> datetime:
+    """Parse an ISO 8601 date or datetime; datetime.fromisoformat needs Python 3.7 and rejects 'Z'"""
+    match = _ISO_DATETIME.match(value.strip())
+    if match is None:
+        raise ValueError(f"Invalid ISO 8601 datetime: {value!r}")
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    # Graph writes up to 7 fractional digits, datetime keeps 6
+    microsecond = int((fraction or '0')[:6].ljust(6, '0'))
+    result = datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+                      microsecond)
+    if offset is None:
+        return result
+    if offset == 'Z':
+        return result.replace(tzinfo=timezone.utc)
+    digits = offset[1:].replace(':', '')
+    delta = timedelta(hours=int(digits[:2]), minutes=int(digits[2:]))
+    return result.replace(tzinfo=timezone(-delta if offset[0] == '-' else delta))
+
+
+def _to_datetime(value: DateLike) -> datetime:
+    """Parse a datetime or ISO 8601 string, treating naive values as UTC"""
+    if isinstance(value, str):
+        value = _parse_iso_datetime(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def format_graph_datetime(value: datetime) -> str:
+    """Format a UTC datetime the way Graph writes receivedDateTime"""
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _odata_string(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _kql_phrase(value: str) -> str:
+    return '"' + value.replace('\\', ' ').replace('"', ' ') + '"'
+
+
+def quote_search(kql: str) -> str:
+    """Wrap a KQL expression as a Graph $search value
+
+    The whole expression goes in one pair of double quotes, with quotes
+    and backslashes inside it escaped by a backslash.
+    """
+    return '"' + kql.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _fts_phrase(value: str) -> str:
+    return '"' + value.replace('"', '""') + '"'
+
+
+class MessageQuery:
+    """Predicates over messages, all of which must match
+
+    Args:
+        sender: Sender e-mail address, compared case-insensitively
+        since: Only messages received at or after this time
+        until: Only messages received before this time
+        has_attachments: True or False to require or exclude attachments
+        subject_contains: Words the subject must contain
+        text: Words to find anywhere in the subject, sender or body
+    """
+
+    def __init__(self, sender: Optional[str] = None, since: Optional[DateLike] = None,
+                 until: Optional[DateLike] = None, has_attachments: Optional[bool] = None,
+                 subject_contains: Optional[str] = None, text: Optional[str] = None):
+        self.sender = sender.strip().lower() if sender else None
+        self.since = _to_datetime(since) if since is not None else None
+        self.until = _to_datetime(until) if until is not None else None
+        self.has_attachments = has_attachments
+        self.subject_contains = subject_contains.strip() if subject_contains else None
+        self.text = text.strip() if text else None
+
+    def __repr__(self):
+        fields = ', '.join(f'{key}={value!r}' for key, value in vars(self).items() if value is not None)
+        return f'MessageQuery({fields})'
+
+    @property
+    def needs_search(self) -> bool:
+        """Whether word predicates require $search, which Graph cannot combine with $filter"""
+        return bool(self.subject_contains or self.text)
+
+    def to_filter(self) -> Optional[str]:
+        """Compile to an OData $filter, None if there is nothing to filter on
+
+        receivedDateTime comes first, as Graph requires of filters combined
+        with $orderby=receivedDateTime.
+        """
+        clauses = []
+        if self.since is not None:
+            clauses.append(f'receivedDateTime ge {format_graph_datetime(self.since)}')
+        if self.until is not None:
+            clauses.append(f'receivedDateTime lt {format_graph_datetime(self.until)}')
+        if not clauses and (self.sender or self.has_attachments is not None):
+            clauses.append('receivedDateTime ge 1900-01-01T00:00:00Z')
+        if self.sender:
+            clauses.append(f'from/emailAddress/address eq {_odata_string(self.sender)}')
+        if self.has_attachments is not None:
+            clauses.append(f"hasAttachments eq {'true' if self.has_attachments else 'false'}")
+        return ' and '.join(clauses) or None
+
+    def to_search(self) -> str:
+        """Compile to a KQL $search query
+
+        KQL compares dates by day, so results should still be checked with
+        matches() for exact time bounds.
+        """
+        terms = []
+        if self.text:
+            terms.append(_kql_phrase(self.text))
+        if self.subject_contains:
+            terms.append(f'subject:{_kql_phrase(self.subject_contains)}')
+        if self.sender:
+            terms.append(f'from:{_kql_phrase(self.sender)}')
+        if self.since is not None:
+            terms.append(f'received>={self.since.date().isoformat()}')
+        if self.until is not None:
+            last_day = self.until if self.until.time() != datetime.min.time() else self.until - timedelta(days=1)
+            terms.append(f'received<={last_day.date().isoformat()}')
+        if self.has_attachments is not None:
+            terms.append(f"hasattachments:{'true' if self.has_attachments else 'false'}")
+        return ' AND '.join(terms)
+
+    def to_graph(self) -> Tuple[Optional[str], Optional[str]]:
+        """Compile to the (filter, search) arguments of EmailClient.get_messages"""
+        if self.needs_search:
+            return None, self.to_search()
+        return self.to_filter(), None
+
+    def to_sql(self, fts: bool = True) -> Tuple[List[str], List, Optional[str]]:
+        """Compile to SQL over the message store
+
+        Returns:
+            Tuple of (WHERE clauses over table alias m, their parameters,
+            FTS5 MATCH expression or None). Without fts, word predicates
+            become LIKE clauses instead.
+        """
+        clauses, params, match = [], [], []
+        if self.sender:
+            clauses.append('m.sender = ? COLLATE NOCASE')
+            params.append(self.sender)
+        if self.since is not None:
+            clauses.append('m.received_at >= ?')
+            params.append(format_graph_datetime(self.since))
+        if self.until is not None:
+            clauses.append('m.received_at < ?')
+            params.append(format_graph_datetime(self.until))
+        if self.has_attachments is not None:
+            clauses.append("json_extract(m.data, '$.hasAttachments') = ?")
+            params.append(1 if self.has_attachments else 0)
+        for column, words in (('subject', self.subject_contains), (None, self.text)):
+            if not words:
+                continue
+            if fts:
+                phrases = ' '.join(_fts_phrase(word) + '*' for word in words.split())
+                match.append(f'{column} : ({phrases})' if column else f'({phrases})')
+            else:
+                for word in words.split():
+                    clauses.append('m.subject LIKE ?' if column else
+                                   "(m.subject LIKE ? OR m.sender LIKE ? OR json_extract(m.data, '$.body.content') LIKE ?)")
+                    params.extend([f'%{word}%'] * (1 if column else 3))
+        return clauses, params, ' AND '.join(match) or None
+
+    def matches(self, message: Dict) -> bool:
+        """Check a Graph message dict against all predicates but `text`
+
+        Free text is left to the server's search or the local index, since
+        the body is often not fetched.
+        """
+        if self.sender:
+            address = ((message.get('from') or {}).get('emailAddress') or {}).get('address') or ''
+            if address.lower() != self.sender:
+                return False
+        if self.since is not None or self.until is not None:
+            received = message.get('receivedDateTime')
+            if not received:
+                return False
+            received = _to_datetime(received)
+            if self.since is not None and received < self.since:
+                return False
+            if self.until is not None and received >= self.until:
+                return False
+        if self.has_attachments is not None and bool(message.get('hasAttachments')) != self.has_attachments:
+            return False
+        if self.subject_contains:
+            subject = (message.get('subject') or '').lower()
+            if not all(word in subject for word in self.subject_contains.lower().split()):
+                return False
+        return True
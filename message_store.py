@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Local Message Store
+SQLite store of synced messages and per-folder delta links, with an FTS5
+full-text index over subject, sender and body
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from mail_query import MessageQuery
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    folder_id TEXT NOT NULL,
+    change_key TEXT,
+    subject TEXT,
+    sender TEXT,
+    received_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_folder_received ON messages (folder_id, received_at);
+CREATE INDEX IF NOT EXISTS messages_sender ON messages (sender COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS sync_state (
+    folder_id TEXT PRIMARY KEY,
+    delta_link TEXT NOT NULL,
+    synced_at REAL NOT NULL
+);
+"""
+
+# Rows share the rowid of their messages row
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    subject, sender, body, tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+# Bumped when FTS_SCHEMA changes, so existing stores are re-indexed
+FTS_VERSION = 1
+
+
+def _sender_address(message: Dict) -> Optional[str]:
+    sender = message.get('from') or {}
+    return (sender.get('emailAddress') or {}).get('address')
+
+
+def _index_text(message: Dict):
+    """Get the (subject, sender, body) columns indexed for a message"""
+    sender = (message.get('from') or {}).get('emailAddress') or {}
+    body = (message.get('body') or {}).get('content') or message.get('bodyPreview') or ''
+    return (
+        message.get('subject') or '',
+        ' '.join(value for value in (sender.get('name'), sender.get('address')) if value),
+        body
+    )
+
+
+class MessageStore:
+    """SQLite-backed store of messages kept in sync with Graph delta queries
+
+    Messages are also indexed for full-text search with FTS5. Where SQLite
+    is built without FTS5, search() falls back to LIKE scans.
+
+    Args:
+        path: Database file path, ':memory:' for a throwaway store
+    """
+
+    def __init__(self, path: str = 'messages.db'):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(SCHEMA)
+            self.fts = self._create_index()
+
+    def _create_index(self) -> bool:
+        """Create the full-text index, indexing existing messages once; False without FTS5"""
+        try:
+            self._conn.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError:
+            return False
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] < FTS_VERSION:
+            with self._conn:
+                self._conn.execute('DELETE FROM messages_fts')
+                rows = self._conn.execute('SELECT rowid, data FROM messages')
+                self._conn.executemany(
+                    'INSERT INTO messages_fts (rowid, subject, sender, body) VALUES (?, ?, ?, ?)',
+                    ((row['rowid'],) + _index_text(json.loads(row['data'])) for row in rows)
+                )
+                self._conn.execute(f'PRAGMA user_version = {FTS_VERSION}')
+        return True
+
+    def _unindex(self, where: str, params) -> None:
+        """Remove the index rows of the messages matching a WHERE clause, caller holds the lock"""
+        if self.fts:
+            self._conn.execute(f'DELETE FROM messages_fts WHERE rowid IN (SELECT rowid FROM messages WHERE {where})',
+                               params)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def get_delta_link(self, folder_id: str) -> Optional[str]:
+        """Get the saved delta link of a folder, None if it was never synced"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT delta_link FROM sync_state WHERE folder_id = ?', (folder_id,)
+            ).fetchone()
+        return row['delta_link'] if row else None
+
+    def set_delta_link(self, folder_id: str, delta_link: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO sync_state (folder_id, delta_link, synced_at) VALUES (?, ?, ?)',
+                (folder_id, delta_link, time.time())
+            )
+
+    def reset_folder(self, folder_id: str) -> None:
+        """Forget a folder's messages and delta link so the next sync starts over"""
+        with self._lock, self._conn:
+            self._unindex('folder_id = ?', (folder_id,))
+            self._conn.execute('DELETE FROM messages WHERE folder_id = ?', (folder_id,))
+            self._conn.execute('DELETE FROM sync_state WHERE folder_id = ?', (folder_id,))
+
+    def apply_changes(self, folder_id: str, changes: Iterable[Dict]) -> Dict[str, int]:
+        """Apply one page of delta changes in a single transaction
+
+        Items carrying '@removed' are deleted; other items are inserted or
+        merged into the stored copy, since updates may only carry changed
+        properties.
+
+        Returns:
+            Dict with counts of 'added', 'updated' and 'deleted' messages
+        """
+        counts = {'added': 0, 'updated': 0, 'deleted': 0}
+        with self._lock, self._conn:
+            for change in changes:
+                message_id = change['id']
+                if '@removed' in change:
+                    self._unindex('id = ?', (message_id,))
+                    cursor = self._conn.execute('DELETE FROM messages WHERE id = ?', (message_id,))
+                    counts['deleted'] += cursor.rowcount
+                    continue
+
+                row = self._conn.execute('SELECT data FROM messages WHERE id = ?', (message_id,)).fetchone()
+                if row:
+                    message = json.loads(row['data'])
+                    message.update(change)
+                    counts['updated'] += 1
+                else:
+                    message = dict(change)
+                    counts['added'] += 1
+                self._unindex('id = ?', (message_id,))
+                cursor = self._conn.execute(
+                    'INSERT OR REPLACE INTO messages '
+                    '(id, folder_id, change_key, subject, sender, received_at, data) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        message_id,
+                        folder_id,
+                        message.get('changeKey'),
+                        message.get('subject'),
+                        _sender_address(message),
+                        message.get('receivedDateTime'),
+                        json.dumps(message)
+                    )
+                )
+                if self.fts:
+                    self._conn.execute(
+                        'INSERT INTO messages_fts (rowid, subject, sender, body) VALUES (?, ?, ?, ?)',
+                        (cursor.lastrowid,) + _index_text(message)
+                    )
+        return counts
+
+    def get_message(self, message_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM messages WHERE id = ?', (message_id,)).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def get_messages(self, folder_id: str, top: Optional[int] = None) -> List[Dict]:
+        """Get stored messages of a folder, newest first"""
+        sql = 'SELECT data FROM messages WHERE folder_id = ? ORDER BY received_at DESC'
+        params = [folder_id]
+        if top is not None:
+            sql += ' LIMIT ?'
+            params.append(top)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [json.loads(row['data']) for row in rows]
+
+    def search(self, query: MessageQuery, folder_id: Optional[str] = None, top: Optional[int] = None) -> List[Dict]:
+        """Get stored messages matching a query, newest first
+
+        Args:
+            query: Predicates to match
+            folder_id: Folder to search, defaults to all stored folders
+            top: Maximum number of messages to return
+        """
+        clauses, params, match = query.to_sql(fts=self.fts)
+        sql = 'SELECT m.data FROM messages AS m'
+        if match:
+            # A subquery runs the MATCH once rather than once per candidate row
+            clauses.insert(0, 'm.rowid IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)')
+            params.insert(0, match)
+        if folder_id is not None:
+            clauses.append('m.folder_id = ?')
+            params.append(folder_id)
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY m.received_at DESC'
+        if top is not None:
+            sql += ' LIMIT ?'
+            params.append(top)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [json.loads(row['data']) for row in rows]
+
+    def count(self, folder_id: str) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT COUNT(*) AS n FROM messages WHERE folder_id = ?', (folder_id,)
+            ).fetchone()
+        return row['n']
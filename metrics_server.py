@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Metrics Server
+Serves the collected instrumentation at /metrics in the OpenMetrics text format
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler
+from typing import Optional
+from urllib.parse import urlsplit
+
+from instrumentation import OPENMETRICS_CONTENT_TYPE, Instrumentation, get_instrumentation
+
+try:
+    from http.server import ThreadingHTTPServer
+except ImportError:
+    # Python 3.6
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.instrumentation.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer:
+    """Serve /metrics in the OpenMetrics text format from a background thread
+
+    Args:
+        instrumentation: Metrics to export, defaults to the shared instrumentation
+        host: Address to listen on
+        port: Port to listen on, 0 for any free port
+    """
+
+    def __init__(self, instrumentation: Optional[Instrumentation] = None, host: str = '127.0.0.1', port: int = 9464):
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.instrumentation = instrumentation if instrumentation is not None else get_instrumentation()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, config, instrumentation: Optional[Instrumentation] = None) -> 'MetricsServer':
+        """Create server listening on [metrics] host and port of config.txt"""
+        return cls(instrumentation,
+                   host=config.get('metrics', 'host', fallback='127.0.0.1'),
+                   port=config.getint('metrics', 'port', fallback=9464))
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
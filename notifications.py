@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""
+Change Notifications
+Graph webhook subscriptions and a concurrent listener that fetches only the
+messages a notification is about and passes them to handlers
+"""
+
+import hmac
+import json
+import logging
+import secrets
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler
+from typing import Callable, Dict, Iterable, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+import mail_api
+from graph_batch import GraphBatch
+from mail_api import EmailClient
+
+try:
+    from http.server import ThreadingHTTPServer
+except ImportError:
+    # Python 3.6
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+logger = logging.getLogger(__name__)
+
+# Longest subscription lifetime Graph allows for Outlook messages
+MAX_LIFETIME_MINUTES = 4230
+# Notifications remembered to drop the duplicates Graph may deliver
+SEEN_LIMIT = 10000
+
+
+def format_expiration(minutes: float) -> str:
+    expires = datetime.now(timezone.utc) + timedelta(minutes=minutes)
+    return expires.strftime('%Y-%m-%dT%H:%M:%S.0000000Z')
+
+
+def parse_expiration(value: str) -> float:
+    """Convert an expirationDateTime to a timestamp"""
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+
+
+class SubscriptionManager:
+    """Create Graph subscriptions and renew them before they expire
+
+    Args:
+        client: Email client used for the subscription requests
+        notification_url: Public HTTPS URL Graph posts notifications to
+        resources: Resources to subscribe to, e.g. "me/mailFolders('inbox')/messages"
+        change_type: Comma-separated change types, e.g. 'created,updated'
+        client_state: Secret echoed in every notification, random by default
+        lifetime: Minutes each subscription lasts, at most 4230
+        renew_margin: Minutes before expiry at which subscriptions are renewed
+    """
+
+    def __init__(self, client: EmailClient, notification_url: str,
+                 resources: Iterable[str] = ("me/mailFolders('inbox')/messages",), change_type: str = 'created',
+                 client_state: Optional[str] = None, lifetime: float = 4200, renew_margin: float = 60):
+        self.client = client
+        self.notification_url = notification_url
+        self.resources = list(resources)
+        self.change_type = change_type
+        self.client_state = client_state or secrets.token_urlsafe(24)
+        self.lifetime = min(lifetime, MAX_LIFETIME_MINUTES)
+        self.renew_margin = renew_margin
+        self.subscriptions = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def create(self, resource: str) -> Dict:
+        """Create a subscription; Graph validates the notification URL before this returns"""
+        subscription = self.client._send_json('POST', f'{mail_api.GRAPH_API_ENDPOINT}/subscriptions', {
+            'changeType': self.change_type,
+            'notificationUrl': self.notification_url,
+            'lifecycleNotificationUrl': self.notification_url,
+            'resource': resource,
+            'expirationDateTime': format_expiration(self.lifetime),
+            'clientState': self.client_state
+        }).json()
+        with self._lock:
+            self.subscriptions[subscription['id']] = subscription
+        logger.info(f"Subscribed to {resource} until {subscription['expirationDateTime']}")
+        return subscription
+
+    def renew(self, subscription_id: str) -> Dict:
+        """Extend a subscription, creating a new one if Graph has already removed it"""
+        with self._lock:
+            resource = self.subscriptions[subscription_id]['resource']
+        try:
+            subscription = self.client._send_json(
+                'PATCH', f'{mail_api.GRAPH_API_ENDPOINT}/subscriptions/{subscription_id}',
+                {'expirationDateTime': format_expiration(self.lifetime)}
+            ).json()
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            with self._lock:
+                self.subscriptions.pop(subscription_id, None)
+            return self.create(resource)
+        with self._lock:
+            self.subscriptions[subscription_id] = subscription
+        return subscription
+
+    def recreate(self, subscription_id: str) -> Dict:
+        """Replace a subscription Graph removed"""
+        with self._lock:
+            subscription = self.subscriptions.pop(subscription_id, None)
+        if subscription is None:
+            raise KeyError(f'Unknown subscription {subscription_id}')
+        return self.create(subscription['resource'])
+
+    def delete_all(self) -> None:
+        with self._lock:
+            subscription_ids = list(self.subscriptions)
+            self.subscriptions.clear()
+        for subscription_id in subscription_ids:
+            try:
+                self.client._send_json('DELETE', f'{mail_api.GRAPH_API_ENDPOINT}/subscriptions/{subscription_id}')
+            except requests.RequestException as e:
+                logger.warning(f"Failed to delete subscription {subscription_id}: {e}")
+
+    def matches_state(self, client_state: Optional[str]) -> bool:
+        return hmac.compare_digest(client_state or '', self.client_state)
+
+    def owns(self, subscription_id: str, client_state: Optional[str]) -> bool:
+        """Check that a notification belongs to one of our subscriptions"""
+        with self._lock:
+            known = subscription_id in self.subscriptions
+        return known and self.matches_state(client_state)
+
+    def start(self) -> None:
+        """Create one subscription per resource and start the renewal thread"""
+        for resource in self.resources:
+            self.create(resource)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._renew_periodically, name='subscription-renewal', daemon=True)
+        self._thread.start()
+
+    def stop(self, delete: bool = True) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if delete:
+            self.delete_all()
+
+    def _next_renewal(self) -> float:
+        with self._lock:
+            expirations = [parse_expiration(s['expirationDateTime']) for s in self.subscriptions.values()]
+        if not expirations:
+            return 60.0
+        return max(1.0, min(expirations) - self.renew_margin * 60 - datetime.now(timezone.utc).timestamp())
+
+    def _renew_periodically(self) -> None:
+        while not self._stopped.wait(self._next_renewal()):
+            now = datetime.now(timezone.utc).timestamp()
+            with self._lock:
+                due = [subscription_id for subscription_id, s in self.subscriptions.items()
+                       if parse_expiration(s['expirationDateTime']) - self.renew_margin * 60 <= now]
+            for subscription_id in due:
+                try:
+                    self.renew(subscription_id)
+                except requests.RequestException as e:
+                    logger.error(f"Failed to renew subscription {subscription_id}: {e}")
+
+
+class NotificationHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        query = parse_qs(urlsplit(self.path).query)
+        if 'validationToken' in query:
+            # Graph checks the endpoint by expecting the token back within 10 seconds
+            token = query['validationToken'][0].encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(token)))
+            self.end_headers()
+            self.wfile.write(token)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            notifications = json.loads(self.rfile.read(length)).get('value', [])
+        except ValueError:
+            self.send_response(400)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        # Acknowledge at once; Graph retries and eventually drops slow endpoints
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.server.listener.dispatch(notifications)
+
+
+class NotificationListener:
+    """Receive Graph change notifications and hand the changed messages to handlers
+
+    Notifications are acknowledged immediately and processed on a worker
+    pool. Each worker fetches only the messages the notifications name,
+    20 per $batch round trip, skips duplicates, and calls every handler
+    registered for the change type with (message, notification). Deleted
+    messages are passed as None.
+
+        with NotificationListener(client, 'https://example.com/notify') as listener:
+            listener.add_handler(lambda message, notification: print(message['subject']))
+            listener.serve_forever()
+
+    Args:
+        client: Email client used to manage subscriptions and fetch messages
+        notification_url: Public HTTPS URL that reaches this listener
+        host: Address to listen on
+        port: Port to listen on, 0 for any free port
+        resources: Resources to subscribe to
+        change_type: Comma-separated change types to subscribe to
+        select: Message fields to fetch, defaults to subject, receivedDateTime and from
+        body: Body to fetch: 'none', 'preview', 'text' or 'html'
+        workers: Threads processing notifications
+        subscribe: Whether to manage subscriptions, False when they are managed elsewhere
+        client_state: Secret shared with the subscriptions
+    """
+
+    def __init__(self, client: EmailClient, notification_url: str, host: str = '0.0.0.0', port: int = 8080,
+                 resources: Iterable[str] = ("me/mailFolders('inbox')/messages",), change_type: str = 'created',
+                 select: Optional[List[str]] = None, body: str = 'text', workers: int = 4,
+                 subscribe: bool = True, client_state: Optional[str] = None, lifetime: float = 4200):
+        self.client = client
+        self.select = select
+        self.body = body
+        self.subscriptions = SubscriptionManager(client, notification_url, resources, change_type,
+                                                 client_state, lifetime)
+        self.subscribe = subscribe
+        self.server = ThreadingHTTPServer((host, port), NotificationHandler)
+        self.server.daemon_threads = True
+        self.server.listener = self
+        self.workers = workers
+        self._executor = None
+        self._thread = None
+        self._handlers = []
+        self._lifecycle_handlers = []
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, client: EmailClient, config=None, **kwargs) -> 'NotificationListener':
+        """Create listener from the [notifications] section of config.txt"""
+        if config is None:
+            config = mail_api.load_config()
+        kwargs.setdefault('host', config.get('notifications', 'host', fallback='0.0.0.0'))
+        kwargs.setdefault('port', config.getint('notifications', 'port', fallback=8080))
+        kwargs.setdefault('change_type', config.get('notifications', 'change_type', fallback='created'))
+        kwargs.setdefault('workers', config.getint('notifications', 'workers', fallback=4))
+        kwargs.setdefault('lifetime', config.getfloat('notifications', 'lifetime_minutes', fallback=4200))
+        client_state = config.get('notifications', 'client_state', fallback='')
+        if client_state:
+            kwargs.setdefault('client_state', client_state)
+        return cls(client, config.get('notifications', 'notification_url'), **kwargs)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def add_handler(self, handler: Callable[[Optional[Dict], Dict], None],
+                    change_types: Iterable[str] = ('created', 'updated', 'deleted')) -> None:
+        """Call `handler(message, notification)` for notifications of the given change types"""
+        self._handlers.append((handler, frozenset(change_types)))
+
+    def add_lifecycle_handler(self, handler: Callable[[Dict], None]) -> None:
+        """Call `handler(notification)` for lifecycle events, e.g. 'missed' to trigger a resync"""
+        self._lifecycle_handlers.append(handler)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self) -> None:
+        """Start serving in a background thread, then create the subscriptions"""
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='notifications')
+        self._thread = threading.Thread(target=self.server.serve_forever, name='notification-listener', daemon=True)
+        self._thread.start()
+        # Graph validates the URL while the subscription is created, so serve first
+        if self.subscribe:
+            self.subscriptions.start()
+        logger.info(f"Listening for change notifications on port {self.port}")
+
+    def serve_forever(self) -> None:
+        """Block until stop() is called from another thread"""
+        self._thread.join()
+
+    def stop(self) -> None:
+        if self.subscribe:
+            self.subscriptions.stop()
+        # shutdown() waits for serve_forever(), which never ran if start() was not called
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread = None
+        self.server.server_close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def dispatch(self, notifications: List[Dict]) -> None:
+        """Queue a notification payload for processing"""
+        accepted = []
+        for notification in notifications:
+            if self.subscribe:
+                valid = self.subscriptions.owns(notification.get('subscriptionId'), notification.get('clientState'))
+            else:
+                valid = self.subscriptions.matches_state(notification.get('clientState'))
+            if not valid:
+                logger.warning(f"Ignoring notification with unknown subscription or client state "
+                               f"({notification.get('subscriptionId')})")
+                continue
+            accepted.append(notification)
+        if accepted:
+            self._executor.submit(self._process, accepted)
+
+    def _is_duplicate(self, notification: Dict) -> bool:
+        data = notification.get('resourceData') or {}
+        key = (notification.get('changeType'), data.get('id'), data.get('@odata.etag'))
+        with self._lock:
+            if key in self._seen:
+                return True
+            self._seen[key] = None
+            if len(self._seen) > SEEN_LIMIT:
+                self._seen.popitem(last=False)
+        return False
+
+    def _process(self, notifications: List[Dict]) -> None:
+        messages = []
+        for notification in notifications:
+            try:
+                if 'lifecycleEvent' in notification:
+                    self._handle_lifecycle(notification)
+                elif not self._is_duplicate(notification):
+                    messages.append(notification)
+            except Exception as e:
+                logger.error(f"Failed to process notification of subscription "
+                             f"{notification.get('subscriptionId')}: {e}")
+        try:
+            fetched = self._fetch(messages)
+        except Exception as e:
+            logger.error(f"Failed to fetch notified messages: {e}")
+            return
+        for notification, message in zip(messages, fetched):
+            for handler, change_types in self._handlers:
+                if notification.get('changeType') in change_types:
+                    self._call(handler, message, notification)
+
+    @staticmethod
+    def _call(handler: Callable, *args) -> None:
+        """Run one handler, logging its failure so the remaining handlers still run"""
+        try:
+            handler(*args)
+        except Exception as e:
+            logger.error(f"Notification handler {getattr(handler, '__name__', handler)} failed: {e}")
+
+    def _fetch(self, notifications: List[Dict]) -> List[Optional[Dict]]:
+        """Fetch the message of each notification, None for deletions or messages already gone"""
+        wanted = [(i, n['resourceData']['id']) for i, n in enumerate(notifications)
+                  if n.get('changeType') != 'deleted' and (n.get('resourceData') or {}).get('id')]
+        results = [None] * len(notifications)
+        if not wanted:
+            return results
+        if len(wanted) == 1:
+            index, message_id = wanted[0]
+            try:
+                results[index] = self.client.get_message(message_id, self.select, self.body)
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+            return results
+        with GraphBatch(self.client) as batch:
+            futures = [(index, batch.get_message(message_id, self.select, self.body)) for index, message_id in wanted]
+        for index, future in futures:
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                logger.warning(f"Failed to fetch notified message: {e}")
+        return results
+
+    def _handle_lifecycle(self, notification: Dict) -> None:
+        event = notification['lifecycleEvent']
+        subscription_id = notification.get('subscriptionId')
+        logger.info(f"Lifecycle event {event} for subscription {subscription_id}")
+        try:
+            if self.subscribe and event == 'reauthorizationRequired':
+                self.subscriptions.renew(subscription_id)
+            elif self.subscribe and event == 'subscriptionRemoved':
+                self.subscriptions.recreate(subscription_id)
+        except (requests.RequestException, KeyError) as e:
+            logger.error(f"Failed to handle {event} for subscription {subscription_id}: {e}")
+        for handler in self._lifecycle_handlers:
+            self._call(handler, notification)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Proxy Resolution
+Resolves the HTTP(S) proxy once and caches it for all Graph and token requests
+"""
+
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+ProxyMap = Dict[str, Optional[str]]
+ProxySource = Callable[[], Optional[ProxyMap]]
+
+NO_PROXY = {"http": None, "https": None}
+
+
+def _proxy_map(proxy_server: str) -> ProxyMap:
+    if '://' not in proxy_server:
+        proxy_server = f"http://{proxy_server}"
+    return {"http": proxy_server, "https": proxy_server}
+
+
+def registry_proxy() -> Optional[ProxyMap]:
+    """Read the proxy from Windows Internet Settings, None if not set or not on Windows"""
+    if sys.platform != 'win32':
+        return None
+    import winreg
+    try:
+        with winreg.OpenKey(winreg.HKEY_CURRENT_USER, r"Software\Microsoft\Windows\CurrentVersion\Internet Settings") as key:
+            proxy_enable, _ = winreg.QueryValueEx(key, "ProxyEnable")
+            proxy_server, _ = winreg.QueryValueEx(key, "ProxyServer")
+
+            if proxy_enable and proxy_server:
+                proxy_parts = proxy_server.split(":")
+                if len(proxy_parts) == 2:
+                    return _proxy_map(proxy_server)
+    except OSError:
+        pass
+    return None
+
+
+def environment_proxy() -> Optional[ProxyMap]:
+    """Read the proxy from HTTP_PROXY / HTTPS_PROXY environment variables"""
+    http_proxy = os.environ.get('HTTP_PROXY') or os.environ.get('http_proxy')
+    https_proxy = os.environ.get('HTTPS_PROXY') or os.environ.get('https_proxy')
+    if not http_proxy and not https_proxy:
+        return None
+    return {"http": http_proxy or https_proxy, "https": https_proxy or http_proxy}
+
+
+def static_proxy(proxy_server: str) -> ProxySource:
+    """Create a source that always returns the given proxy server, e.g. from config.txt"""
+    def source() -> Optional[ProxyMap]:
+        return _proxy_map(proxy_server) if proxy_server else None
+    return source
+
+
+class ProxyResolver:
+    """Resolve the proxy from a chain of sources and cache the result
+
+    Sources are tried in order and the first one returning a proxy map wins.
+    The result is cached for `ttl` seconds so the registry or environment
+    is not consulted on every request.
+    """
+
+    def __init__(self, sources: List[ProxySource] = None, ttl: float = 300):
+        self.sources = sources if sources is not None else [registry_proxy, environment_proxy]
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cached = None
+        self._resolved_at = 0.0
+
+    @classmethod
+    def from_config(cls, config) -> 'ProxyResolver':
+        """Create resolver from the optional [proxy] section of config.txt
+
+        An explicit `server` takes precedence over system proxy settings.
+        """
+        server = config.get('proxy', 'server', fallback='').strip()
+        ttl = config.getfloat('proxy', 'cache_ttl', fallback=300)
+        sources = [registry_proxy, environment_proxy]
+        if server:
+            sources.insert(0, static_proxy(server))
+        return cls(sources, ttl=ttl)
+
+    def resolve(self) -> ProxyMap:
+        """Get the proxy map for requests, resolving it again once the TTL has passed"""
+        now = time.monotonic()
+        cached = self._cached
+        if cached is not None and now - self._resolved_at < self.ttl:
+            return cached
+        with self._lock:
+            if self._cached is None or now - self._resolved_at >= self.ttl:
+                self._cached = self._resolve_uncached()
+                self._resolved_at = now
+            return self._cached
+
+    def invalidate(self) -> None:
+        """Drop the cached proxy so the next request resolves it again"""
+        with self._lock:
+            self._cached = None
+
+    def _resolve_uncached(self) -> ProxyMap:
+        for source in self.sources:
+            proxies = source()
+            if proxies:
+                return proxies
+        return dict(NO_PROXY)
+
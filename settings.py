@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Settings
+Lazily loaded config.txt, so importing the library touches no files, plus
+lazy imports for heavy dependencies only needed once a request is sent
+"""
+
+import configparser
+import importlib.util
+import io
+import os
+import sys
+import threading
+from types import ModuleType
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Import a module whose code only runs on first attribute access
+
+    Modules already imported are returned as they are. The lazy module is
+    registered in sys.modules, so later plain imports share it.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+class Settings:
+    """Configuration read from config.txt on first use
+
+    The file is parsed again only when its modification time or size
+    changes, so every client sees edits without re-reading it each time.
+
+    Args:
+        path: Configuration file, relative to the working directory at first use
+    """
+
+    def __init__(self, path: str = 'config.txt'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._config = None
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    @property
+    def config(self) -> configparser.ConfigParser:
+        """Parsed configuration, read now if not read yet or changed on disk"""
+        with self._lock:
+            stamp = self._file_stamp()
+            if self._config is None or stamp != self._stamp:
+                self._config = self._read()
+                self._stamp = stamp
+            return self._config
+
+    def _read(self) -> configparser.ConfigParser:
+        config = configparser.ConfigParser()
+        config.read(self.path, encoding='utf-8')
+        return config
+
+    def save(self, config: configparser.ConfigParser) -> None:
+        """Write the configuration to the file
+
+        The write holds the same file lock as the config.txt token store and
+        replaces the file atomically, so readers never see a partial file.
+        """
+        # Imported here to keep sqlite3 out of the library's import time
+        from token_store import atomic_write, file_lock
+
+        content = io.StringIO()
+        config.write(content)
+        with self._lock, file_lock(self.path):
+            atomic_write(self.path, content.getvalue())
+            self._config = None
+
+    @property
+    def client_id(self) -> str:
+        """Application (client) ID from the [microsoft] section"""
+        config = self.config
+        if not config.has_option('microsoft', 'client_id'):
+            raise KeyError(f"client_id missing from the [microsoft] section of {self.path}")
+        return config['microsoft']['client_id']
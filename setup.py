@@ -27,7 +27,7 @@ setup(
         "Development Status :: 4 - Beta",
         "Intended Audience :: Developers",
         "License :: OSI Approved :: MIT License",
-        "Operating System :: Microsoft :: Windows",
+        "Operating System :: OS Independent",
         "Programming Language :: Python :: 3",
         "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
@@ -43,6 +43,9 @@ setup(
     python_requires=">=3.6",
     install_requires=requirements,
     extras_require={
+        "async": [
+            "aiohttp>=3.8",
+        ],
         "dev": [
             "pytest>=6.0",
             "pytest-cov>=2.0",
@@ -55,6 +58,7 @@ setup(
         "console_scripts": [
             "outlook-auth=get_refresh_token:main",
             "outlook-mail=mail_api:main",
+            "outlook-daemon=mail_daemon:main",
         ],
     },
     include_package_data=True,
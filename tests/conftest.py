@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+import mail_api
+from stub_graph import StubGraphServer
+
+CONFIG = """[microsoft]
+client_id = test
+redirect_uri = http://localhost:8000
+
+[tokens]
+refresh_token = test
+access_token = test
+expires_at = 2999-01-01 00:00:00
+
+[retry]
+requests_per_second = 0
+backoff_base = 0
+"""
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    """Working directory holding a config.txt with a valid token"""
+    (tmp_path / 'config.txt').write_text(CONFIG, encoding='utf-8')
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def stub(config_dir, monkeypatch):
+    """Stub Graph server the mail_api endpoints point at"""
+    with StubGraphServer(message_count=25) as server:
+        monkeypatch.setattr(mail_api, 'GRAPH_API_ENDPOINT', server.graph_endpoint)
+        monkeypatch.setattr(mail_api, 'TOKEN_URL', server.token_url)
+        yield server
+
+
+@pytest.fixture
+def client(stub):
+    with mail_api.EmailClient() as client:
+        yield client
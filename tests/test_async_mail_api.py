@@ -0,0 +1,20 @@
+import asyncio
+
+from async_mail_api import AsyncEmailClient
+
+
+def test_client_created_outside_event_loop(stub):
+    client = AsyncEmailClient(max_concurrency=2)
+
+    async def fetch():
+        try:
+            return await asyncio.gather(*(client.get_messages(top=5) for _ in range(4)))
+        finally:
+            await client.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        pages = loop.run_until_complete(fetch())
+    finally:
+        loop.close()
+    assert [len(page) for page in pages] == [5, 5, 5, 5]
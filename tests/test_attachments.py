@@ -0,0 +1,68 @@
+import hashlib
+
+import pytest
+import requests
+
+import mail_api
+from attachments import UploadSession
+
+CHUNK_SIZE = 320 * 1024
+
+
+@pytest.fixture
+def large_file(config_dir):
+    path = config_dir / 'large.bin'
+    path.write_bytes(bytes(range(256)) * 4096 * 4)
+    return path
+
+
+def create_draft(client) -> str:
+    response = client._send_json('POST', f'{mail_api.GRAPH_API_ENDPOINT}/me/messages', {'subject': 'Draft'})
+    return response.json()['id']
+
+
+def upload_requests(stub) -> int:
+    return sum(count for key, count in stub.request_counts.items() if key.startswith('upload/'))
+
+
+def uploaded(stub, draft_id: str) -> list:
+    return [item['sha256'] for item in stub.server.drafts[draft_id]['attachments']]
+
+
+def test_large_attachment_is_sent_in_chunks(client, stub, large_file):
+    assert client.send_email(['to@example.com'], 'Report', 'Attached', attachments=[str(large_file)])
+
+    [message] = stub.server.sent
+    [attachment] = message['attachments']
+    assert attachment['name'] == 'large.bin'
+    assert attachment['sha256'] == hashlib.sha256(large_file.read_bytes()).hexdigest()
+    assert upload_requests(stub) == 2
+
+
+def test_failed_chunk_resumes_from_next_expected_range(client, stub, large_file):
+    draft_id = create_draft(client)
+    session = client.create_upload_session(draft_id, str(large_file), chunk_size=CHUNK_SIZE)
+    stub.server.fail_next.extend([None, (400, None)])
+
+    session.upload()
+
+    assert uploaded(stub, draft_id) == [hashlib.sha256(large_file.read_bytes()).hexdigest()]
+    # 13 chunks, the failed one again, and one status query
+    assert upload_requests(stub) == 13 + 1 + 1
+
+
+def test_another_session_resumes_interrupted_upload(client, stub, large_file, monkeypatch):
+    draft_id = create_draft(client)
+    session = client.create_upload_session(draft_id, str(large_file), chunk_size=CHUNK_SIZE)
+    stub.server.fail_next.extend([None, None, (400, None)])
+    monkeypatch.setattr(client.retry_policy, 'max_retries', 0)
+    with pytest.raises(requests.HTTPError):
+        session.upload()
+    assert session.offset == 2 * CHUNK_SIZE
+
+    resumed = UploadSession(client, session.upload_url, str(large_file), chunk_size=CHUNK_SIZE)
+    assert resumed.status() == 2 * CHUNK_SIZE
+    resumed.upload()
+
+    assert uploaded(stub, draft_id) == [hashlib.sha256(large_file.read_bytes()).hexdigest()]
+    assert upload_requests(stub) == 13 + 1 + 1
@@ -0,0 +1,50 @@
+from http.client import RemoteDisconnected
+
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NameResolutionError, NewConnectionError, ProtocolError
+
+from bulk_send import BulkSender, Outbox, classify_error
+
+
+def http_error(status: int, retry_after=None) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    if retry_after is not None:
+        response.headers['Retry-After'] = retry_after
+    return requests.HTTPError(f'{status} error', response=response)
+
+
+def connection_error(reason: Exception) -> requests.ConnectionError:
+    return requests.ConnectionError(MaxRetryError(None, 'https://graph.example/v1.0/me/sendMail', reason))
+
+
+@pytest.mark.parametrize('error, expected', [
+    (http_error(429, '10'), 'retry'),
+    (http_error(503, '10'), 'retry'),
+    (http_error(429), 'unknown'),
+    (http_error(502), 'unknown'),
+    (http_error(504), 'unknown'),
+    (http_error(400), None),
+    (requests.ConnectTimeout(), 'retry'),
+    (requests.ReadTimeout(), 'unknown'),
+    (connection_error(NewConnectionError(None, 'Connection refused')), 'retry'),
+    (connection_error(NameResolutionError('graph.example', None, 'no such host')), 'retry'),
+    (requests.ConnectionError(ProtocolError('Connection aborted.', RemoteDisconnected('closed'))), 'unknown'),
+    (requests.ConnectionError(ConnectionResetError(104, 'reset by peer')), 'unknown'),
+    (ValueError('bad attachment'), None),
+], ids=lambda value: repr(value) if not isinstance(value, Exception) else type(value).__name__)
+def test_classify_error(error, expected):
+    assert classify_error(error) == expected
+
+
+def test_gateway_error_is_not_sent_twice(client, stub):
+    stub.server.fail_next.append((502, None))
+    with Outbox(':memory:') as outbox:
+        outbox.enqueue(['to@contoso.com'], 'Subject', 'Body')
+        sender = BulkSender(outbox, clients={'default': client}, workers=1, retry_delay=0)
+
+        summary = sender.run()
+
+    assert summary['unknown'] == 1 and summary['sent'] == 0
+    assert stub.request_counts['me/sendMail'] == 1
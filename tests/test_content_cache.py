@@ -0,0 +1,134 @@
+import os
+
+import pytest
+
+import mail_api
+from content_cache import ContentCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with ContentCache(str(tmp_path / 'cache'), max_bytes=10000, inline_limit=100) as cache:
+        yield cache
+
+
+def object_files(cache):
+    root = os.path.join(cache.directory, 'objects')
+    return [os.path.join(path, name) for path, _, names in os.walk(root) for name in names]
+
+
+def test_small_items_stay_inline(cache):
+    cache.put('message:1', b'hello', change_key='ck1', etag='W/"1"')
+
+    entry = cache.get('message:1')
+    assert entry.data == b'hello' and entry.path is None
+    assert (entry.change_key, entry.etag) == ('ck1', 'W/"1"')
+    assert object_files(cache) == []
+
+
+def test_large_items_go_to_content_addressed_files(cache):
+    cache.put('message:1', b'x' * 500)
+
+    entry = cache.get('message:1')
+    assert entry.data is None
+    assert entry.read() == b'x' * 500
+    assert object_files(cache) == [entry.path]
+
+
+def test_change_key_mismatch_is_a_miss(cache):
+    cache.put('message:1', b'old', change_key='ck1')
+
+    assert cache.get('message:1', change_key='ck2') is None
+    assert cache.get('message:1', change_key='ck1').read() == b'old'
+
+
+def test_put_stream_and_copy_to(cache, tmp_path):
+    cache.put_stream('attachment:1', [b'a' * 300, b'b' * 300])
+
+    destination = tmp_path / 'out.bin'
+    assert cache.copy_to('attachment:1', str(destination))
+    assert destination.read_bytes() == b'a' * 300 + b'b' * 300
+    assert not cache.copy_to('attachment:2', str(destination))
+
+
+def test_identical_content_shares_one_file(cache):
+    cache.put('message:1', b'y' * 500)
+    cache.put('message:2', b'y' * 500)
+    assert len(object_files(cache)) == 1
+
+    cache.delete('message:1')
+    assert cache.get('message:2').read() == b'y' * 500
+    cache.delete('message:2')
+    assert object_files(cache) == []
+
+
+def test_least_recently_used_entries_are_evicted(cache):
+    for i in range(4):
+        cache.put(f'message:{i}', bytes([i]) * 3000)
+    # 12000 bytes do not fit in 10000, so the oldest entry went
+    assert cache.get('message:0') is None
+    assert cache.total_bytes <= cache.max_bytes
+
+    cache.get('message:1')
+    cache.put('message:4', b'z' * 3000)
+    assert cache.get('message:1') is not None
+    assert cache.get('message:2') is None
+
+
+def test_storing_the_same_content_again_keeps_the_file(cache):
+    cache.put('message:1', b'x' * 500, change_key='ck1')
+    cache.put('message:1', b'x' * 500, change_key='ck1')
+
+    entry = cache.get('message:1')
+    assert entry is not None and entry.read() == b'x' * 500
+    assert object_files(cache) == [entry.path]
+
+
+def test_replacing_content_removes_the_old_file(cache):
+    cache.put('message:1', b'x' * 500)
+    cache.put('message:1', b'y' * 500)
+
+    entry = cache.get('message:1')
+    assert entry.read() == b'y' * 500
+    assert object_files(cache) == [entry.path]
+
+
+def test_size_cap_counts_entries_of_other_processes(cache):
+    with ContentCache(cache.directory, max_bytes=10000, inline_limit=100) as other:
+        other.put('message:other', b'o' * 6000)
+        cache.put('message:1', b'x' * 6000)
+
+        assert cache.total_bytes == other.total_bytes == 6000
+        assert cache.get('message:other') is None
+
+
+def test_hits_do_not_write_until_a_batch_is_due(cache):
+    cache.put('message:1', b'hello')
+    changes = cache._conn.total_changes
+
+    for _ in range(10):
+        cache.get('message:1')
+    assert cache._conn.total_changes == changes
+
+
+def test_new_entry_is_never_evicted_by_its_own_insert(cache):
+    cache.put('message:1', b'a' * 3000)
+
+    entry = cache.put_stream('attachment:big', [b'b' * 12000])
+
+    assert cache.get('message:1') is None
+    assert cache.get('attachment:big').read() == b'b' * 12000
+    assert os.path.exists(entry.path)
+
+
+def test_download_attachment_is_served_from_cache(stub, config_dir, cache):
+    with mail_api.EmailClient(cache=cache) as client:
+        first = client.download_attachment('msg-1', 'att-0', str(config_dir / 'first.bin'))
+        second = client.download_attachment('msg-1', 'att-0', str(config_dir / 'second.bin'))
+        counters = client.retry_metrics.snapshot()
+
+    assert first == second == stub.server.attachment_size
+    assert (config_dir / 'first.bin').read_bytes() == (config_dir / 'second.bin').read_bytes()
+    assert stub.request_counts['me/messages'] == 1
+    assert (counters['cache_misses'], counters['cache_hits']) == (1, 1)
+    assert not (config_dir / 'second.bin.part').exists()
@@ -0,0 +1,62 @@
+import json
+from collections import Counter
+
+import pytest
+
+from crawler import CrawlCheckpoint, JsonlSink, MailboxCrawler
+
+
+class CrashingSink(JsonlSink):
+    """Sink that dies halfway through writing page number `crash_at`"""
+
+    def __init__(self, path: str, crash_at: int):
+        super().__init__(path)
+        self.crash_at = crash_at
+        self.pages = 0
+
+    def write(self, folder, messages):
+        self.pages += 1
+        if self.pages == self.crash_at:
+            super().write(folder, messages[:3])
+            self._file.write(b'{"truncated')
+            raise OSError('disk gone')
+        super().write(folder, messages)
+
+
+def read_records(path) -> list:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def discovery_requests(stub) -> int:
+    # Two folders per page: three top-level pages, inbox and projects children
+    return 2 + 1 + 1
+
+
+def test_interrupted_crawl_resumes_without_duplicates(client, stub, config_dir):
+    output = str(config_dir / 'mail.jsonl')
+    folders = len(stub.server.folders)
+
+    with CrawlCheckpoint(str(config_dir / 'crawl.db')) as checkpoint:
+        sink = CrashingSink(output, crash_at=5)
+        with pytest.raises(OSError):
+            MailboxCrawler(client, sink, checkpoint, workers=2, page_size=10).run()
+        sink.close()
+        interrupted = checkpoint.totals()
+        assert 0 < interrupted['done'] < folders
+
+    first_run = stub.request_counts['me/mailFolders']
+    with CrawlCheckpoint(str(config_dir / 'crawl.db')) as checkpoint:
+        sink = JsonlSink(output)
+        summary = MailboxCrawler(client, sink, checkpoint, workers=2, page_size=10).run()
+        sink.close()
+
+    records = read_records(output)
+    keys = Counter((record['_folder'], record['id']) for record in records)
+    assert len(records) == folders * 25
+    assert max(keys.values()) == 1
+    assert summary['totals'] == {'folders': folders, 'done': folders, 'messages': folders * 25}
+    assert summary['messages'] == folders * 25 - interrupted['messages']
+    # Only the pages missing from the checkpoint are fetched again
+    second_run = stub.request_counts['me/mailFolders'] - first_run
+    assert second_run < discovery_requests(stub) + folders * 3
@@ -0,0 +1,64 @@
+import pytest
+
+from graph_batch import GraphBatch, GraphBatchError
+
+
+def batch_requests(stub) -> int:
+    return stub.request_counts['$batch']
+
+
+def test_responses_resolve_their_own_futures(client, stub):
+    with GraphBatch(client) as batch:
+        messages = [batch.get_message(f'msg-{i}', select=['subject']) for i in (4, 0, 2)]
+        moved = batch.move_message('msg-1', 'archive')
+        sent = batch.send_email(['to@example.com'], 'Subject', 'Body')
+        missing = batch.get_message('msg-999')
+
+    assert batch_requests(stub) == 1
+    assert [future.result()['id'] for future in messages] == ['msg-4', 'msg-0', 'msg-2']
+    assert moved.result() == 'msg-1-moved'
+    assert sent.result() is True
+    with pytest.raises(GraphBatchError) as excinfo:
+        missing.result()
+    assert excinfo.value.status == 404
+    assert stub.server.moved == [('msg-1', 'archive')]
+
+
+def test_throttled_items_are_sent_again(client, stub):
+    stub.server.fail_next.extend([(429, 0), (503, 0)])
+
+    with GraphBatch(client) as batch:
+        futures = [batch.get_message(f'msg-{i}') for i in range(5)]
+
+    assert [future.result()['id'] for future in futures] == [f'msg-{i}' for i in range(5)]
+    assert batch_requests(stub) == 2
+    assert stub.request_counts['me/messages'] == 7
+    assert client.retry_metrics.snapshot()['throttled'] == 2
+
+
+def test_sends_when_max_size_is_queued(client, stub):
+    batch = GraphBatch(client, max_size=3)
+    futures = [batch.get_message(f'msg-{i}') for i in range(4)]
+
+    assert batch_requests(stub) == 1
+    assert all(future.done() for future in futures[:3])
+    assert not futures[3].done()
+    batch.close()
+    assert batch_requests(stub) == 2
+    assert futures[3].result()['id'] == 'msg-3'
+
+
+def test_max_size_is_capped_at_graph_limit(client, stub):
+    with GraphBatch(client, max_size=50) as batch:
+        futures = [batch.get_message(f'msg-{i}') for i in range(25)]
+
+    assert batch.max_size == 20
+    assert batch_requests(stub) == 2
+    assert all(future.result() for future in futures)
+
+
+def test_flush_interval_sends_in_background(client, stub):
+    with GraphBatch(client, flush_interval=0.05) as batch:
+        future = batch.get_message('msg-0')
+        assert future.result(timeout=5)['id'] == 'msg-0'
+        assert batch_requests(stub) == 1
@@ -0,0 +1,49 @@
+import configparser
+import json
+import logging
+
+import pytest
+
+from instrumentation import Instrumentation, JsonFormatter, configure_logging
+
+
+@pytest.fixture
+def root_logger():
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    yield root
+    root.handlers, root.level = handlers, level
+
+
+def metrics_config(log_format: str) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read_dict({'metrics': {'log_format': log_format}})
+    return config
+
+
+def test_json_log_format_switches_all_logging_to_json(root_logger, capsys):
+    root_logger.setLevel(logging.WARNING)
+    configure_logging(metrics_config('json'))
+    instrumentation = Instrumentation.from_config(metrics_config('json'))
+
+    assert [type(handler.formatter) for handler in root_logger.handlers] == [JsonFormatter]
+    logging.getLogger('app').info('plain record')
+    instrumentation.record_request('GET', 'https://graph.microsoft.com/v1.0/me/messages', 200, 0.05)
+
+    lines = [json.loads(line) for line in capsys.readouterr().err.splitlines()]
+    assert lines[0]['message'] == 'plain record'
+    assert lines[1]['event'] == 'graph_request' and lines[1]['status'] == 200
+
+
+def test_json_log_format_leaves_logging_to_the_application(root_logger):
+    handlers = root_logger.handlers[:]
+    Instrumentation.from_config(metrics_config('json'))
+
+    assert root_logger.handlers == handlers
+
+
+def test_text_log_format_leaves_logging_alone(root_logger):
+    handlers = root_logger.handlers[:]
+    Instrumentation.from_config(metrics_config('text'))
+
+    assert root_logger.handlers == handlers
@@ -0,0 +1,125 @@
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+import junk_triage
+from conftest import ROOT
+from junk_triage import JunkTriage, RuleModel
+from throttling import MAILBOX_CONCURRENCY
+
+
+def message(address: str, subject: str = '', preview: str = '') -> dict:
+    return {'from': {'emailAddress': {'address': address}}, 'subject': subject, 'bodyPreview': preview}
+
+
+@pytest.fixture
+def model():
+    return RuleModel(
+        senders={'Boss@Contoso.com': 5},
+        domains={'contoso.com': 1, 'promo.contoso.com': -3},
+        keywords={'invoice': 1.5, 'free money': -4, '$$$': -2},
+        threshold=2
+    )
+
+
+def test_scores_add_sender_domain_and_keyword_weights(model):
+    scores = model.score_batch([
+        message('boss@contoso.com'),
+        message('billing@mail.contoso.com', 'Your INVOICE', 'invoice attached'),
+        message('deals@promo.contoso.com', 'invoice'),
+        message('x@example.com', 'free   money $$$'),
+        {'id': 'no-sender'}
+    ])
+
+    assert scores == [6.0, 2.5, -0.5, -6.0, 0.0]
+
+
+def test_keywords_match_whole_words_only(model):
+    assert model.score(message('a@example.com', 'invoices')) == 0.0
+
+
+def test_explain_lists_matching_rules(model):
+    assert model.explain(message('boss@contoso.com', 'invoice')) == [
+        ('sender:boss@contoso.com', 5.0), ('domain:contoso.com', 1.0), ('keyword:invoice', 1.5)
+    ]
+
+
+def test_load_rejects_unknown_keys(tmp_path):
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps({'threshold': 1, 'sender': {}}), encoding='utf-8')
+
+    with pytest.raises(ValueError):
+        RuleModel.load(str(path))
+
+
+def test_load_with_threshold_override(tmp_path):
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps({'threshold': 1, 'domains': {'example.com': 1}}), encoding='utf-8')
+
+    assert RuleModel.load(str(path), threshold=3).threshold == 3.0
+
+
+def test_run_moves_rescued_messages_in_batches(client, stub):
+    stub.server.message_count = 100
+    model = RuleModel(domains={'example.com': 1}, keywords={'stub message 7': -5}, threshold=1)
+
+    summary = JunkTriage(client, model).run()
+
+    assert (summary['scanned'], summary['rescued'], summary['moved'], summary['failed']) == (100, 99, 99, 0)
+    assert all(destination == 'inbox' for _, destination in stub.server.moved)
+    assert 'junkemail-msg-7' not in [message_id for message_id, _ in stub.server.moved]
+    assert stub.request_counts['me/mailFolders'] == 1
+    assert stub.request_counts['$batch'] == 5
+
+
+def test_dry_run_moves_nothing(client, stub):
+    summary = JunkTriage(client, RuleModel(domains={'example.com': 1})).run(dry_run=True)
+
+    assert summary['rescued'] == 25 and summary['moved'] == 0
+    assert stub.server.moved == []
+
+
+def test_concurrent_batches_are_capped_per_mailbox(client, stub, monkeypatch):
+    stub.server.message_count = 400
+    stub.server.latency = 0.05
+    active, peak = [0], [0]
+    lock = threading.Lock()
+    request = client._request
+
+    def counting_request(method, url, **kwargs):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        try:
+            return request(method, url, **kwargs)
+        finally:
+            with lock:
+                active[0] -= 1
+
+    monkeypatch.setattr(client, '_request', counting_request)
+    triage = JunkTriage(client, RuleModel(domains={'example.com': 1}), workers=16)
+    summary = triage.run()
+
+    assert triage.workers == MAILBOX_CONCURRENCY
+    assert summary['moved'] == 400
+    assert peak[0] == MAILBOX_CONCURRENCY
+
+
+def test_example_rules_file_loads():
+    model = RuleModel.load(os.path.join(ROOT, 'junk_rules.example.json'))
+
+    assert model.threshold == 2
+    assert model.score(message('billing@contoso.com', 'Your invoice')) == 9.5
+
+
+def test_missing_rules_file_is_a_clear_error(config_dir, monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['junk_triage.py', '--dry-run'])
+
+    with pytest.raises(SystemExit) as excinfo:
+        junk_triage.main()
+
+    assert excinfo.value.code == 2
+    assert 'copy junk_rules.example.json to junk_rules.json' in capsys.readouterr().err
@@ -0,0 +1,25 @@
+import subprocess
+import sys
+
+import instrumentation
+import mail_api
+from conftest import ROOT
+
+
+def test_import_reads_no_config_and_loads_no_requests(tmp_path):
+    # requests is registered lazily, urllib3 only loads once its code runs
+    code = 'import sys, mail_api; print("urllib3" in sys.modules, mail_api.settings._config is None)'
+    result = subprocess.run([sys.executable, '-c', code], cwd=str(tmp_path), env={'PYTHONPATH': ROOT},
+                            stdout=subprocess.PIPE, check=True)
+
+    assert result.stdout.split() == [b'False', b'True']
+
+
+def test_client_id_is_read_on_access(config_dir):
+    assert mail_api.CLIENT_ID == 'test'
+
+
+def test_metrics_server_is_reexported():
+    import metrics_server
+
+    assert instrumentation.MetricsServer is metrics_server.MetricsServer
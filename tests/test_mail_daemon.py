@@ -0,0 +1,112 @@
+import threading
+import time
+
+import logging
+import os
+import signal
+import sys
+
+import pytest
+
+import mail_api
+import mail_daemon
+from mail_daemon import MailDaemon, account_store_path
+from stub_graph import StubGraphHandler, StubGraphServer
+
+FOLDERS = ['inbox', 'junkemail', 'archive', 'sentitems', 'projects', 'receipts']
+
+
+class ConcurrencyHandler(StubGraphHandler):
+    """Stub handler recording the most delta requests served at the same time"""
+
+    def delta_page(self, url, headers):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        try:
+            time.sleep(0.05)
+            return super().delta_page(url, headers)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+@pytest.fixture
+def counting_stub(config_dir, monkeypatch):
+    with StubGraphServer(ConcurrencyHandler, message_count=5) as server:
+        server.server.active = server.server.peak = 0
+        monkeypatch.setattr(mail_api, 'GRAPH_API_ENDPOINT', server.graph_endpoint)
+        monkeypatch.setattr(mail_api, 'TOKEN_URL', server.token_url)
+        yield server
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_due_jobs_wait_for_a_free_worker(counting_stub, config_dir):
+    daemon = MailDaemon(folders=FOLDERS, workers=2, min_interval=0.01, max_interval=0.05,
+                        store_path=str(config_dir / 'messages.db'))
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    try:
+        wait_for(lambda: all(job['runs'] >= 2 for job in daemon.status()))
+    finally:
+        daemon.stop()
+        thread.join(10)
+
+    assert not thread.is_alive()
+    assert counting_stub.server.peak == 2
+
+
+def test_stop_runs_no_queued_syncs(stub, config_dir):
+    stub.server.latency = 0.3
+    daemon = MailDaemon(folders=FOLDERS, workers=1, min_interval=0.01, store_path=str(config_dir / 'messages.db'))
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    time.sleep(0.5)
+
+    stopped = time.monotonic()
+    daemon.stop()
+    thread.join(10)
+
+    assert not thread.is_alive()
+    # Only the sync running at stop() finishes; six queued syncs would take over 1.5 s
+    assert time.monotonic() - stopped < 1.0
+    assert sum(job['runs'] for job in daemon.status()) <= 3
+
+
+@pytest.fixture
+def restore_signals():
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def test_sigterm_drains_running_sync(stub, config_dir, monkeypatch, restore_signals, caplog):
+    stub.server.latency = 0.3
+    monkeypatch.setattr(sys, 'argv', ['mail_daemon.py', '--workers', '1'] +
+                        [arg for folder in FOLDERS for arg in ('--folder', folder)])
+    timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+
+    started = time.monotonic()
+    with caplog.at_level(logging.INFO, logger='mail_daemon'):
+        mail_daemon.main()
+    timer.join()
+
+    assert 'Received SIGTERM, shutting down' in caplog.messages
+    assert 'Daemon stopped' in caplog.messages
+    # The sync running at the signal finishes; the other five would take 1.5 s more
+    assert time.monotonic() - started < 1.5
+    assert stub.request_counts['me/mailFolders'] <= 3
+
+
+def test_accounts_get_their_own_store():
+    assert account_store_path('messages.db', 'default') == 'messages.db'
+    assert account_store_path('data/messages.db', 'second') == 'data/messages.second.db'
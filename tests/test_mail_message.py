@@ -0,0 +1,95 @@
+import json
+
+import pytest
+
+from mail_message import JsonPageStream, Message
+
+GRAPH_MESSAGE = {
+    'id': 'msg-1',
+    'changeKey': 'ck-1',
+    'subject': '四半期レポート',
+    'receivedDateTime': '2024-01-01T00:00:00Z',
+    'from': {'emailAddress': {'address': 'a@contoso.com', 'name': 'A'}},
+    'body': {'contentType': 'text', 'content': 'こんにちは、世界 ' * 20},
+    'bodyPreview': 'こんにちは',
+    'isRead': False,
+    'categories': ['Blue']
+}
+
+
+def chunked(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 64, 100000])
+def test_items_parse_across_any_chunk_boundary(chunk_size):
+    page = {
+        'value': [dict(GRAPH_MESSAGE, id=f'msg-{i}', size=12345 + i) for i in range(5)],
+        '@odata.nextLink': 'https://graph.example/next'
+    }
+    stream = JsonPageStream(chunked(json.dumps(page, ensure_ascii=False).encode('utf-8'), chunk_size))
+
+    assert list(stream.items()) == page['value']
+    assert stream.metadata == {'@odata.nextLink': 'https://graph.example/next'}
+
+
+def test_metadata_before_the_array_is_kept():
+    data = b'{"@odata.context": "ctx", "value": [], "@odata.deltaLink": "delta"}'
+    stream = JsonPageStream(chunked(data, 5))
+
+    assert list(stream.items()) == []
+    assert stream.metadata == {'@odata.context': 'ctx', '@odata.deltaLink': 'delta'}
+
+
+def test_items_are_yielded_before_the_stream_ends():
+    def chunks():
+        yield b'{"value": [{"id": "1"},'
+        raise AssertionError('read past the first item')
+
+    assert next(JsonPageStream(chunks()).items()) == {'id': '1'}
+
+
+def test_truncated_stream_raises():
+    with pytest.raises(ValueError):
+        list(JsonPageStream([b'{"value": [{"id": "1"}']).items())
+
+
+def test_message_round_trips_to_the_graph_dict():
+    message = Message.from_graph(GRAPH_MESSAGE)
+
+    assert message.sender == 'a@contoso.com'
+    assert message.body == GRAPH_MESSAGE['body']['content']
+    assert message.body_bytes == GRAPH_MESSAGE['body']['content'].encode('utf-8')
+    assert message.extra == {'categories': ['Blue']}
+    assert message.to_dict() == GRAPH_MESSAGE
+
+
+def test_item_access_mirrors_the_graph_dict():
+    message = Message.from_graph(GRAPH_MESSAGE)
+
+    assert message['from']['emailAddress']['address'] == 'a@contoso.com'
+    assert message['subject'] == GRAPH_MESSAGE['subject']
+    assert message['categories'] == ['Blue']
+    with pytest.raises(KeyError):
+        message['hasAttachments']
+
+
+def test_message_without_body():
+    message = Message.from_graph({'id': 'msg-2', 'subject': 'Hi'})
+
+    assert message.body is None
+    assert message.to_dict() == {'id': 'msg-2', 'subject': 'Hi'}
+
+
+def test_body_keeps_the_decoded_string():
+    message = Message.from_graph(GRAPH_MESSAGE)
+
+    assert message.body is GRAPH_MESSAGE['body']['content']
+
+
+def test_item_access_does_not_rebuild_the_dict(monkeypatch):
+    message = Message.from_graph(GRAPH_MESSAGE)
+    monkeypatch.setattr(Message, 'to_dict', lambda self: pytest.fail('to_dict called'))
+
+    assert message['id'] == 'msg-1'
+    assert message['body']['contentType'] == 'text'
@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from mail_api import build_message_query
+from mail_query import MessageQuery, quote_search
+
+
+def message(address='billing@contoso.com', received='2024-03-01T10:00:00Z', subject='Invoice for March',
+            has_attachments=True):
+    return {
+        'from': {'emailAddress': {'address': address}},
+        'receivedDateTime': received,
+        'subject': subject,
+        'hasAttachments': has_attachments
+    }
+
+
+def test_filter_puts_received_date_first():
+    query = MessageQuery(sender='Billing@Contoso.com', since=datetime(2024, 1, 1), has_attachments=True)
+
+    assert query.to_filter() == (
+        "receivedDateTime ge 2024-01-01T00:00:00Z and from/emailAddress/address eq 'billing@contoso.com' "
+        "and hasAttachments eq true"
+    )
+
+
+def test_filter_without_dates_adds_an_open_date_range():
+    assert MessageQuery(has_attachments=False).to_filter() == (
+        'receivedDateTime ge 1900-01-01T00:00:00Z and hasAttachments eq false'
+    )
+
+
+def test_filter_escapes_quotes():
+    assert MessageQuery(sender="o'brien@contoso.com").to_filter().endswith("eq 'o''brien@contoso.com'")
+
+
+def test_empty_query_compiles_to_nothing():
+    assert MessageQuery().to_graph() == (None, None)
+
+
+def test_dates_are_normalized_to_utc():
+    query = MessageQuery(since='2024-01-01T02:00:00+02:00')
+
+    assert query.since == datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def test_word_predicates_need_search():
+    query = MessageQuery(sender='billing@contoso.com', subject_contains='invoice')
+
+    filter, search = query.to_graph()
+    assert filter is None and search
+
+
+def test_sql_with_full_text_index():
+    query = MessageQuery(sender='billing@contoso.com', until='2024-06-30', subject_contains='quarterly report',
+                         text='budget')
+
+    clauses, params, match = query.to_sql()
+    assert clauses == ['m.sender = ? COLLATE NOCASE', 'm.received_at < ?']
+    assert params == ['billing@contoso.com', '2024-06-30T00:00:00Z']
+    assert match == 'subject : ("quarterly"* "report"*) AND ("budget"*)'
+
+
+def test_sql_without_full_text_index_uses_like():
+    clauses, params, match = MessageQuery(subject_contains='invoice').to_sql(fts=False)
+
+    assert clauses == ['m.subject LIKE ?']
+    assert params == ['%invoice%']
+    assert match is None
+
+
+def test_matches_checks_every_predicate_but_text():
+    query = MessageQuery(sender='billing@contoso.com', since='2024-02-01', until='2024-04-01',
+                         has_attachments=True, subject_contains='invoice', text='ignored')
+
+    assert query.matches(message())
+    assert not query.matches(message(address='other@contoso.com'))
+    assert not query.matches(message(received='2024-04-01T00:00:00Z'))
+    assert not query.matches(message(has_attachments=False))
+    assert not query.matches(message(subject='Receipt'))
+
+
+def search_param(query: MessageQuery) -> str:
+    filter, search = query.to_graph()
+    return build_message_query(filter=filter, search=search)[0]['$search']
+
+
+def test_field_query_is_sent_as_one_quoted_search():
+    query = MessageQuery(subject_contains='quarterly report')
+
+    assert query.to_search() == 'subject:"quarterly report"'
+    assert search_param(query) == r'"subject:\"quarterly report\""'
+
+
+def test_compound_query_is_sent_as_one_quoted_search():
+    query = MessageQuery(text='invoice', sender='a@b.com', since='2024-01-01')
+
+    assert query.to_search() == '"invoice" AND from:"a@b.com" AND received>=2024-01-01'
+    assert search_param(query) == r'"\"invoice\" AND from:\"a@b.com\" AND received>=2024-01-01"'
+
+
+def test_until_midnight_searches_up_to_the_day_before():
+    assert MessageQuery(text='x', until='2024-06-30').to_search() == '"x" AND received<=2024-06-29'
+
+
+def test_plain_search_words_are_quoted_once():
+    assert build_message_query(search='invoice')[0]['$search'] == '"invoice"'
+    assert build_message_query(search='"invoice"')[0]['$search'] == r'"\"invoice\""'
+    assert '$orderby' not in build_message_query(search='invoice')[0]
+
+
+def test_backslashes_are_escaped():
+    assert quote_search('a\\b') == r'"a\\b"'
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2024-03-01', datetime(2024, 3, 1, tzinfo=timezone.utc)),
+    ('2024-03-01T10:00:00Z', datetime(2024, 3, 1, 10, tzinfo=timezone.utc)),
+    ('2024-03-01T10:00:00.1234567Z', datetime(2024, 3, 1, 10, 0, 0, 123456, tzinfo=timezone.utc)),
+    ('2024-03-01T12:30:00+02:00', datetime(2024, 3, 1, 10, 30, tzinfo=timezone.utc)),
+    ('2024-03-01 10:00-0130', datetime(2024, 3, 1, 11, 30, tzinfo=timezone.utc)),
+])
+def test_since_accepts_iso_strings(value, expected):
+    assert MessageQuery(since=value).since == expected
+
+
+def test_invalid_date_string_is_rejected():
+    with pytest.raises(ValueError):
+        MessageQuery(since='March 1st')
+
+
+def test_aware_datetimes_are_converted_to_utc():
+    since = datetime(2024, 3, 1, 9, tzinfo=timezone(timedelta(hours=-5)))
+
+    assert MessageQuery(since=since).since == datetime(2024, 3, 1, 14, tzinfo=timezone.utc)
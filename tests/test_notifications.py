@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+import requests
+
+from notifications import NotificationListener
+
+
+class Received:
+    """Handler collecting (message, notification) calls"""
+
+    def __init__(self):
+        self.calls = []
+        self.event = threading.Event()
+
+    def __call__(self, message, notification):
+        self.calls.append((message, notification))
+        self.event.set()
+
+    def wait(self, count: int = 1, timeout: float = 5) -> list:
+        while len(self.calls) < count:
+            assert self.event.wait(timeout)
+            self.event.clear()
+        return self.calls
+
+
+@pytest.fixture
+def listener(client):
+    listener = NotificationListener(client, 'http://127.0.0.1/', host='127.0.0.1', port=0,
+                                    workers=1, subscribe=False, client_state='secret')
+    listener.start()
+    yield listener
+    listener.stop()
+
+
+def notify(listener, *notifications):
+    response = requests.post(f'http://127.0.0.1:{listener.port}/', json={'value': list(notifications)}, timeout=5)
+    assert response.status_code == 202
+
+
+def created(message_id: str, client_state: str = 'secret', etag: str = 'W/"1"') -> dict:
+    return {'subscriptionId': 'sub-1', 'clientState': client_state, 'changeType': 'created',
+            'resourceData': {'id': message_id, '@odata.etag': etag}}
+
+
+def test_validation_token_is_echoed(listener):
+    response = requests.post(f'http://127.0.0.1:{listener.port}/', params={'validationToken': 'token 1'},
+                             timeout=5)
+
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'text/plain'
+    assert response.text == 'token 1'
+
+
+def test_subscription_is_validated_on_create(client, stub):
+    listener = NotificationListener(client, '', host='127.0.0.1', port=0)
+    listener.subscriptions.notification_url = f'http://127.0.0.1:{listener.port}/'
+    with listener:
+        [subscription] = stub.server.subscriptions.values()
+        assert subscription['clientState'] == listener.subscriptions.client_state
+    assert stub.server.subscriptions == {}
+
+
+def test_wrong_client_state_is_ignored(listener):
+    received = Received()
+    listener.add_handler(received)
+
+    notify(listener, created('msg-1', client_state='forged'))
+    notify(listener, created('msg-2'))
+
+    [(message, notification)] = received.wait()
+    assert message['id'] == 'msg-2'
+    assert notification['resourceData']['id'] == 'msg-2'
+
+
+def test_duplicate_notifications_are_handled_once(listener):
+    received = Received()
+    listener.add_handler(received)
+
+    notify(listener, created('msg-1'), created('msg-1'))
+    notify(listener, created('msg-1'), created('msg-1', etag='W/"2"'))
+
+    calls = received.wait(2)
+    assert [message['id'] for message, _ in calls] == ['msg-1', 'msg-1']
+    assert [notification['resourceData']['@odata.etag'] for _, notification in calls] == ['W/"1"', 'W/"2"']
+
+
+def test_failing_handler_does_not_stop_others(listener):
+    def broken(message, notification):
+        raise RuntimeError('handler bug')
+
+    received = Received()
+    listener.add_handler(broken)
+    listener.add_handler(received)
+
+    notify(listener, created('msg-1'), created('msg-2'))
+
+    assert sorted(message['id'] for message, _ in received.wait(2)) == ['msg-1', 'msg-2']
+
+
+def test_stop_without_start_returns(client):
+    listener = NotificationListener(client, 'http://127.0.0.1/', host='127.0.0.1', port=0, subscribe=False)
+    stopper = threading.Thread(target=listener.stop, daemon=True)
+    stopper.start()
+    stopper.join(5)
+
+    assert not stopper.is_alive()
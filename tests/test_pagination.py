@@ -0,0 +1,79 @@
+import tracemalloc
+
+import mail_api
+from mail_message import Message
+
+
+def page_requests(stub) -> int:
+    return stub.request_counts['me/mailFolders']
+
+
+def test_iter_messages_follows_next_link(client, stub):
+    messages = list(client.iter_messages('inbox', page_size=10))
+
+    assert [message['id'] for message in messages] == [f'msg-{i}' for i in range(25)]
+    assert page_requests(stub) == 3
+
+
+def test_iter_messages_fetches_pages_lazily(client, stub):
+    messages = client.iter_messages('inbox', page_size=10)
+
+    assert page_requests(stub) == 0
+    for _ in range(10):
+        next(messages)
+    assert page_requests(stub) == 1
+    next(messages)
+    assert page_requests(stub) == 2
+
+
+def test_iter_messages_stops_at_limit(client, stub):
+    messages = list(client.iter_messages('inbox', page_size=10, limit=15))
+
+    assert len(messages) == 15
+    assert page_requests(stub) == 2
+
+
+def test_iter_messages_keeps_query_on_later_pages(client, stub):
+    messages = list(client.iter_messages('inbox', page_size=10, select=['subject'], body='none'))
+
+    assert len(messages) == 25
+    assert all(set(message) <= {'id', '@odata.etag', 'subject'} for message in messages)
+
+
+def test_iter_messages_non_positive_limit(client, stub):
+    assert list(client.iter_messages('inbox', limit=0)) == []
+    assert page_requests(stub) == 0
+
+
+def test_page_size_capped_at_graph_maximum(client, stub):
+    stub.server.message_count = mail_api.MAX_PAGE_SIZE + 5
+
+    assert len(list(client.iter_messages('inbox', page_size=5000))) == mail_api.MAX_PAGE_SIZE + 5
+    assert page_requests(stub) == 2
+
+
+def test_stream_messages_follows_next_link(client, stub):
+    messages = list(client.stream_messages('inbox', page_size=10))
+
+    assert all(isinstance(message, Message) for message in messages)
+    assert [message.id for message in messages] == [f'msg-{i}' for i in range(25)]
+    assert messages[3].sender == 'sender3@example.com'
+    assert page_requests(stub) == 3
+
+
+def test_walking_a_large_folder_keeps_memory_flat(client, stub):
+    stub.server.message_count = 5000
+    stub.server.body_size = 2000
+
+    tracemalloc.start()
+    try:
+        count = 0
+        for _ in client.iter_messages('inbox', page_size=100):
+            count += 1
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert count == 5000
+    # One 100-message page is ~250 KB of bodies; the whole folder would be ~10 MB
+    assert peak < 4 * 1024 * 1024
@@ -0,0 +1,82 @@
+import sys
+
+import pytest
+import requests
+
+import get_refresh_token
+from get_refresh_token import Provisioner
+from token_store import IniTokenStore, MemoryTokenStore
+
+
+@pytest.fixture
+def auth_stub(stub, monkeypatch):
+    monkeypatch.setattr(get_refresh_token, 'AUTH_URL', f'{stub.base_url}/authorize')
+    monkeypatch.setattr(get_refresh_token, 'TOKEN_URL', stub.token_url)
+    monkeypatch.setattr(get_refresh_token, 'DEVICE_CODE_URL', f'{stub.base_url}/devicecode')
+    return stub
+
+
+class Tab:
+    """Browser tab that follows the sign-in redirect like a user who approves at once"""
+
+    def get(self, url):
+        requests.get(url, timeout=5)
+
+    def close(self):
+        pass
+
+
+class Browser:
+    def new_tab(self):
+        return Tab()
+
+
+def test_device_code_provisions_accounts_concurrently(auth_stub):
+    auth_stub.server.latency = 0.2
+    store = MemoryTokenStore()
+    provisioner = Provisioner('test', 'http://localhost/', store, workers=4)
+
+    summary = provisioner.provision([(f'user{i}', None) for i in range(4)], device_code=True)
+
+    assert summary['provisioned'] == ['user0', 'user1', 'user2', 'user3']
+    assert summary['failed'] == {}
+    assert sorted(store.load_all()) == ['user0', 'user1', 'user2', 'user3']
+    assert all(token.refresh_token == 'stub-refresh-token' for token in store.load_all().values())
+    # Each account polls until its code is redeemed; one at a time would take 4 x 4 requests
+    assert auth_stub.request_counts['token'] == 4 * (auth_stub.server.device_code_polls + 1)
+    assert summary['elapsed'] < 4 * 4 * 0.2
+
+
+def test_expired_device_code_fails_only_that_account(auth_stub):
+    store = MemoryTokenStore()
+    provisioner = Provisioner('test', 'http://localhost/', store, timeout=0)
+
+    summary = provisioner.provision([('alice', None)], device_code=True)
+
+    assert summary['provisioned'] == []
+    assert 'not redeemed' in summary['failed']['alice']
+    assert store.load_all() == {}
+
+
+def test_browser_sign_in_exchanges_code(auth_stub):
+    store = MemoryTokenStore()
+    provisioner = Provisioner('test', 'http://localhost/', store, timeout=5)
+
+    tokens = provisioner.authorize_browser(Browser(), 'alice', 'alice@example.com')
+
+    assert tokens['refresh_token'] == 'stub-refresh-token'
+    assert auth_stub.request_counts['token'] == 1
+
+
+def test_main_skips_accounts_with_tokens(auth_stub, config_dir, monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', ['get_refresh_token.py', '--device-code', '--skip-existing',
+                                      '--account', 'default', '--account', 'alice=alice@example.com',
+                                      '--account', 'bob'])
+
+    get_refresh_token.main()
+
+    assert 'Provisioned 2 of 2 accounts' in capsys.readouterr().out
+    tokens = IniTokenStore(str(config_dir / 'config.txt')).load_all()
+    assert tokens['default'].refresh_token == 'test'
+    assert tokens['alice'].refresh_token == tokens['bob'].refresh_token == 'stub-refresh-token'
+    assert len(auth_stub.server.device_codes) == 2
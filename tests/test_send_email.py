@@ -0,0 +1,43 @@
+import pytest
+import requests
+
+import bulk_send
+import mail_api
+
+
+@pytest.fixture
+def large_file(config_dir):
+    path = config_dir / 'large.bin'
+    path.write_bytes(b'x' * (4 * 1024 * 1024))
+    return str(path)
+
+
+def fail_send_with(stub, status):
+    # Draft, upload session and two chunks go through before the send
+    stub.server.fail_next.extend([None] * 4 + [(status, None)])
+
+
+def test_rejected_send_deletes_draft(client, stub, large_file):
+    fail_send_with(stub, 400)
+
+    with pytest.raises(requests.HTTPError):
+        client.send_email(['to@example.com'], 'Report', 'Attached', attachments=[large_file])
+    assert stub.server.drafts == {}
+    assert stub.server.sent == []
+
+
+def test_failed_upload_deletes_draft(client, stub, large_file):
+    stub.server.fail_next.extend([None, (400, None)])
+
+    with pytest.raises(requests.HTTPError):
+        client.send_email(['to@example.com'], 'Report', 'Attached', attachments=[large_file])
+    assert stub.server.drafts == {}
+
+
+def test_gateway_error_on_send_keeps_draft(client, stub, large_file):
+    fail_send_with(stub, 502)
+
+    with pytest.raises(mail_api.DeliveryUnknownError) as excinfo:
+        client.send_email(['to@example.com'], 'Report', 'Attached', attachments=[large_file])
+    assert list(stub.server.drafts) == [excinfo.value.draft_id]
+    assert bulk_send.classify_error(excinfo.value) == 'unknown'
@@ -0,0 +1,31 @@
+import os
+import threading
+
+import mail_api
+from settings import Settings
+from token_store import file_lock
+
+
+def test_save_config_is_read_back(config_dir):
+    config = mail_api.load_config()
+    config['microsoft']['client_id'] = 'changed'
+    mail_api.save_config(config)
+
+    assert Settings('config.txt').client_id == 'changed'
+    assert sorted(os.listdir(config_dir)) == ['config.txt', 'config.txt.lock']
+
+
+def test_save_waits_for_token_store_lock(config_dir):
+    settings = Settings('config.txt')
+    config = settings.config
+    config['microsoft']['client_id'] = 'changed'
+
+    with file_lock('config.txt'):
+        writer = threading.Thread(target=settings.save, args=(config,))
+        writer.start()
+        writer.join(0.2)
+        assert writer.is_alive()
+        assert 'changed' not in (config_dir / 'config.txt').read_text(encoding='utf-8')
+    writer.join()
+
+    assert settings.client_id == 'changed'
@@ -0,0 +1,63 @@
+import pytest
+
+from message_store import MessageStore
+
+
+@pytest.fixture
+def store(config_dir):
+    store = MessageStore(str(config_dir / 'messages.db'))
+    yield store
+    store.close()
+
+
+def delta_requests(stub) -> int:
+    return stub.request_counts['me/mailFolders']
+
+
+def test_first_sync_downloads_folder_and_saves_delta_link(client, stub, store):
+    totals = client.sync_folder('inbox', store, page_size=10)
+
+    assert totals == {'added': 25, 'updated': 0, 'deleted': 0}
+    assert store.count('inbox') == 25
+    assert delta_requests(stub) == 3
+    assert store.get_delta_link('inbox').endswith('/me/mailFolders/inbox/messages/delta?$deltatoken=0')
+
+
+def test_next_sync_only_applies_changes(client, stub, store):
+    client.sync_folder('inbox', store, page_size=10)
+    stub.server.delta_changes.extend([
+        {'id': 'msg-1', 'subject': 'Renamed', 'changeKey': 'ck-new'},
+        {'id': 'msg-new', 'subject': 'Fresh', 'receivedDateTime': '2030-01-01T00:00:00Z'},
+        {'id': 'msg-3', '@removed': {'reason': 'deleted'}},
+    ])
+
+    totals = client.sync_folder('inbox', store, page_size=10)
+
+    assert totals == {'added': 1, 'updated': 1, 'deleted': 1}
+    assert delta_requests(stub) == 4
+    assert store.count('inbox') == 25
+    assert store.get_message('msg-3') is None
+    renamed = store.get_message('msg-1')
+    assert renamed['subject'] == 'Renamed'
+    assert 'body' in renamed
+    assert store.get_delta_link('inbox').endswith('$deltatoken=3')
+
+
+def test_next_sync_without_changes_keeps_store(client, stub, store):
+    client.sync_folder('inbox', store, page_size=10)
+
+    assert client.sync_folder('inbox', store) == {'added': 0, 'updated': 0, 'deleted': 0}
+    assert store.count('inbox') == 25
+
+
+def test_expired_delta_link_resyncs_folder(client, stub, store):
+    client.sync_folder('inbox', store, page_size=10)
+    store.apply_changes('inbox', [{'id': 'stale', 'subject': 'Gone from the server'}])
+    stub.server.fail_next.append((410, None))
+
+    totals = client.sync_folder('inbox', store, page_size=10)
+
+    assert totals == {'added': 25, 'updated': 0, 'deleted': 0}
+    assert store.get_message('stale') is None
+    assert store.count('inbox') == 25
+    assert delta_requests(stub) == 3 + 1 + 3
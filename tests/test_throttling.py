@@ -0,0 +1,58 @@
+import pytest
+import requests
+
+from throttling import RetryPolicy, parse_retry_after
+
+
+@pytest.fixture
+def policy():
+    return RetryPolicy(max_retries=3, backoff_base=0)
+
+
+@pytest.mark.parametrize('status', [429, 502, 503, 504])
+def test_idempotent_requests_retry_transient_statuses(policy, status):
+    assert policy.should_retry_status('GET', status, 0)
+    assert not policy.should_retry_status('GET', status, 3)
+
+
+@pytest.mark.parametrize('status', [502, 504])
+def test_post_is_not_retried_on_gateway_errors(policy, status):
+    assert not policy.should_retry_status('POST', status, 0, retry_after='5')
+
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_post_is_retried_only_when_throttled_with_retry_after(policy, status):
+    assert policy.should_retry_status('POST', status, 0, retry_after='5')
+    assert not policy.should_retry_status('POST', status, 0)
+
+
+def test_client_error_statuses_are_not_retried(policy):
+    assert not policy.should_retry_status('GET', 404, 0)
+
+
+def test_retry_after_wins_over_backoff(policy):
+    assert policy.delay(0, '7') == 7.0
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+
+
+def test_send_email_getting_502_is_not_retried(client, stub):
+    stub.server.fail_next.append((502, None))
+
+    with pytest.raises(requests.HTTPError):
+        client.send_email(['to@contoso.com'], 'Subject', 'Body')
+    assert stub.request_counts['me/sendMail'] == 1
+    assert client.retry_metrics.snapshot().get('retries', 0) == 0
+
+
+def test_send_email_throttled_with_retry_after_is_retried(client, stub):
+    stub.server.fail_next.append((429, 0))
+
+    assert client.send_email(['to@contoso.com'], 'Subject', 'Body') is True
+    assert stub.request_counts['me/sendMail'] == 2
+
+
+def test_get_getting_502_is_retried(client, stub):
+    stub.server.fail_next.append((502, None))
+
+    assert len(client.get_messages(top=5)) == 5
+    assert stub.request_counts['me/mailFolders'] == 2
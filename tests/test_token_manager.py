@@ -0,0 +1,61 @@
+import threading
+import time
+
+import pytest
+
+from token_manager import TokenManager
+
+
+@pytest.fixture
+def manager(stub):
+    manager = TokenManager(refresh_margin=600, jitter=0)
+    yield manager
+    manager.stop()
+
+
+def token_requests(stub) -> int:
+    return stub.request_counts['token']
+
+
+def test_concurrent_refreshes_share_one_request(manager, stub):
+    stub.server.latency = 0.2
+    manager.add_account('alice', 'refresh-a')
+    results = []
+
+    def refresh():
+        results.append(manager.refresh('alice'))
+
+    threads = [threading.Thread(target=refresh) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert token_requests(stub) == 1
+    assert len(results) == 8
+    assert all(token.access_token == 'stub-access-token' for token in results)
+
+
+def test_get_token_refreshes_only_expiring_tokens(manager, stub):
+    manager.add_account('fresh', 'refresh-f', 'cached', time.time() + 3600)
+    manager.add_account('stale', 'refresh-s', 'old', time.time() + 10)
+
+    assert manager.get_access_token('fresh') == 'cached'
+    assert manager.get_access_token('stale') == 'stub-access-token'
+    assert token_requests(stub) == 1
+
+
+def test_tokens_refresh_in_background_before_expiry(manager, stub):
+    refreshed = threading.Event()
+    manager.add_listener(lambda token: refreshed.set())
+    manager.add_account('alice', 'refresh-a', 'old', time.time() + 600.2)
+    manager.start()
+
+    assert token_requests(stub) == 0
+    assert refreshed.wait(5)
+    token = manager.get_token('alice')
+    assert token.access_token == 'stub-access-token'
+    assert token.refresh_token == 'stub-refresh-token'
+    assert token.expires_at > time.time() + 3000
+    time.sleep(0.2)
+    assert token_requests(stub) == 1
@@ -0,0 +1,36 @@
+import pytest
+
+from token_store import AccountToken, IniTokenStore, MemoryTokenStore, SqliteTokenStore, TokenStore
+
+
+def test_incomplete_backend_fails_on_construction():
+    class NoDelete(TokenStore):
+        def load_all(self):
+            return {}
+
+        def save(self, token):
+            pass
+
+    with pytest.raises(TypeError):
+        NoDelete()
+
+
+@pytest.mark.parametrize('make_store', [
+    lambda tmp_path: MemoryTokenStore(),
+    lambda tmp_path: IniTokenStore(str(tmp_path / 'config.txt')),
+    lambda tmp_path: SqliteTokenStore(str(tmp_path / 'tokens.db')),
+], ids=['memory', 'ini', 'sqlite'])
+def test_backends_round_trip_tokens(make_store, tmp_path):
+    store = make_store(tmp_path)
+    try:
+        store.save(AccountToken('default', 'refresh', 'access', 1700000000.0))
+        store.save(AccountToken('second', 'refresh-2'))
+
+        token = store.load()
+        assert (token.refresh_token, token.access_token, token.expires_at) == ('refresh', 'access', 1700000000.0)
+        assert sorted(store.load_all()) == ['default', 'second']
+
+        store.delete('second')
+        assert store.load('second') is None
+    finally:
+        store.close()
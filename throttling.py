@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Retry and Throttling
+Backoff for throttled or failed Graph requests, honoring Retry-After, and
+per-mailbox token buckets that keep request rates below Graph's limits
+"""
+
+import random
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+# Statuses Graph returns when a request may succeed if repeated later
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+# Statuses that mean the caller is being throttled
+THROTTLE_STATUSES = frozenset([429, 503])
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+# Concurrent requests Graph serves per mailbox before throttling the rest
+MAILBOX_CONCURRENCY = 4
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given in seconds or as an HTTP date"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryMetrics:
+    """Thread-safe counters of requests, retries and throttled responses
+
+    Args:
+        parent: Optional counters every increment is also added to, e.g. process-wide totals
+    """
+
+    def __init__(self, parent: Optional['RetryMetrics'] = None):
+        self.parent = parent
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counts[name] += amount
+        if self.parent is not None:
+            self.parent.increment(name, amount)
+
+    def snapshot(self) -> Dict[str, int]:
+        """Get a copy of all counters"""
+        with self._lock:
+            return dict(self._counts)
+
+
+class RetryPolicy:
+    """Decide whether and how long to wait before repeating a request
+
+    Delays grow exponentially from `backoff_base` up to `backoff_max` with
+    full jitter, unless the server sent Retry-After, which always wins.
+
+    Args:
+        max_retries: Retries after the first attempt
+        backoff_base: Delay in seconds before the first retry
+        backoff_max: Upper bound of any computed delay
+    """
+
+    def __init__(self, max_retries: int = 5, backoff_base: float = 1.0, backoff_max: float = 60.0):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    @classmethod
+    def from_config(cls, config) -> 'RetryPolicy':
+        """Create policy from the optional [retry] section of config.txt"""
+        return cls(
+            max_retries=config.getint('retry', 'max_retries', fallback=5),
+            backoff_base=config.getfloat('retry', 'backoff_base', fallback=1.0),
+            backoff_max=config.getfloat('retry', 'backoff_max', fallback=60.0)
+        )
+
+    def should_retry_status(self, method: str, status: int, attempt: int,
+                            retry_after: Optional[str] = None) -> bool:
+        """Whether a response status is worth repeating the request for
+
+        Requests that are not safe to repeat, such as POST sendMail, are only
+        retried on 429 or 503 with Retry-After, where Graph turned the request
+        away; a 502 or 504 may arrive after the request took effect.
+        """
+        if status not in RETRY_STATUSES or attempt >= self.max_retries:
+            return False
+        if method.upper() in IDEMPOTENT_METHODS:
+            return True
+        return status in THROTTLE_STATUSES and bool(retry_after)
+
+    def should_retry_error(self, method: str, attempt: int) -> bool:
+        """Connection errors are only retried for methods that are safe to repeat"""
+        return method.upper() in IDEMPOTENT_METHODS and attempt < self.max_retries
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Get seconds to wait before retry number `attempt` (0-based)"""
+        server_delay = parse_retry_after(retry_after)
+        if server_delay is not None:
+            return server_delay
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+class TokenBucket:
+    """Token bucket allowing `rate` requests per second with bursts of `capacity`"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Take tokens and return the seconds the caller must wait before using them"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """Block until tokens are available, returning the seconds waited"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiter:
+    """One token bucket per mailbox
+
+    Graph throttles per app and mailbox (about 10,000 requests per 10
+    minutes), so the default 15 requests per second stays just below it.
+
+    Args:
+        rate: Requests per second allowed per mailbox, 0 disables limiting
+        burst: Requests a mailbox may send at once after being idle
+    """
+
+    def __init__(self, rate: float = 15.0, burst: float = 30.0):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config) -> 'RateLimiter':
+        """Create limiter from the optional [retry] section of config.txt"""
+        return cls(
+            rate=config.getfloat('retry', 'requests_per_second', fallback=15.0),
+            burst=config.getfloat('retry', 'burst', fallback=30.0)
+        )
+
+    def bucket(self, mailbox: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(mailbox)
+            if bucket is None:
+                bucket = self._buckets[mailbox] = TokenBucket(self.rate, self.burst)
+            return bucket
+
+    def reserve(self, mailbox: str) -> float:
+        """Take one request from the mailbox's bucket, returning the seconds to wait"""
+        if self.rate <= 0:
+            return 0.0
+        return self.bucket(mailbox).reserve()
+
+    def acquire(self, mailbox: str) -> float:
+        """Block until the mailbox may send another request, returning the seconds waited"""
+        wait = self.reserve(mailbox)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
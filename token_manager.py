@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Multi-Account Token Manager
+Keeps access tokens of many accounts fresh by refreshing them in the
+background, ahead of expiry, instead of inside the request path
+"""
+
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import requests
+
+import mail_api
+from mail_api import create_session, get_timeout
+from instrumentation import Instrumentation, get_instrumentation
+from proxy_resolver import ProxyResolver
+from token_store import DEFAULT_ACCOUNT, AccountToken, TokenStore, open_token_store
+
+logger = logging.getLogger(__name__)
+
+
+class TokenManager:
+    """Hold tokens of many accounts and refresh them before they expire
+
+    Each account is scheduled for refresh `refresh_margin` seconds before
+    expiry, minus a random jitter of up to `jitter` seconds so accounts
+    loaded together do not all refresh at once. Concurrent refreshes of the
+    same account share a single token request.
+
+    Args:
+        session: Optional HTTP session, defaults to a pooled session from config.txt
+        proxy_resolver: Optional proxy resolver, defaults to one from config.txt
+        refresh_margin: Seconds before expiry at which tokens are refreshed in the background
+        jitter: Maximum random seconds subtracted from each scheduled refresh
+        request_buffer: Tokens closer than this to expiry are refreshed in the request path
+        workers: Number of background refresh threads
+        instrumentation: Optional metrics collector timing refreshes, defaults to the process-wide one
+    """
+
+    def __init__(self, session: requests.Session = None, proxy_resolver: ProxyResolver = None,
+                 refresh_margin: float = 600, jitter: float = 120, request_buffer: float = 300,
+                 workers: int = 4, instrumentation: Instrumentation = None):
+        config = mail_api.load_config()
+        self.session = session if session is not None else create_session(config)
+        self.timeout = get_timeout(config)
+        self.proxy_resolver = proxy_resolver if proxy_resolver is not None else ProxyResolver.from_config(config)
+        self.instrumentation = instrumentation if instrumentation is not None else get_instrumentation(config)
+        self.refresh_margin = refresh_margin
+        self.jitter = jitter
+        self.request_buffer = request_buffer
+        self.workers = workers
+        self._accounts = {}
+        self._inflight = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._schedule = []
+        self._due = {}
+        self._sequence = itertools.count()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopped = True
+        self._scheduler = None
+        self._executor = None
+
+    @classmethod
+    def from_config(cls, config=None, **kwargs) -> 'TokenManager':
+        """Create manager with every account of the configured token store
+
+        The store is selected by the [token_store] section and defaults to
+        config.txt, where [tokens] is the 'default' account and
+        [tokens:<name>] sections are further accounts. Manager settings come
+        from the optional [token_manager] section.
+        """
+        if config is None:
+            config = mail_api.load_config()
+        kwargs.setdefault('refresh_margin', config.getfloat('token_manager', 'refresh_margin', fallback=600))
+        kwargs.setdefault('jitter', config.getfloat('token_manager', 'jitter', fallback=120))
+        kwargs.setdefault('workers', config.getint('token_manager', 'workers', fallback=4))
+        return cls.from_store(open_token_store(config), **kwargs)
+
+    @classmethod
+    def from_store(cls, store: TokenStore, **kwargs) -> 'TokenManager':
+        """Create manager with every account in `store` and save refreshed tokens back to it"""
+        manager = cls(**kwargs)
+        for token in store.load_all().values():
+            if token.refresh_token:
+                manager.add_account(token.account, token.refresh_token, token.access_token, token.expires_at)
+        manager.add_listener(store.save)
+        return manager
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def accounts(self) -> List[str]:
+        with self._lock:
+            return list(self._accounts)
+
+    def add_listener(self, listener: Callable[[AccountToken], None]) -> None:
+        """Call listener with the account's token state after every successful refresh"""
+        self._listeners.append(listener)
+
+    def add_account(self, account: str, refresh_token: str, access_token: str = '',
+                    expires_at: float = 0.0) -> None:
+        """Add or replace an account and schedule its next refresh"""
+        token = AccountToken(account, refresh_token, access_token, expires_at)
+        with self._lock:
+            self._accounts[account] = token
+            self._schedule_refresh(token)
+
+    def remove_account(self, account: str) -> None:
+        with self._lock:
+            self._accounts.pop(account, None)
+            self._due.pop(account, None)
+
+    def get_token(self, account: str = DEFAULT_ACCOUNT) -> AccountToken:
+        """Get an account's token state, refreshing now only if it is about to expire"""
+        with self._lock:
+            token = self._accounts[account]
+        if token.expires_within(self.request_buffer):
+            return self.refresh(account)
+        return token
+
+    def get_access_token(self, account: str = DEFAULT_ACCOUNT) -> str:
+        return self.get_token(account).access_token
+
+    def refresh(self, account: str = DEFAULT_ACCOUNT) -> AccountToken:
+        """Refresh an account's access token
+
+        If a refresh of the same account is already running, wait for it and
+        share its result instead of sending another token request.
+        """
+        with self._lock:
+            future = self._inflight.get(account)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[account] = future
+        if not owner:
+            return future.result()
+
+        try:
+            token = self._refresh_now(account)
+            future.set_result(token)
+            return token
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[account]
+
+    def _refresh_now(self, account: str) -> AccountToken:
+        with self._lock:
+            token = self._accounts[account]
+        refresh_params = {
+            'client_id': mail_api.settings.client_id,
+            'refresh_token': token.refresh_token,
+            'grant_type': 'refresh_token',
+        }
+
+        try:
+            with self.instrumentation.time_token_refresh(account):
+                response = self.session.post(
+                    mail_api.TOKEN_URL,
+                    data=refresh_params,
+                    timeout=self.timeout,
+                    proxies=self.proxy_resolver.resolve()
+                )
+                response.raise_for_status()
+                tokens = response.json()
+        except requests.RequestException as e:
+            logger.error(f"Failed to refresh access token of {account}: {e}")
+            raise
+
+        with self._lock:
+            token.access_token = tokens['access_token']
+            token.expires_at = time.time() + tokens['expires_in']
+            if 'refresh_token' in tokens:
+                token.refresh_token = tokens['refresh_token']
+            if self._accounts.get(account) is token:
+                self._schedule_refresh(token)
+        for listener in self._listeners:
+            try:
+                listener(token)
+            except Exception as e:
+                logger.error(f"Token listener failed for {account}: {e}")
+        return token
+
+    def _schedule_refresh(self, token: AccountToken, due: Optional[float] = None) -> None:
+        """Queue the account's next background refresh, caller holds the lock"""
+        if due is None:
+            due = token.expires_at - self.refresh_margin - random.uniform(0, self.jitter)
+        self._due[token.account] = due
+        heapq.heappush(self._schedule, (due, next(self._sequence), token.account))
+        self._wakeup.notify()
+
+    def start(self) -> None:
+        """Start refreshing tokens in the background"""
+        with self._lock:
+            if not self._stopped:
+                return
+            self._stopped = False
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='token-refresh')
+        self._scheduler = threading.Thread(target=self._run_scheduler, name='token-scheduler', daemon=True)
+        self._scheduler.start()
+
+    def stop(self) -> None:
+        """Stop the background scheduler and wait for running refreshes"""
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._wakeup.notify()
+        self._scheduler.join()
+        self._executor.shutdown(wait=True)
+
+    def _run_scheduler(self) -> None:
+        while True:
+            with self._lock:
+                while not self._stopped:
+                    if self._schedule:
+                        due, _, account = self._schedule[0]
+                        if self._due.get(account) != due:
+                            # Superseded by a later schedule entry or account removed
+                            heapq.heappop(self._schedule)
+                            continue
+                        delay = due - time.time()
+                        if delay <= 0:
+                            heapq.heappop(self._schedule)
+                            del self._due[account]
+                            break
+                        # Capped, as far-off expiries overflow the platform timeout
+                        self._wakeup.wait(min(delay, 3600))
+                    else:
+                        self._wakeup.wait()
+                if self._stopped:
+                    return
+            self._executor.submit(self._background_refresh, account)
+
+    def _background_refresh(self, account: str) -> None:
+        try:
+            self.refresh(account)
+        except Exception:
+            with self._lock:
+                token = self._accounts.get(account)
+                if token is not None and account not in self._due:
+                    # Retry soon, but never hammer the token endpoint
+                    self._schedule_refresh(token, time.time() + 30 + random.uniform(0, self.jitter))
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Token Storage
+Pluggable persistence for account tokens: the config.txt INI file, a SQLite
+database or memory. File writes are atomic and serialized with a file lock,
+and reads are served from memory until the underlying file changes
+"""
+
+import abc
+import configparser
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Optional
+
+DEFAULT_ACCOUNT = 'default'
+# Config sections holding tokens: [tokens] for the default account, [tokens:<name>] for others
+ACCOUNT_SECTION_PREFIX = 'tokens:'
+EXPIRES_AT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def account_section(account: str) -> str:
+    """Get the config.txt section name holding an account's tokens"""
+    return 'tokens' if account == DEFAULT_ACCOUNT else f'{ACCOUNT_SECTION_PREFIX}{account}'
+
+
+def section_account(section: str) -> Optional[str]:
+    """Get the account stored in a config.txt section, None if it holds no tokens"""
+    if section == 'tokens':
+        return DEFAULT_ACCOUNT
+    if section.startswith(ACCOUNT_SECTION_PREFIX):
+        return section[len(ACCOUNT_SECTION_PREFIX):]
+    return None
+
+
+def parse_expires_at(value: str) -> float:
+    return datetime.strptime(value, EXPIRES_AT_FORMAT).timestamp() if value else 0.0
+
+
+def format_expires_at(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime(EXPIRES_AT_FORMAT)
+
+
+class AccountToken:
+    """Token state of one account"""
+
+    __slots__ = ('account', 'refresh_token', 'access_token', 'expires_at')
+
+    def __init__(self, account: str, refresh_token: str, access_token: str = '', expires_at: float = 0.0):
+        self.account = account
+        self.refresh_token = refresh_token
+        self.access_token = access_token
+        self.expires_at = expires_at
+
+    def expires_within(self, seconds: float) -> bool:
+        return not self.access_token or time.time() + seconds >= self.expires_at
+
+    def copy(self) -> 'AccountToken':
+        return AccountToken(self.account, self.refresh_token, self.access_token, self.expires_at)
+
+
+@contextmanager
+def file_lock(path: str):
+    """Hold an exclusive inter-process lock on `path`.lock"""
+    with open(f'{path}.lock', 'a+') as lock_file:
+        if os.name == 'nt':
+            import msvcrt
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def atomic_write(path: str, content: str) -> None:
+    """Replace a file's content so readers see either the old or the new file, never a partial one"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(path)}.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class TokenStore(abc.ABC):
+    """Base class of token stores
+
+    Backends implement load_all(), save() and delete(). Tokens returned by
+    load() and load_all() are copies; pass changed tokens back through save().
+    """
+
+    def load(self, account: str = DEFAULT_ACCOUNT) -> Optional[AccountToken]:
+        return self.load_all().get(account)
+
+    @abc.abstractmethod
+    def load_all(self) -> Dict[str, AccountToken]:
+        """Get the tokens of every account"""
+
+    @abc.abstractmethod
+    def save(self, token: AccountToken) -> None:
+        """Store an account's token, replacing any earlier one"""
+
+    @abc.abstractmethod
+    def delete(self, account: str) -> None:
+        """Remove an account's token if there is one"""
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryTokenStore(TokenStore):
+    """Keep tokens in memory only, e.g. for tests or short-lived workers"""
+
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def load_all(self) -> Dict[str, AccountToken]:
+        with self._lock:
+            return {account: token.copy() for account, token in self._tokens.items()}
+
+    def save(self, token: AccountToken) -> None:
+        with self._lock:
+            self._tokens[token.account] = token.copy()
+
+    def delete(self, account: str) -> None:
+        with self._lock:
+            self._tokens.pop(account, None)
+
+
+class IniTokenStore(TokenStore):
+    """Store tokens in the [tokens] and [tokens:<name>] sections of config.txt
+
+    The file is parsed again only when its modification time or size
+    changes. Saves take a file lock, re-read the latest file so tokens
+    written by other processes are kept, and atomically replace it.
+    """
+
+    def __init__(self, path: str = 'config.txt'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._tokens = {}
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read_config(self) -> configparser.ConfigParser:
+        config = configparser.ConfigParser()
+        config.read(self.path, encoding='utf-8')
+        return config
+
+    def _refresh_cache(self) -> None:
+        """Re-parse the file if it changed since it was last read, caller holds the lock"""
+        stamp = self._file_stamp()
+        if stamp is not None and stamp == self._stamp:
+            return
+        tokens = {}
+        config = self._read_config()
+        for section in config.sections():
+            account = section_account(section)
+            if account is None:
+                continue
+            values = config[section]
+            tokens[account] = AccountToken(
+                account,
+                values.get('refresh_token', ''),
+                values.get('access_token', ''),
+                parse_expires_at(values.get('expires_at', ''))
+            )
+        self._tokens = tokens
+        self._stamp = stamp
+
+    def load_all(self) -> Dict[str, AccountToken]:
+        with self._lock:
+            self._refresh_cache()
+            return {account: token.copy() for account, token in self._tokens.items()}
+
+    def _update(self, account: str, token: Optional[AccountToken]) -> None:
+        with self._lock, file_lock(self.path):
+            config = self._read_config()
+            section = account_section(account)
+            if token is None:
+                config.remove_section(section)
+            else:
+                if not config.has_section(section):
+                    config.add_section(section)
+                config[section]['refresh_token'] = token.refresh_token
+                config[section]['access_token'] = token.access_token
+                config[section]['expires_at'] = format_expires_at(token.expires_at) if token.expires_at else ''
+
+            content = io.StringIO()
+            config.write(content)
+            atomic_write(self.path, content.getvalue())
+            self._stamp = None
+
+    def save(self, token: AccountToken) -> None:
+        self._update(token.account, token)
+
+    def delete(self, account: str) -> None:
+        self._update(account, None)
+
+
+class SqliteTokenStore(TokenStore):
+    """Store tokens in a SQLite database shared safely between processes
+
+    Reads are served from memory until another connection commits a change,
+    detected through SQLite's data_version pragma.
+    """
+
+    def __init__(self, path: str = 'tokens.db'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS tokens ('
+            'account TEXT PRIMARY KEY, refresh_token TEXT NOT NULL, '
+            'access_token TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self._conn.commit()
+        self._version = None
+        self._tokens = {}
+
+    def load_all(self) -> Dict[str, AccountToken]:
+        with self._lock:
+            version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+            if version != self._version:
+                rows = self._conn.execute(
+                    'SELECT account, refresh_token, access_token, expires_at FROM tokens'
+                ).fetchall()
+                self._tokens = {row[0]: AccountToken(*row) for row in rows}
+                self._version = version
+            return {account: token.copy() for account, token in self._tokens.items()}
+
+    def save(self, token: AccountToken) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO tokens (account, refresh_token, access_token, expires_at) '
+                'VALUES (?, ?, ?, ?)',
+                (token.account, token.refresh_token, token.access_token, token.expires_at)
+            )
+            self._tokens[token.account] = token.copy()
+
+    def delete(self, account: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM tokens WHERE account = ?', (account,))
+            self._tokens.pop(account, None)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def open_token_store(config) -> TokenStore:
+    """Open the token store selected by the optional [token_store] section of config.txt
+
+        backend: 'ini' (default), 'sqlite' or 'memory'
+        path: Store file, defaults to config.txt for ini and tokens.db for sqlite
+    """
+    backend = config.get('token_store', 'backend', fallback='ini').strip().lower()
+    if backend == 'ini':
+        return IniTokenStore(config.get('token_store', 'path', fallback='config.txt'))
+    if backend == 'sqlite':
+        return SqliteTokenStore(config.get('token_store', 'path', fallback='tokens.db'))
+    if backend == 'memory':
+        return MemoryTokenStore()
+    raise ValueError(f"Unknown token store backend: {backend}")